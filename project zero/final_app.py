@@ -3,23 +3,46 @@
 # -----------------------------
 import io
 import os
+import sys
+import mmap
 import re
+import struct
+import bisect
 import json
 import math
 import time
 import hashlib
+import uuid
+import queue
+import tempfile
+import shutil
+import importlib.util
 import zipfile
+import zlib
 import datetime as dt
+import asyncio
+import threading
 import subprocess
 import multiprocessing
-from typing import List, Optional, Dict, Any, Tuple, Generator, cast
+import contextlib
+import functools
+import ipaddress
+from array import array
+from urllib.parse import urlsplit
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Dict, Any, Tuple, Generator, Callable, Awaitable, cast
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Query
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from sqlalchemy import create_engine, String, Integer, Float, Boolean, DateTime, Text, asc, desc
-from sqlalchemy.orm import declarative_base, sessionmaker, Session, Mapped, mapped_column
+from sqlalchemy import create_engine, event, String, Integer, Float, Boolean, DateTime, Text, LargeBinary, Index, asc, desc, func, or_, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import declarative_base, sessionmaker, Session, Mapped, mapped_column, undefer
+from sqlalchemy.types import TypeDecorator
 
 # Required for Streamlit frontend
 import streamlit as st
@@ -30,21 +53,9 @@ import requests
 # -----------------------------
 # These blocks handle cases where third-party libraries (like androguard) might not be installed.
 # They define placeholder classes to prevent ImportErrors.
-try:
-    from androguard.core.bytecodes.apk import APK  # type: ignore
-    ANDROGUARD_AVAILABLE = True
-except ImportError:
-    ANDROGUARD_AVAILABLE = False
-    class APK:  # type: ignore
-        def __init__(self, *args, **kwargs): pass
-        def get_app_name(self): pass
-        def get_package(self): pass
-        def get_permissions(self): pass
-        def get_activities(self): pass
-        def get_receivers(self): pass
-        def get_services(self): pass
-        def get_providers(self): pass
-        def get_signature_names(self): pass
+# androguard is slow to import and only used in deep mode (or when the built-in manifest
+# parser fails), so it is located here and imported on first use in extract_with_androguard.
+ANDROGUARD_AVAILABLE = importlib.util.find_spec("androguard") is not None
 
 try:
     from apkutils2 import APK as APKU  # type: ignore
@@ -75,26 +86,246 @@ except ImportError:
         @staticmethod
         def load(path): return None
 
+try:
+    import numpy as np  # type: ignore
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    np = None  # type: ignore
+
+try:
+    import zstandard as zstd  # type: ignore
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+    zstd = None  # type: ignore
+
+try:
+    import msgpack  # type: ignore
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+    msgpack = None  # type: ignore
+
 
 # -----------------------------
 # BACKEND: Setup
 # This section sets up the database, file directories, and core constants for the FastAPI backend.
 # -----------------------------
 DATA_DIR = os.path.abspath("data")
-UPLOAD_DIR = os.path.abspath(os.path.join("storage", "uploads"))
+UPLOAD_DIR = os.path.abspath(os.path.join("storage", "uploads"))  # in-progress spools
+SAMPLE_DIR = os.path.abspath(os.path.join("storage", "samples"))
+# Samples at rest: "zstd" (needs the zstandard package) or "none".
+SAMPLE_COMPRESSION = os.environ.get("SAMPLE_COMPRESSION", "none")
+SAMPLE_ZSTD_LEVEL = 3
+SAMPLE_RETENTION_DAYS = int(os.environ.get("SAMPLE_RETENTION_DAYS", 90))
+SPOOL_MAX_AGE = 24 * 3600  # seconds before an abandoned .part spool is collected
 MODEL_DIR = os.path.abspath("models")
+DEFAULT_MODEL_NAME = "model"
+# Traffic split across model versions stored as MODEL_DIR/<name>.joblib, e.g. "model:90,model_v2:10".
+MODEL_AB_SPLIT = os.environ.get("MODEL_AB_SPLIT", f"{DEFAULT_MODEL_NAME}:100")
+MODEL_RELOAD_INTERVAL = 2.0
+RESCORE_CHUNK_SIZE = 2000
 MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 ALLOWED_CONTENT_TYPES = {"application/vnd.android.package-archive", "application/octet-stream"}
+BATCH_CONTENT_TYPES = ALLOWED_CONTENT_TYPES | {"application/zip", "application/x-zip-compressed"}
+BATCH_MAX_ITEMS = 1000
+BATCH_LIMIT_ERROR = f"Batch limit of {BATCH_MAX_ITEMS} items exceeded, not analyzed"
+
+# Analysis engine: ANALYSIS_WORKERS=0 runs extraction in the server's thread pool instead
+# of worker processes. At most ANALYSIS_MAX_PENDING analyses may be queued or running.
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", os.cpu_count() or 1))
+ANALYSIS_MAX_PENDING = int(os.environ.get("ANALYSIS_MAX_PENDING", 4 * max(ANALYSIS_WORKERS, 1)))
+ANALYSIS_MP_CONTEXT = os.environ.get("ANALYSIS_MP_CONTEXT", "spawn")
+ANALYSIS_RETRY_AFTER = 5
+# Deep mode parses manifests with androguard instead of the built-in AXML reader.
+ANALYSIS_DEEP = os.environ.get("ANALYSIS_DEEP", "0") == "1"
+# Per-entry scan results are cached by (CRC32, sizes, name); entries below the size floor
+# are cheaper to rescan than to look up.
+ENTRY_CACHE_ENABLED = os.environ.get("ENTRY_CACHE", "1") == "1"
+ENTRY_CACHE_MIN_BYTES = 16 * 1024
+ENTRY_CACHE_BATCH = 500
+# Rows kept in entry_cache; the oldest are evicted past this (by gc_samples and by writers).
+ENTRY_CACHE_MAX_ROWS = int(os.environ.get("ENTRY_CACHE_MAX_ROWS", 200000))
+# Entries of one APK can be inflated and scanned by a thread pool (zlib releases the GIL).
+# 1 keeps the serial walk; with process workers, threads multiply per worker.
+ENTRY_SCAN_THREADS = int(os.environ.get("ENTRY_SCAN_THREADS", "1"))
+ENTRY_SCAN_MEMORY_BUDGET = int(os.environ.get("ENTRY_SCAN_MEMORY_BUDGET", 256 * 1024 * 1024))
+# Per-APK extraction budgets. Entries beyond them are skipped (not failed), the analysis
+# still completes, and the report gets a resource_limit reason.
+EXTRACT_MAX_BYTES = int(os.environ.get("EXTRACT_MAX_BYTES", 512 * 1024 * 1024))  # decompressed, all entries
+EXTRACT_MAX_ENTRIES = int(os.environ.get("EXTRACT_MAX_ENTRIES", 20000))  # scannable entries inflated
+EXTRACT_MAX_RATIO = 100  # uncompressed/compressed, checked for entries over EXTRACT_RATIO_MIN_BYTES
+EXTRACT_RATIO_MIN_BYTES = 1024 * 1024
+EXTRACT_DEADLINE = float(os.environ.get("EXTRACT_DEADLINE", 30.0))  # seconds per APK
+MANIFEST_MAX_BYTES = 16 * 1024 * 1024
+# Entry names kept in features["files"]; longer listings are cut and noted in `limits`.
+FEATURES_MAX_FILES = int(os.environ.get("FEATURES_MAX_FILES", 10000))
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(SAMPLE_DIR, exist_ok=True)
 
 DB_URL = f"sqlite:///{os.path.join(DATA_DIR, 'app.db')}"
 engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+# WAL lets /reports readers run alongside the writer; NORMAL only fsyncs at checkpoints.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": "5000",
+    "temp_store": "MEMORY",
+    "cache_size": "-65536",  # KiB
+}
+# Report inserts are group-committed by a single writer thread (see ReportWriter).
+REPORT_WRITE_BATCH = 64
+REPORT_WRITE_DELAY = 0.005  # seconds the writer waits to grow a batch
+# Report features/reasons are stored as msgpack + zstd with a dictionary trained on
+# stored features (JSON + zlib when those packages are missing).
+REPORT_ZSTD_LEVEL = 9
+REPORT_DICT_SIZE = 64 * 1024
+REPORT_DICT_SAMPLES = 2000  # most recent reports the dictionary is trained on
+REPORT_DICT_MIN_SAMPLES = 100
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_conn, _record) -> None:
+    cur = dbapi_conn.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cur.execute(f"PRAGMA {name}={value}")
+    cur.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+# -----------------------------
+# BACKEND: Report storage codec
+# Blob layout: b"RC", serializer, compressor, dictionary id (struct "<2sBBI"), payload.
+# Rows written as JSON text by earlier versions still decode; migrate_report_storage()
+# converts them.
+# -----------------------------
+class ReportCodec:
+    """Encodes JSON-compatible values into compact blobs and back."""
+
+    MAGIC = b"RC"
+    HEADER = struct.Struct("<2sBBI")
+    JSON, MSGPACK = 1, 2
+    ZLIB, ZSTD = 1, 2
+
+    def __init__(self, level: int = REPORT_ZSTD_LEVEL):
+        self.level = level
+        self.dicts: Dict[int, Any] = {}  # id -> zstd.ZstdCompressionDict
+        self.active_id = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.local = threading.local()  # zstd (de)compressors are not thread-safe
+
+    def load(self) -> None:
+        """Reads the trained dictionaries; the newest one compresses new rows."""
+        if not ZSTD_AVAILABLE:
+            self.loaded = True
+            return
+        with SessionLocal() as db:
+            rows = db.query(CodecDictionary.id, CodecDictionary.data).order_by(asc(CodecDictionary.id)).all()
+        with self.lock:
+            for r in rows:
+                if r.id not in self.dicts:
+                    self.dicts[r.id] = zstd.ZstdCompressionDict(r.data)
+            if rows:
+                self.active_id = rows[-1].id
+            self.loaded = True
+
+    def dictionary(self, dict_id: int) -> Any:
+        if dict_id not in self.dicts:
+            self.load()  # trained by another process
+        if dict_id not in self.dicts:
+            raise ValueError(f"Unknown report codec dictionary {dict_id}")
+        return self.dicts[dict_id]
+
+    def coder(self, kind: str, dict_id: int) -> Any:
+        cache = self.local.__dict__.setdefault(kind, {})
+        coder = cache.get(dict_id)
+        if coder is None:
+            d = self.dictionary(dict_id) if dict_id else None
+            if kind == "compress":
+                coder = zstd.ZstdCompressor(level=self.level, dict_data=d)
+            else:
+                coder = zstd.ZstdDecompressor(dict_data=d)
+            cache[dict_id] = coder
+        return coder
+
+    @classmethod
+    def serialize(cls, value: Any) -> Tuple[int, bytes]:
+        if MSGPACK_AVAILABLE:
+            return cls.MSGPACK, msgpack.packb(value, use_bin_type=True)
+        return cls.JSON, json.dumps(value, separators=(",", ":")).encode()
+
+    def encode(self, value: Any) -> bytes:
+        fmt, payload = self.serialize(value)
+        if ZSTD_AVAILABLE:
+            if not self.loaded:
+                self.load()
+            dict_id = self.active_id
+            return self.HEADER.pack(self.MAGIC, fmt, self.ZSTD, dict_id) + self.coder("compress", dict_id).compress(payload)
+        return self.HEADER.pack(self.MAGIC, fmt, self.ZLIB, 0) + zlib.compress(payload, 6)
+
+    def decode(self, blob: Any) -> Any:
+        if isinstance(blob, str):
+            return json.loads(blob)
+        blob = bytes(blob)
+        if not blob.startswith(self.MAGIC):
+            return json.loads(blob)
+        _, fmt, comp, dict_id = self.HEADER.unpack_from(blob)
+        body = blob[self.HEADER.size:]
+        if comp == self.ZSTD:
+            if not ZSTD_AVAILABLE:
+                raise RuntimeError("Decoding stored reports needs the zstandard package")
+            payload = self.coder("decompress", dict_id).decompress(body)
+        else:
+            payload = zlib.decompress(body)
+        if fmt == self.MSGPACK:
+            if not MSGPACK_AVAILABLE:
+                raise RuntimeError("Decoding stored reports needs the msgpack package")
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        return json.loads(payload)
+
+    def train(self, samples: List[Any]) -> Optional[int]:
+        """Trains and stores a dictionary from sample values; None if there are too few."""
+        if not ZSTD_AVAILABLE or len(samples) < REPORT_DICT_MIN_SAMPLES:
+            return None
+        try:
+            d = zstd.train_dictionary(REPORT_DICT_SIZE, [self.serialize(v)[1] for v in samples])
+        except zstd.ZstdError:
+            return None
+        with SessionLocal() as db:
+            row = CodecDictionary(data=d.as_bytes())
+            db.add(row)
+            db.commit()
+            dict_id = row.id
+        with self.lock:
+            self.dicts[dict_id] = d
+            self.active_id = dict_id
+            self.loaded = True
+        return dict_id
+
+
+report_codec = ReportCodec()
+
+
+class PackedJSON(TypeDecorator):
+    """A JSON value column stored through report_codec."""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value: Any, dialect: Any) -> Optional[bytes]:
+        return None if value is None else report_codec.encode(value)
+
+    def process_result_value(self, value: Any, dialect: Any) -> Any:
+        return None if value is None else report_codec.decode(value)
+
+
 # -----------------------------
 # BACKEND: Models (SQLAlchemy 2.0 typing)
 # These classes define the database schema using SQLAlchemy 2.0's Mapped syntax.
@@ -108,10 +339,17 @@ class Report(Base):
     size_bytes: Mapped[int] = mapped_column(Integer)
     verdict: Mapped[str] = mapped_column(String)
     score: Mapped[float] = mapped_column(Float)
-    reasons: Mapped[str] = mapped_column(Text)
-    features: Mapped[str] = mapped_column(Text)
+    reasons: Mapped[List[Dict[str, Any]]] = mapped_column(PackedJSON)
+    # Deferred: loading a Report row does not read or decode its features until accessed.
+    features: Mapped[Dict[str, Any]] = mapped_column(PackedJSON, deferred=True)
+    perm_mask: Mapped[int] = mapped_column(Integer, default=0, index=True)
+    minhash: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    minhash_version: Mapped[int] = mapped_column(Integer, default=0)  # MINHASH_TOKEN_VERSION
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
 
+    # Keyset pagination of /reports walks (created_at, id) newest first.
+    __table_args__ = (Index("ix_reports_created_id", "created_at", "id"),)
+
 
 class BankRef(Base):
     __tablename__ = "banks"
@@ -121,9 +359,66 @@ class BankRef(Base):
     official: Mapped[bool] = mapped_column(Boolean, default=True)
 
 
+class BankSigner(Base):
+    __tablename__ = "bank_signers"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    bank_id: Mapped[int] = mapped_column(Integer, index=True)
+    fingerprint: Mapped[str] = mapped_column(String, index=True)
+
+
+class AnalysisJob(Base):
+    __tablename__ = "jobs"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    sha256: Mapped[str] = mapped_column(String, index=True)
+    filename: Mapped[str] = mapped_column(String)
+    size_bytes: Mapped[int] = mapped_column(Integer)
+    status: Mapped[str] = mapped_column(String, index=True, default="queued")
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    report_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
+class AnalysisLock(Base):
+    __tablename__ = "analysis_locks"
+    sha256: Mapped[str] = mapped_column(String, primary_key=True)
+    owner: Mapped[str] = mapped_column(String)
+    acquired_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
+class CodecDictionary(Base):
+    __tablename__ = "codec_dictionaries"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
+class EntryCache(Base):
+    __tablename__ = "entry_cache"
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    data: Mapped[str] = mapped_column(Text)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
 Base.metadata.create_all(bind=engine)
 
 
+def ensure_column(table: str, column: str, ddl: str) -> bool:
+    """Adds a column that create_all() cannot add to an existing table. Returns True if added."""
+    with engine.begin() as conn:
+        cols = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+        if column in cols:
+            return False
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        return True
+
+
+# create_all() skips indexes of tables that already exist.
+with engine.begin() as conn:
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_reports_created_id ON reports (created_at, id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_entry_cache_created_at ON entry_cache (created_at)"))
+
+
 # Seed database with known banks. This ensures the application has initial data to work with.
 with SessionLocal() as s:
     if s.query(BankRef).count() == 0:
@@ -162,10 +457,64 @@ class AnalysisResult(BaseModel):
     created_at: dt.datetime
 
 
+class ReportSummary(BaseModel):
+    id: int
+    sha256: str
+    filename: str
+    size_bytes: int
+    score: float
+    verdict: str
+    created_at: dt.datetime
+
+
+class SimilarReport(ReportSummary):
+    similarity: float
+
+
+class SearchHit(ReportSummary):
+    package: Optional[str] = None
+    app_name: Optional[str] = None
+
+
+class AnalysisProgress(BaseModel):
+    """One line of a streamed analysis; only the `final` one reflects the stored report."""
+    stage: str
+    final: bool = False
+    sha256: str
+    score: float
+    verdict: str
+    reasons: List[Reason]
+    features: Dict[str, Any]
+    report: Optional[AnalysisResult] = None
+    error: Optional[str] = None
+
+
+class JobOut(BaseModel):
+    id: int
+    sha256: str
+    filename: str
+    size_bytes: int
+    status: str
+    error: Optional[str] = None
+    report_id: Optional[int] = None
+    created_at: dt.datetime
+    updated_at: dt.datetime
+    report: Optional[AnalysisResult] = None
+
+
+class BatchItem(BaseModel):
+    filename: str
+    sha256: Optional[str] = None
+    status: str
+    error: Optional[str] = None
+    report: Optional[AnalysisResult] = None
+
+
 class BankIn(BaseModel):
     name: str
     package: str
     official: bool = True
+    signers: List[str] = []  # SHA-256 fingerprints of the official signing certificates
 
 
 class BankOut(BankIn):
@@ -183,6 +532,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -198,12 +548,327 @@ def get_db() -> Generator[Session, None, None]:
     finally:
         db.close()
 
+def report_to_result(r: Report) -> AnalysisResult:
+    """Builds the API response model from a stored report row."""
+    return AnalysisResult(
+        sha256=r.sha256,
+        filename=r.filename,
+        size_bytes=r.size_bytes,
+        score=r.score,
+        verdict=r.verdict,
+        reasons=[Reason(**x) for x in r.reasons],
+        features=r.features,
+        created_at=r.created_at,
+    )
+
+def load_results(digests: List[str]) -> Dict[str, AnalysisResult]:
+    """Stored results keyed by sha256. Decodes the features blobs, so async callers
+    run it in the threadpool."""
+    with SessionLocal() as db:
+        rows = db.query(Report).options(undefer(Report.features)).filter(Report.sha256.in_(digests)).all()
+        return {r.sha256: report_to_result(r) for r in rows}
+
+def load_result(report_id: int) -> AnalysisResult:
+    """The stored result of one report; blocking like load_results."""
+    with SessionLocal() as db:
+        return report_to_result(cast(Report, db.query(Report).filter(Report.id == report_id).first()))
+
+def job_to_out(job: AnalysisJob, report: Optional[Report] = None) -> JobOut:
+    """Builds the API response model for a job, embedding its report once finished."""
+    return JobOut(
+        id=job.id,
+        sha256=job.sha256,
+        filename=job.filename,
+        size_bytes=job.size_bytes,
+        status=job.status,
+        error=job.error,
+        report_id=job.report_id,
+        created_at=job.created_at,
+        updated_at=job.updated_at,
+        report=report_to_result(report) if report is not None else None,
+    )
+
 def sha256_bytes(b: bytes) -> str:
     """Calculates the SHA256 hash of a byte string."""
     h = hashlib.sha256()
     h.update(b)
     return h.hexdigest()
 
+def sha256_file(path: str) -> str:
+    """Calculates the SHA256 hash of a file without reading it into memory at once."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+async def spool_upload(file: UploadFile) -> Tuple[str, str, int]:
+    """Streams an upload to a temp file in UPLOAD_DIR, hashing chunks as they arrive.
+
+    Returns (temp_path, sha256, size). The size limit is enforced as soon as it is
+    exceeded, and the temp file is removed on any failure.
+    """
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="File too large")
+    h = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(status_code=413, detail="File too large")
+                h.update(chunk)
+                await run_in_threadpool(out.write, chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, h.hexdigest(), size
+
+def spool_fileobj(src: Any) -> Tuple[str, str, int]:
+    """Synchronous counterpart of spool_upload for members read out of a ZIP bundle."""
+    h = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(status_code=413, detail="File too large")
+                h.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, h.hexdigest(), size
+
+
+# -----------------------------
+# BACKEND: Sample store
+# Uploaded APKs are kept content-addressed under SAMPLE_DIR/ab/cd/<sha256>, optionally
+# zstd-compressed (<sha256>.zst). Two 256-way shard levels keep every directory small.
+# -----------------------------
+DIGEST_REGEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+class SampleStore:
+    """Content-addressed blob store for uploaded samples.
+
+    Blobs are written to a temp file inside their shard and renamed into place, so a
+    sample is either complete or absent. Compressed blobs are inflated transparently by
+    open() and checkout(). Samples stored flat as UPLOAD_DIR/<sha256>.apk by earlier
+    versions are still found.
+    """
+
+    def __init__(self, root: str, compression: str = "none"):
+        self.root = root
+        self.compress = compression == "zstd" and ZSTD_AVAILABLE
+
+    def shard(self, digest: str) -> str:
+        if not DIGEST_REGEX.match(digest):
+            raise ValueError(f"Not a sha256 digest: {digest}")
+        return os.path.join(self.root, digest[:2], digest[2:4])
+
+    def candidates(self, digest: str) -> List[str]:
+        base = os.path.join(self.shard(digest), digest)
+        return [base, base + ".zst", os.path.join(UPLOAD_DIR, f"{digest}.apk")]
+
+    def locate(self, digest: str) -> Optional[str]:
+        for path in self.candidates(digest):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def put_file(self, src_path: str, digest: str) -> str:
+        """Moves a spooled upload into the store, compressing it if enabled. `src_path` is consumed."""
+        existing = self.locate(digest)
+        if existing is not None:
+            os.remove(src_path)
+            os.utime(existing)  # a fresh upload, so gc_samples' orphan grace period restarts
+            return existing
+        shard = self.shard(digest)
+        os.makedirs(shard, exist_ok=True)
+        if not self.compress:
+            dest = os.path.join(shard, digest)
+            os.replace(src_path, dest)
+            return dest
+        dest = os.path.join(shard, digest + ".zst")
+        fd, tmp = tempfile.mkstemp(dir=shard, suffix=".part")
+        try:
+            with open(src_path, "rb") as src, os.fdopen(fd, "wb") as out:
+                zstd.ZstdCompressor(level=SAMPLE_ZSTD_LEVEL).copy_stream(src, out)
+            os.replace(tmp, dest)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        os.remove(src_path)
+        return dest
+
+    async def put(self, src_path: str, digest: str) -> str:
+        """put_file off the event loop."""
+        return await run_in_threadpool(self.put_file, src_path, digest)
+
+    def open(self, digest: str) -> Any:
+        """Readable binary stream of the original APK bytes; FileNotFoundError if not stored."""
+        path = self.locate(digest)
+        if path is None:
+            raise FileNotFoundError(f"Sample {digest} is not stored")
+        f = open(path, "rb")
+        if path.endswith(".zst"):
+            return zstd.ZstdDecompressor().stream_reader(f, closefd=True)
+        return f
+
+    def iter_chunks(self, digest: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> Generator[bytes, None, None]:
+        with self.open(digest) as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+
+    def checkout(self, digest: str) -> Tuple[str, bool]:
+        """(path, is_temp): a plain file with the APK bytes, as mmap needs.
+
+        Uncompressed blobs are used in place; compressed ones are inflated to a temp file
+        that checkin() removes.
+        """
+        path = self.locate(digest)
+        if path is None:
+            raise FileNotFoundError(f"Sample {digest} is not stored")
+        if not path.endswith(".zst"):
+            return path, False
+        # A .part suffix lets gc_samples collect copies leaked by a crashed process.
+        fd, tmp = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out, self.open(digest) as src:
+                shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return tmp, True
+
+    @staticmethod
+    def checkin(path: str, is_temp: bool) -> None:
+        if is_temp and os.path.exists(path):
+            os.remove(path)
+
+    @contextlib.contextmanager
+    def local_path(self, digest: str) -> Generator[str, None, None]:
+        path, is_temp = self.checkout(digest)
+        try:
+            yield path
+        finally:
+            self.checkin(path, is_temp)
+
+    def scan(self) -> Generator[Any, None, None]:
+        """os.DirEntry of every file in the shards: blobs and leftover .part temps."""
+        for top in os.scandir(self.root):
+            if not top.is_dir():
+                continue
+            for sub in os.scandir(top.path):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    if entry.is_file():
+                        yield entry
+
+    def delete(self, digest: str) -> bool:
+        removed = False
+        for path in self.candidates(digest):
+            try:
+                os.remove(path)
+                removed = True
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+sample_store = SampleStore(SAMPLE_DIR, SAMPLE_COMPRESSION)
+
+
+def gc_samples(retention_days: int = SAMPLE_RETENTION_DAYS, chunk_size: int = 2000) -> Dict[str, int]:
+    """Deletes stored samples whose report is older than `retention_days`.
+
+    Reports are kept; samples of queued or running jobs are skipped. Blobs older than
+    SPOOL_MAX_AGE that no report references (uploads rejected before a report was
+    written) and abandoned upload spools of that age are removed as well, and
+    entry_cache is trimmed to ENTRY_CACHE_MAX_ROWS.
+    """
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=retention_days)
+    scanned = removed = 0
+    with SessionLocal() as db:
+        busy = {
+            row[0] for row in db.query(AnalysisJob.sha256).filter(AnalysisJob.status.in_(("queued", "running")))
+        }
+        last_sha = ""
+        while True:
+            # A sample expires with the newest report that references it.
+            rows = (
+                db.query(Report.sha256)
+                .filter(Report.sha256 > last_sha)
+                .group_by(Report.sha256)
+                .having(func.max(Report.created_at) < cutoff)
+                .order_by(asc(Report.sha256))
+                .limit(chunk_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_sha = rows[-1].sha256
+            for r in rows:
+                scanned += 1
+                if r.sha256 not in busy and DIGEST_REGEX.match(r.sha256) and sample_store.delete(r.sha256):
+                    removed += 1
+
+        def sweep(candidates: Dict[str, str]) -> int:
+            referenced = {
+                row[0] for row in db.query(Report.sha256).filter(Report.sha256.in_(list(candidates))).distinct()
+            }
+            count = 0
+            for digest, path in candidates.items():
+                if digest not in referenced:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                        count += 1
+            return count
+
+        # Blobs are stored before analysis, so a rejected upload leaves one without a
+        # report. The grace period covers analyses still in flight.
+        orphans = spools = 0
+        now = time.time()
+        candidates: Dict[str, str] = {}
+        for entry in sample_store.scan():
+            if now - entry.stat().st_mtime <= SPOOL_MAX_AGE:
+                continue
+            if entry.name.endswith(".part"):
+                os.remove(entry.path)
+                spools += 1
+                continue
+            digest = entry.name.split(".", 1)[0]
+            if DIGEST_REGEX.match(digest) and digest not in busy:
+                candidates[digest] = entry.path
+                if len(candidates) >= chunk_size:
+                    orphans += sweep(candidates)
+                    candidates = {}
+        if candidates:
+            orphans += sweep(candidates)
+
+    for entry in os.scandir(UPLOAD_DIR):
+        if entry.name.endswith(".part") and now - entry.stat().st_mtime > SPOOL_MAX_AGE:
+            os.remove(entry.path)
+            spools += 1
+    cache_evicted = entry_cache.evict()
+    return {
+        "scanned": scanned, "removed": removed, "orphans_removed": orphans, "spools_removed": spools,
+        "cache_evicted": cache_evicted,
+    }
+
+
 DANGEROUS_PERMS = {
     "android.permission.READ_SMS",
     "android.permission.RECEIVE_SMS",
@@ -226,222 +891,3226 @@ SUSPICIOUS_TLDS = {
     ".top", ".xyz", ".info", ".click", ".shop", ".live", ".ru", ".cn", ".su", ".biz",
 }
 
+# Offline domain intelligence (see DomainReputation). Missing files mean empty lists and
+# the built-in suffixes below.
+PUBLIC_SUFFIX_FILE = os.environ.get("PUBLIC_SUFFIX_FILE", os.path.join(DATA_DIR, "public_suffix_list.dat"))
+DOMAIN_BLOCKLIST_FILE = os.environ.get("DOMAIN_BLOCKLIST", os.path.join(DATA_DIR, "domain_blocklist.txt"))
+DOMAIN_ALLOWLIST_FILE = os.environ.get("DOMAIN_ALLOWLIST", os.path.join(DATA_DIR, "domain_allowlist.txt"))
+# Multi-label public suffixes used without a PSL file; any other last label is the TLD.
+BUILTIN_PUBLIC_SUFFIXES = (
+    "co.in", "net.in", "org.in", "gov.in", "ac.in", "firm.in", "gen.in", "ind.in",
+    "co.uk", "org.uk", "ac.uk", "gov.uk", "com.au", "net.au", "org.au", "com.br",
+    "com.cn", "net.cn", "org.cn", "com.ru", "co.jp", "ne.jp", "com.sg", "com.hk",
+    "co.za", "com.pk", "com.bd", "com.np", "com.lk", "co.id", "com.tr", "com.mx",
+    "appspot.com", "blogspot.com", "github.io", "herokuapp.com", "firebaseapp.com",
+    "web.app", "netlify.app", "vercel.app", "pages.dev", "workers.dev", "ngrok.io",
+    "ngrok-free.app", "000webhostapp.com", "azurewebsites.net", "cloudfront.net",
+)
+DOMAIN_CACHE_SIZE = 65536  # hosts whose verdict is memoized per process
+BLOCKLIST_POINTS = 15  # per blocklisted registrable domain
+BLOCKLIST_MAX_POINTS = 45
+
 URL_REGEX = re.compile(r"https?://[\w.-/:?=&%#]+", re.IGNORECASE)
+URL_BYTES_REGEX = re.compile(URL_REGEX.pattern.encode(), re.IGNORECASE)
 
-def extract_with_androguard(apk_bytes: bytes) -> Dict[str, Any]:
-    """Extracts features from an APK using androguard."""
-    fp = io.BytesIO(apk_bytes)
-    a = APK(fp)
-    out: Dict[str, Any] = {
-        "app_name": a.get_app_name(),
-        "package": a.get_package(),
-        "permissions": sorted(list(set(a.get_permissions() or []))),
-        "activities": a.get_activities() or [],
-        "receivers": a.get_receivers() or [],
-        "services": a.get_services() or [],
-        "providers": a.get_providers() or [],
-        "files": [],
-        "urls": [],
-        "certificates": [str(x) for x in (a.get_signature_names() or [])],
-    }
-    with zipfile.ZipFile(io.BytesIO(apk_bytes)) as z:
-        file_names = z.namelist()
-        out["files"] = file_names
-        urls: List[str] = []
-        for name in file_names:
-            if name.endswith((".dex", ".arsc", ".xml", ".txt", ".json", ".js")):
-                try:
-                    data = z.read(name)
-                    urls.extend([u for u in URL_REGEX.findall(data.decode("utf-8", errors="ignore"))])
-                except Exception:
-                    pass
-        out["urls"] = sorted(list(set(urls)))
-    return out
+SCANNABLE_EXTENSIONS = (".dex", ".arsc", ".xml", ".txt", ".json", ".js")
+MANIFEST_NAME = "AndroidManifest.xml"
+RESOURCES_NAME = "resources.arsc"
 
+SCAN_CHUNK_SIZE = 256 * 1024
+SCAN_MAX_BYTES_PER_ENTRY = 32 * 1024 * 1024
+URL_MAX_LENGTH = 4096
+URL_MIN_PREFIX = len("https://")  # longest unmatched tail that could still start a URL
 
-def extract_with_apkutils(apk_bytes: bytes) -> Dict[str, Any]:
-    """Extracts features from an APK using apkutils2."""
-    fp = io.BytesIO(apk_bytes)
-    apk = APKU(fp)
-    manifest = apk.get_manifest() or {}
-    permissions = sorted(list({p["name"] for p in manifest.get("uses-permission", []) if "name" in p}))
-    app_label = apk.get_app_name()
-    pkg = apk.get_package_name()
-    out: Dict[str, Any] = {
-        "app_name": app_label,
-        "package": pkg,
-        "permissions": permissions,
-        "activities": [],
-        "receivers": [],
-        "services": [],
-        "providers": [],
-        "files": [],
-        "urls": [],
-        "certificates": [],
-    }
-    with zipfile.ZipFile(io.BytesIO(apk_bytes)) as z:
-        file_names = z.namelist()
-        out["files"] = file_names
-        urls: List[str] = []
-        for name in file_names:
-            if name.endswith((".dex", ".arsc", ".xml", ".txt", ".json", ".js")):
-                try:
-                    data = z.read(name)
-                    urls.extend([u for u in URL_REGEX.findall(data.decode("utf-8", errors="ignore"))])
-                except Exception:
-                    pass
-        out["urls"] = sorted(list(set(urls)))
-    return out
 
+class ResourceLimitExceeded(Exception):
+    """An extraction budget ran out while an entry was being read."""
 
-def extract_features(apk_bytes: bytes) -> Dict[str, Any]:
-    """Attempts to extract features using available libraries, with a fallback for basic info."""
-    if ANDROGUARD_AVAILABLE:
-        try:
-            return extract_with_androguard(apk_bytes)
-        except Exception:
-            pass
-    if APKUTILS_AVAILABLE:
-        try:
-            return extract_with_apkutils(apk_bytes)
-        except Exception:
-            pass
-    features: Dict[str, Any] = {
-        "app_name": None,
-        "package": None,
-        "permissions": [],
-        "activities": [],
-        "receivers": [],
-        "services": [],
-        "providers": [],
-        "files": [],
-        "urls": [],
-        "certificates": [],
-    }
-    try:
-        with zipfile.ZipFile(io.BytesIO(apk_bytes)) as z:
-            file_names = z.namelist()
-            features["files"] = file_names
-            urls: List[str] = []
-            for name in file_names:
-                if name.endswith((".dex", ".arsc", ".xml", ".txt", ".json", ".js")):
-                    try:
-                        data = z.read(name)
-                        urls.extend([u for u in URL_REGEX.findall(data.decode("utf-8", errors="ignore"))])
-                    except Exception:
-                        pass
-            features["urls"] = sorted(list(set(urls)))
-    except Exception:
-        pass
-    return features
 
+def scan_urls(
+    stream: Any,
+    chunk_size: int = SCAN_CHUNK_SIZE,
+    max_bytes: int = SCAN_MAX_BYTES_PER_ENTRY,
+    deadline: Optional[float] = None
+) -> Generator[str, None, None]:
+    """Yields URL matches from a binary stream, reading at most `max_bytes` in fixed chunks.
 
-def tld_score(urls: List[str]) -> int:
-    """Calculates a score based on suspicious top-level domains in URLs."""
-    score = 0
-    for u in urls:
-        for tld in SUSPICIOUS_TLDS:
-            if u.lower().endswith(tld) or ("." + tld.strip(".")) in u.lower().split("/")[2]:
-                score += 2
+    Runs URL_BYTES_REGEX directly on the bytes, so entries are never decoded or held
+    whole in memory. A match touching the end of a chunk is carried into the next one,
+    as is the short tail that could be the start of a URL. Raises ResourceLimitExceeded
+    once time.monotonic() passes `deadline`.
+    """
+    carry = b""
+    scanned = 0
+    while scanned < max_bytes:
+        if deadline is not None and time.monotonic() > deadline:
+            raise ResourceLimitExceeded("deadline")
+        chunk = stream.read(min(chunk_size, max_bytes - scanned))
+        if not chunk:
+            break
+        scanned += len(chunk)
+        buf = carry + chunk
+        keep_from = max(0, len(buf) - URL_MIN_PREFIX)
+        for m in URL_BYTES_REGEX.finditer(buf):
+            if m.end() == len(buf) and m.end() - m.start() < URL_MAX_LENGTH:
+                # May continue in the next chunk.
+                keep_from = m.start()
                 break
-    return score
+            yield m.group().decode("ascii")
+            keep_from = max(keep_from, m.end())
+        carry = buf[keep_from:]
+    for m in URL_BYTES_REGEX.finditer(carry):
+        yield m.group().decode("ascii")
 
 
-def name_similarity_score(app_name: Optional[str], known: List[str]) -> float:
-    """Calculates app name similarity to a list of known names."""
-    if not app_name or not known:
-        return 0.0
-    if RAPIDFUZZ_AVAILABLE:
-        best = max(fuzz.ratio(app_name, k) for k in known)
-        return float(best)
-    app_lower = app_name.lower()
-    best = 0
-    for k in known:
-        k_lower = k.lower()
-        common = len(set(app_lower.split()) & set(k_lower.split()))
-        best = max(best, common / max(len(k_lower.split()), 1) * 100)
-    return float(best)
+# -----------------------------
+# BACKEND: Binary manifest (AXML) and resources.arsc reader
+# A dependency-free reader for the compiled AndroidManifest.xml and just enough of
+# resources.arsc to resolve an @string app label. It is the default manifest source;
+# androguard is only used in deep mode or when this reader cannot parse the manifest.
+# -----------------------------
+RES_STRING_POOL_TYPE = 0x0001
+RES_TABLE_TYPE = 0x0002
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+RES_TABLE_PACKAGE_TYPE = 0x0200
+RES_TABLE_TYPE_TYPE = 0x0201
+RES_VALUE_REFERENCE = 0x01
+RES_VALUE_STRING = 0x03
+NO_ENTRY = 0xFFFFFFFF
+# Framework attribute ids, used when an obfuscator has blanked the attribute name strings.
+ANDROID_ATTR_NAMES = {0x01010001: "label", 0x01010003: "name"}
+COMPONENT_TAGS = {
+    "activity": "activities",
+    "activity-alias": "activities",
+    "service": "services",
+    "receiver": "receivers",
+    "provider": "providers",
+}
+PERMISSION_TAGS = {"uses-permission", "uses-permission-sdk-23", "uses-permission-sdk-m"}
+SIGNATURE_FILE_REGEX = re.compile(r"^META-INF/[^/]+\.(RSA|DSA|EC)$", re.IGNORECASE)
 
 
-def compute_heuristic_score(
-    features: Dict[str, Any],
-    bank_names: List[str],
-    bank_packages: List[str]
-) -> Tuple[float, List[Reason]]:
-    """Applies a set of heuristic rules to determine a risk score."""
-    score = 0.0
-    reasons: List[Reason] = []
-    perms = set(features.get("permissions") or [])
-    bad_perms = perms & DANGEROUS_PERMS
-    if bad_perms:
-        add = min(40, 5 * len(bad_perms))
-        score += add
-        reasons.append(Reason(code="dangerous_permissions", detail=f"Requests {len(bad_perms)} dangerous permissions: {', '.join(bad_perms)} (+{add})"))
-    urls = features.get("urls") or []
-    if urls:
-        add = min(20, 2 * len(urls))
-        score += add
-        reasons.append(Reason(code="embedded_urls", detail=f"Contains {len(urls)} embedded URL(s) in resources (+{add})"))
-        s_tld = tld_score(urls)
-        if s_tld:
-            score += s_tld
-            reasons.append(Reason(code="suspicious_tlds", detail=f"URLs include suspicious TLDs (+{s_tld})"))
-    app_name = features.get("app_name")
-    pkg = features.get("package") or ""
-    if pkg and any(pkg.startswith(k.split(".")[0]) for k in bank_packages) and app_name:
-        sim = name_similarity_score(app_name, bank_names)
-        if sim < 60:
-            score += 15
-            reasons.append(Reason(code="pkg_name_mismatch", detail=f"Bank-like package prefix but name similarity low ({sim:.1f}) (+15)"))
-    if "android.permission.BIND_ACCESSIBILITY_SERVICE" in perms:
-        score += 15
-        reasons.append(Reason(code="accessibility", detail="Requests Accessibility Service (used in overlay/credential theft) (+15)"))
-    if "android.permission.SYSTEM_ALERT_WINDOW" in perms:
-        score += 10
-        reasons.append(Reason(code="overlay", detail="Can draw over other apps (overlay attacks) (+10)"))
-    sms_perms = {"android.permission.READ_SMS", "android.permission.RECEIVE_SMS", "android.permission.SEND_SMS"}
-    if perms & sms_perms:
-        score += 10
-        reasons.append(Reason(code="otp_capture", detail="Requests SMS permissions (OTP capture risk) (+10)"))
-    score = max(0.0, min(100.0, score))
-    if score >= 70:
-        verdict = "MALICIOUS"
-    elif score >= 40:
-        verdict = "SUSPICIOUS"
-    else:
-        verdict = "SAFE"
-    sim = name_similarity_score(app_name, bank_names) if app_name else 0.0
-    reasons.insert(0, Reason(code="name_similarity", detail=f"App name similarity to official bank apps: {sim:.1f}/100"))
-    return score, reasons
+class ResourceRef(int):
+    """An attribute value that points at a resource (e.g. @string/app_name)."""
 
 
-def model_predict_probability(features: Dict[str, Any]) -> Optional[float]:
-    """Uses a machine learning model to predict a malicious probability."""
-    if not JOBLIB_AVAILABLE:
-        return None
-    model_path = os.path.join(MODEL_DIR, "model.joblib")
-    if not os.path.exists(model_path):
-        return None
+class StringPool:
+    """ResStringPool chunk at `buf[off:]`; strings are decoded on demand."""
+
+    def __init__(self, buf: Any, off: int):
+        _, header_size, size, count, _, flags, strings_start, _ = struct.unpack_from("<HHIIIIII", buf, off)
+        if header_size + 4 * count > size:
+            raise ValueError("String pool out of bounds")
+        self.buf = buf
+        self.utf8 = bool(flags & 0x100)
+        self.offsets = struct.unpack_from(f"<{count}I", buf, off + header_size)
+        self.base = off + strings_start
+        self.cache: Dict[int, str] = {}
+
+    def get(self, idx: int) -> Optional[str]:
+        if idx >= len(self.offsets):
+            return None
+        value = self.cache.get(idx)
+        if value is None:
+            p = self.base + self.offsets[idx]
+            if self.utf8:
+                _, p = self.length8(p)
+                n, p = self.length8(p)
+                value = bytes(self.buf[p:p + n]).decode("utf-8", errors="replace")
+            else:
+                (n,) = struct.unpack_from("<H", self.buf, p)
+                p += 2
+                if n & 0x8000:
+                    (low,) = struct.unpack_from("<H", self.buf, p)
+                    n = ((n & 0x7FFF) << 16) | low
+                    p += 2
+                value = bytes(self.buf[p:p + 2 * n]).decode("utf-16-le", errors="replace")
+            self.cache[idx] = value
+        return value
+
+    def length8(self, p: int) -> Tuple[int, int]:
+        b = self.buf[p]
+        if b & 0x80:
+            return ((b & 0x7F) << 8) | self.buf[p + 1], p + 2
+        return b, p + 1
+
+
+def parse_axml(buf: Any, base: int = 0, size: Optional[int] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """Returns (tag, attributes) for every start element of a binary XML document.
+
+    Attribute keys are local names; string values are str, references are ResourceRef,
+    other typed values are their raw int data.
+    """
+    size = len(buf) - base if size is None else size
+    type_, header_size, doc_size = struct.unpack_from("<HHI", buf, base)
+    if type_ != RES_XML_TYPE:
+        raise ValueError("Not a binary XML document")
+    end = base + min(doc_size, size)
+    pool: Optional[StringPool] = None
+    res_ids: Tuple[int, ...] = ()
+    elements: List[Tuple[str, Dict[str, Any]]] = []
+    off = base + header_size
+    while off + 8 <= end:
+        ctype, chunk_header, chunk_size = struct.unpack_from("<HHI", buf, off)
+        if chunk_size < 8:
+            raise ValueError("Malformed XML chunk")
+        if ctype == RES_STRING_POOL_TYPE:
+            pool = StringPool(buf, off)
+        elif ctype == RES_XML_RESOURCE_MAP_TYPE:
+            res_ids = struct.unpack_from(f"<{(chunk_size - chunk_header) // 4}I", buf, off + chunk_header)
+        elif ctype == RES_XML_START_ELEMENT_TYPE and pool is not None:
+            ext = off + chunk_header
+            _, name_idx, attr_start, attr_size, attr_count = struct.unpack_from("<IIHHH", buf, ext)
+            attrs: Dict[str, Any] = {}
+            for i in range(attr_count):
+                _, attr_name, raw, _, _, data_type, data = struct.unpack_from("<IIIHBBI", buf, ext + attr_start + i * attr_size)
+                key = ANDROID_ATTR_NAMES.get(res_ids[attr_name]) if attr_name < len(res_ids) else None
+                key = key or pool.get(attr_name) or ""
+                if raw != NO_ENTRY:
+                    attrs[key] = pool.get(raw)
+                elif data_type == RES_VALUE_STRING:
+                    attrs[key] = pool.get(data)
+                elif data_type == RES_VALUE_REFERENCE:
+                    attrs[key] = ResourceRef(data)
+                else:
+                    attrs[key] = data
+            elements.append((pool.get(name_idx) or "", attrs))
+        off += chunk_size
+    return elements
+
+
+def arsc_entry_value(buf: Any, chunk: int, chunk_header: int, entry_idx: int) -> Optional[Tuple[int, int]]:
+    """(data_type, data) of entry `entry_idx` in a ResTable_type chunk, or None if absent/complex."""
+    _, flags, _, entry_count, entries_start = struct.unpack_from("<BBHII", buf, chunk + 8)
+    index = chunk + chunk_header
+    entry_off: Optional[int] = None
+    if flags & 0x01:  # sparse: (idx, offset / 4) pairs sorted by idx
+        for i in range(entry_count):
+            idx, off4 = struct.unpack_from("<HH", buf, index + 4 * i)
+            if idx == entry_idx:
+                entry_off = off4 * 4
+                break
+    elif flags & 0x02:  # 16-bit offsets / 4
+        if entry_idx < entry_count:
+            (off4,) = struct.unpack_from("<H", buf, index + 2 * entry_idx)
+            entry_off = None if off4 == 0xFFFF else off4 * 4
+    elif entry_idx < entry_count:
+        (off32,) = struct.unpack_from("<I", buf, index + 4 * entry_idx)
+        entry_off = None if off32 == NO_ENTRY else off32
+    if entry_off is None:
+        return None
+    entry = chunk + entries_start + entry_off
+    entry_size, entry_flags, key = struct.unpack_from("<HHI", buf, entry)
+    if entry_flags & 0x0001:  # complex (bag) entry
+        return None
+    if entry_flags & 0x0008:  # compact entry: type in the flags' high byte, data in `key`
+        return entry_flags >> 8, key
+    _, _, data_type, data = struct.unpack_from("<HBBI", buf, entry + entry_size)
+    return data_type, data
+
+
+def resolve_string_resource(buf: Any, base: int, size: int, res_id: int) -> Optional[str]:
+    """Looks up a string resource in resources.arsc, preferring the default configuration."""
+    type_, header_size, table_size = struct.unpack_from("<HHI", buf, base)
+    if type_ != RES_TABLE_TYPE:
+        return None
+    package_id, type_id, entry_idx = res_id >> 24, (res_id >> 16) & 0xFF, res_id & 0xFFFF
+    end = base + min(table_size, size)
+    values: Optional[StringPool] = None
+    off = base + header_size
+    while off + 8 <= end:
+        ctype, chunk_header, chunk_size = struct.unpack_from("<HHI", buf, off)
+        if chunk_size < 8:
+            return None
+        if ctype == RES_STRING_POOL_TYPE and values is None:
+            values = StringPool(buf, off)
+        elif ctype == RES_TABLE_PACKAGE_TYPE and values is not None:
+            (pid,) = struct.unpack_from("<I", buf, off + 8)
+            if pid == package_id:
+                fallback: Optional[str] = None
+                sub = off + chunk_header
+                while sub + 8 <= off + chunk_size:
+                    stype, sub_header, sub_size = struct.unpack_from("<HHI", buf, sub)
+                    if sub_size < 8:
+                        break
+                    if stype == RES_TABLE_TYPE_TYPE and buf[sub + 8] == type_id:
+                        value = arsc_entry_value(buf, sub, sub_header, entry_idx)
+                        if value and value[0] == RES_VALUE_STRING:
+                            text_ = values.get(value[1])
+                            (config_size,) = struct.unpack_from("<I", buf, sub + 20)
+                            if not any(bytes(buf[sub + 24:sub + 20 + config_size])):
+                                return text_
+                            fallback = fallback or text_
+                    sub += sub_size
+                return fallback
+        off += chunk_size
+    return None
+
+
+def qualify_component(name: Optional[str], package: Optional[str]) -> Optional[str]:
+    """Expands `.Main` / `Main` to `com.pkg.Main`, as Android (and androguard) do."""
+    if not name or not package:
+        return name
+    if name.startswith("."):
+        return package + name
+    if "." not in name:
+        return f"{package}.{name}"
+    return name
+
+
+def parse_manifest(manifest: bytes, resources: Optional[Tuple[Any, int, int]] = None) -> Dict[str, Any]:
+    """Extracts package, label, permissions and components from a binary AndroidManifest.xml."""
+    out: Dict[str, Any] = {"app_name": None, "package": None, "permissions": []}
+    for key in COMPONENT_TAGS.values():
+        out[key] = []
+    permissions = set()
+    label: Any = None
+    for tag, attrs in parse_axml(manifest):
+        if tag == "manifest":
+            out["package"] = attrs.get("package")
+        elif tag in PERMISSION_TAGS and isinstance(attrs.get("name"), str):
+            permissions.add(attrs["name"])
+        elif tag == "application":
+            label = attrs.get("label")
+        elif tag in COMPONENT_TAGS and isinstance(attrs.get("name"), str):
+            out[COMPONENT_TAGS[tag]].append(qualify_component(attrs["name"], out["package"]))
+    if isinstance(label, ResourceRef):
+        label = resolve_string_resource(*resources, label) if resources else None
+    out["app_name"] = label if isinstance(label, str) else None
+    out["permissions"] = sorted(permissions)
+    return out
+
+
+# -----------------------------
+# BACKEND: DEX reader
+# Reads the string_ids / type_ids / method_ids / class_defs tables straight from the DEX
+# header with struct.unpack_from, over either bytes or the APK's mmap (for STORED
+# entries, no copy of the entry is made at all). This yields the exact string pool,
+# the referenced framework APIs and the defined classes without androguard's analysis.
+# -----------------------------
+DEX_NAME_REGEX = re.compile(r"^classes\d*\.dex$")
+DEX_MAX_BYTES = 64 * 1024 * 1024
+SENSITIVE_API_CLASSES = {
+    "Landroid/telephony/SmsManager;",
+    "Landroid/telephony/TelephonyManager;",
+    "Landroid/accessibilityservice/AccessibilityService;",
+    "Landroid/view/accessibility/AccessibilityNodeInfo;",
+    "Landroid/webkit/WebView;",
+    "Landroid/app/admin/DevicePolicyManager;",
+    "Landroid/content/pm/PackageInstaller;",
+    "Landroid/view/WindowManager;",
+    "Ldalvik/system/DexClassLoader;",
+    "Ljava/lang/Runtime;",
+}
+
+
+def read_uleb128(buf: Any, off: int) -> Tuple[int, int]:
+    """Decodes an unsigned LEB128 value; returns (value, next_offset)."""
+    result = shift = 0
+    while True:
+        b = buf[off]
+        off += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, off
+        shift += 7
+        if shift > 28:
+            raise ValueError("Malformed uleb128")
+
+
+class DexFile:
+    """Table-level DEX reader over `buf[base:base + size]`; `buf` may be bytes or an mmap."""
+
+    def __init__(self, buf: Any, base: int = 0, size: Optional[int] = None):
+        self.buf = buf
+        self.base = base
+        self.size = len(buf) - base if size is None else size
+        if self.size < 0x70 or buf[base:base + 4] != b"dex\n":
+            raise ValueError("Not a DEX file")
+        (self.string_ids_size, self.string_ids_off,
+         self.type_ids_size, self.type_ids_off,
+         _, _, _, _,
+         self.method_ids_size, self.method_ids_off,
+         self.class_defs_size, self.class_defs_off) = struct.unpack_from("<12I", buf, base + 0x38)
+        for off, count, item in (
+            (self.string_ids_off, self.string_ids_size, 4),
+            (self.type_ids_off, self.type_ids_size, 4),
+            (self.method_ids_off, self.method_ids_size, 8),
+            (self.class_defs_off, self.class_defs_size, 32),
+        ):
+            if off + count * item > self.size:
+                raise ValueError("DEX table out of bounds")
+
+    def string_span(self, idx: int) -> Tuple[int, int]:
+        """Absolute [start, end) of string `idx`'s MUTF-8 bytes in `buf`."""
+        (data_off,) = struct.unpack_from("<I", self.buf, self.base + self.string_ids_off + 4 * idx)
+        _, start = read_uleb128(self.buf, self.base + data_off)
+        end = self.buf.find(b"\0", start, self.base + self.size)
+        if end < 0:
+            raise ValueError("Unterminated DEX string")
+        return start, end
+
+    def string(self, idx: int) -> str:
+        start, end = self.string_span(idx)
+        return bytes(self.buf[start:end]).decode("utf-8", errors="replace")
+
+    def type_span(self, idx: int) -> Tuple[int, int]:
+        (string_idx,) = struct.unpack_from("<I", self.buf, self.base + self.type_ids_off + 4 * idx)
+        return self.string_span(string_idx)
+
+    def type_descriptor(self, idx: int) -> str:
+        start, end = self.type_span(idx)
+        return bytes(self.buf[start:end]).decode("utf-8", errors="replace")
+
+    def string_urls(self) -> Generator[str, None, None]:
+        """URL_REGEX matches inside strings of the string pool.
+
+        The regex runs once over the string-data span; each hit is kept only if it lies
+        inside a single string item (no NUL between the item's start and the match).
+        """
+        if not self.string_ids_size:
+            return
+        starts = sorted(struct.unpack_from(f"<{self.string_ids_size}I", self.buf, self.base + self.string_ids_off))
+        lo = self.base + starts[0]
+        hi = self.buf.find(b"\0", self.base + starts[-1], self.base + self.size)
+        if hi < 0:
+            raise ValueError("Unterminated DEX string")
+        for m in URL_BYTES_REGEX.finditer(self.buf, lo, hi):
+            i = bisect.bisect_right(starts, m.start() - self.base) - 1
+            if self.buf.find(b"\0", self.base + starts[i], m.start()) < 0:
+                yield m.group().decode("ascii")
+
+    def class_names(self) -> Generator[str, None, None]:
+        for i in range(self.class_defs_size):
+            (class_idx,) = struct.unpack_from("<I", self.buf, self.base + self.class_defs_off + 32 * i)
+            yield self.type_descriptor(class_idx)
+
+    def api_calls(self, classes: set) -> Generator[str, None, None]:
+        """`Lpkg/Class;->method` for every method reference whose class is in `classes`."""
+        encoded = {c.encode() for c in classes}
+        wanted = {i for i in range(self.type_ids_size) if self.buf[slice(*self.type_span(i))] in encoded}
+        if not wanted:
+            return
+        for i in range(self.method_ids_size):
+            class_idx, _, name_idx = struct.unpack_from("<HHI", self.buf, self.base + self.method_ids_off + 8 * i)
+            if class_idx in wanted:
+                yield f"{self.type_descriptor(class_idx)}->{self.string(name_idx)}"
+
+
+def java_package(descriptor: str) -> str:
+    """`Lcom/example/Foo;` -> `com.example` (empty for the default package)."""
+    return descriptor[1:-1].rpartition("/")[0].replace("/", ".")
+
+
+def parse_dex(buf: Any, base: int = 0, size: Optional[int] = None) -> Dict[str, Any]:
+    """Extracts string-pool URLs, sensitive API references and class packages from one DEX."""
+    dex = DexFile(buf, base, size)
+    packages = {java_package(c) for c in dex.class_names()}
+    packages.discard("")
+    return {
+        "stats": {
+            "strings": dex.string_ids_size,
+            "types": dex.type_ids_size,
+            "methods": dex.method_ids_size,
+            "classes": dex.class_defs_size,
+        },
+        "urls": set(dex.string_urls()),
+        "api_calls": set(dex.api_calls(SENSITIVE_API_CLASSES)),
+        "packages": packages,
+    }
+
+
+# -----------------------------
+# BACKEND: Signing certificates
+# Signer fingerprints are the SHA-256 of the DER certificate (as printed by
+# `apksigner verify --print-certs`). They are read from the APK Signature Scheme v2/v3
+# block and from the v1 PKCS#7 files under META-INF. Only v2/v3 signatures using RSA
+# PKCS#1 v1.5 are verified here (signature plus content digest); a v1 certificate can be
+# copied into any APK, so it is never trusted on its own.
+# -----------------------------
+APK_SIG_BLOCK_MAGIC = b"APK Sig Block 42"
+APK_SIGNATURE_SCHEME_V2_ID = 0x7109871A
+APK_SIGNATURE_SCHEME_V3_ID = 0xF05368C0
+APK_DIGEST_CHUNK = 1024 * 1024
+EOCD_SEARCH_BYTES = 22 + 0xFFFF
+# Signature algorithm id -> (hash name, DER DigestInfo prefix) for RSASSA-PKCS1-v1_5.
+RSA_PKCS1_ALGORITHMS = {
+    0x0103: ("sha256", bytes.fromhex("3031300d060960864801650304020105000420")),
+    0x0104: ("sha512", bytes.fromhex("3051300d060960864801650304020305000440")),
+}
+RSA_ENCRYPTION_OID = bytes.fromhex("2a864886f70d010101")
+# X.520 attribute OIDs shown in certificate subjects.
+X509_NAME_ATTRIBUTES = {
+    bytes.fromhex("550403"): "CN",
+    bytes.fromhex("55040b"): "OU",
+    bytes.fromhex("55040a"): "O",
+    bytes.fromhex("550407"): "L",
+    bytes.fromhex("550408"): "ST",
+    bytes.fromhex("550406"): "C",
+}
+FINGERPRINT_REGEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+def normalize_fingerprint(value: str) -> str:
+    """Lower-case hex without separators; ValueError unless it is a SHA-256 fingerprint."""
+    fp = re.sub(r"[\s:]", "", value).lower()
+    if not FINGERPRINT_REGEX.match(fp):
+        raise ValueError(f"Not a SHA-256 certificate fingerprint: {value}")
+    return fp
+
+
+def certificate_fingerprint(der: bytes) -> str:
+    return hashlib.sha256(der).hexdigest()
+
+
+def der_element(buf: bytes, off: int) -> Tuple[int, int, int]:
+    """(tag, content_start, content_end) of the DER element at `off`."""
+    tag, length = buf[off], buf[off + 1]
+    off += 2
+    if length & 0x80:
+        n = length & 0x7F
+        if not 0 < n <= 4:
+            raise ValueError("Unsupported DER length")
+        length = int.from_bytes(buf[off:off + n], "big")
+        off += n
+    if off + length > len(buf):
+        raise ValueError("Truncated DER element")
+    return tag, off, off + length
+
+
+def der_children(buf: bytes, start: int, end: int) -> List[Tuple[int, int, int, int]]:
+    """(tag, element_start, content_start, element_end) of each element in [start, end)."""
+    out = []
+    off = start
+    while off < end:
+        tag, c_start, c_end = der_element(buf, off)
+        out.append((tag, off, c_start, c_end))
+        off = c_end
+    return out
+
+
+def pkcs7_certificates(data: bytes) -> List[bytes]:
+    """DER certificates embedded in a v1 signature file (PKCS#7 SignedData)."""
+    _, start, end = der_element(data, 0)
+    content_info = der_children(data, start, end)
+    if len(content_info) < 2 or content_info[1][0] != 0xA0:
+        raise ValueError("Not a PKCS#7 SignedData")
+    _, signed_start, signed_end = der_element(data, content_info[1][2])
+    for tag, _, c_start, c_end in der_children(data, signed_start, signed_end):
+        if tag == 0xA0:
+            return [data[s:e] for _, s, _, e in der_children(data, c_start, c_end)]
+    return []
+
+
+def certificate_public_key(cert: bytes) -> bytes:
+    """The DER SubjectPublicKeyInfo of an X.509 certificate."""
+    _, start, end = der_element(cert, 0)
+    tbs = der_children(cert, start, end)[0]
+    fields = der_children(cert, tbs[2], tbs[3])
+    spki = fields[6] if fields[0][0] == 0xA0 else fields[5]
+    return cert[spki[1]:spki[3]]
+
+
+def certificate_subject(cert: bytes) -> str:
+    """The subject of an X.509 certificate as "CN=..., O=...", in certificate order."""
+    _, start, end = der_element(cert, 0)
+    tbs = der_children(cert, start, end)[0]
+    fields = der_children(cert, tbs[2], tbs[3])
+    subject = fields[5] if fields[0][0] == 0xA0 else fields[4]
+    parts = []
+    for _, _, set_start, set_end in der_children(cert, subject[2], subject[3]):
+        for _, _, seq_start, seq_end in der_children(cert, set_start, set_end):
+            oid, value = der_children(cert, seq_start, seq_end)[:2]
+            name = X509_NAME_ATTRIBUTES.get(cert[oid[2]:oid[3]])
+            if name is None:
+                continue
+            raw = cert[value[2]:value[3]]
+            parts.append(f"{name}={raw.decode('utf-16-be' if value[0] == 0x1E else 'utf-8', 'replace')}")
+    return ", ".join(parts)
+
+
+def rsa_public_key(spki: bytes) -> Tuple[int, int]:
+    """(n, e) of a DER SubjectPublicKeyInfo; ValueError for non-RSA keys."""
+    _, start, end = der_element(spki, 0)
+    algorithm, key = der_children(spki, start, end)[:2]
+    _, oid_start, oid_end = der_element(spki, algorithm[2])
+    if spki[oid_start:oid_end] != RSA_ENCRYPTION_OID or key[0] != 0x03:
+        raise ValueError("Not an RSA key")
+    _, seq_start, seq_end = der_element(spki, key[2] + 1)  # skip the unused-bits byte
+    n, e = der_children(spki, seq_start, seq_end)[:2]
+    return int.from_bytes(spki[n[2]:n[3]], "big"), int.from_bytes(spki[e[2]:e[3]], "big")
+
+
+def rsa_pkcs1_verify(spki: bytes, algorithm: int, message: bytes, signature: bytes) -> bool:
+    hash_name, prefix = RSA_PKCS1_ALGORITHMS[algorithm]
+    n, e = rsa_public_key(spki)
+    k = (n.bit_length() + 7) // 8
+    s = int.from_bytes(signature, "big")
+    if len(signature) != k or s >= n:
+        return False
+    t = prefix + hashlib.new(hash_name, message).digest()
+    if k < len(t) + 11:
+        return False
+    return pow(s, e, n).to_bytes(k, "big") == b"\x00\x01" + b"\xff" * (k - len(t) - 3) + b"\x00" + t
+
+
+def length_prefixed(buf: Any, off: int, end: int) -> Tuple[int, int]:
+    """(start, end) of the uint32-length-prefixed item at `off`."""
+    if off + 4 > end:
+        raise ValueError("Truncated signing block")
+    (n,) = struct.unpack_from("<I", buf, off)
+    if off + 4 + n > end:
+        raise ValueError("Truncated signing block")
+    return off + 4, off + 4 + n
+
+
+def length_prefixed_items(buf: Any, start: int, end: int) -> List[Tuple[int, int]]:
+    out = []
+    while start < end:
+        out.append(length_prefixed(buf, start, end))
+        start = out[-1][1]
+    return out
+
+
+def apk_signing_block(data: Any) -> Optional[Tuple[Tuple[int, int, int], Dict[int, Tuple[int, int]]]]:
+    """((block_start, cd_offset, eocd_offset), {pair id: (start, end)}) or None if absent."""
+    eocd = data.rfind(b"PK\x05\x06", max(0, len(data) - EOCD_SEARCH_BYTES))
+    if eocd < 0 or eocd + 22 > len(data):
+        return None
+    (cd_offset,) = struct.unpack_from("<I", data, eocd + 16)
+    if cd_offset < 32 or cd_offset > eocd or data[cd_offset - 16:cd_offset] != APK_SIG_BLOCK_MAGIC:
+        return None
+    (size,) = struct.unpack_from("<Q", data, cd_offset - 24)
+    block_start = cd_offset - size - 8
+    if block_start < 0 or struct.unpack_from("<Q", data, block_start)[0] != size:
+        raise ValueError("Corrupt APK signing block")
+    pairs = {}
+    off, end = block_start + 8, cd_offset - 24
+    while off + 12 <= end:
+        length, pair_id = struct.unpack_from("<QI", data, off)
+        if length < 4 or off + 8 + length > end:
+            raise ValueError("Corrupt APK signing block")
+        pairs[pair_id] = (off + 12, off + 8 + length)
+        off += 8 + length
+    return (block_start, cd_offset, eocd), pairs
+
+
+def apk_scheme_signers(data: Any) -> Optional[Tuple[Tuple[int, int, int], List[Dict[str, Any]]]]:
+    """Signers of the v3 (preferred) or v2 signature scheme block, if the APK has one."""
+    found = apk_signing_block(data)
+    if found is None:
+        return None
+    offsets, pairs = found
+    v3 = APK_SIGNATURE_SCHEME_V3_ID in pairs
+    span = pairs.get(APK_SIGNATURE_SCHEME_V3_ID if v3 else APK_SIGNATURE_SCHEME_V2_ID)
+    if span is None:
+        return None
+    signers = []
+    seq_start, seq_end = length_prefixed(data, *span)
+    for start, end in length_prefixed_items(data, seq_start, seq_end):
+        sd_start, sd_end = length_prefixed(data, start, end)
+        off = sd_end + 8 if v3 else sd_end  # v3 adds minSdkVersion/maxSdkVersion
+        sig_start, sig_end = length_prefixed(data, off, end)
+        key_start, key_end = length_prefixed(data, sig_end, end)
+        dg_start, dg_end = length_prefixed(data, sd_start, sd_end)
+        cert_start, cert_end = length_prefixed(data, dg_end, sd_end)
+        digests, signatures = {}, []
+        for s, e in length_prefixed_items(data, dg_start, dg_end):
+            d_start, d_end = length_prefixed(data, s + 4, e)
+            digests[struct.unpack_from("<I", data, s)[0]] = bytes(data[d_start:d_end])
+        for s, e in length_prefixed_items(data, sig_start, sig_end):
+            g_start, g_end = length_prefixed(data, s + 4, e)
+            signatures.append((struct.unpack_from("<I", data, s)[0], bytes(data[g_start:g_end])))
+        signers.append({
+            "signed_data": bytes(data[sd_start:sd_end]),
+            "digests": digests,
+            "certificates": [bytes(data[s:e]) for s, e in length_prefixed_items(data, cert_start, cert_end)],
+            "signatures": signatures,
+            "public_key": bytes(data[key_start:key_end]),
+        })
+    return offsets, signers
+
+
+def apk_content_digest(data: Any, hash_name: str, block_start: int, cd_offset: int, eocd: int) -> bytes:
+    """The v2/v3 chunked digest over the entries, central directory and EOCD."""
+    eocd_bytes = bytearray(data[eocd:])
+    struct.pack_into("<I", eocd_bytes, 16, block_start)  # EOCD as if the signing block were absent
+    sections = [(data, 0, block_start), (data, cd_offset, eocd), (bytes(eocd_bytes), 0, len(eocd_bytes))]
+    chunk_digests = []
+    for buf, start, end in sections:
+        for off in range(start, end, APK_DIGEST_CHUNK):
+            chunk = buf[off:min(off + APK_DIGEST_CHUNK, end)]
+            h = hashlib.new(hash_name, b"\xa5" + struct.pack("<I", len(chunk)))
+            h.update(chunk)
+            chunk_digests.append(h.digest())
+    top = hashlib.new(hash_name, b"\x5a" + struct.pack("<I", len(chunk_digests)))
+    for d in chunk_digests:
+        top.update(d)
+    return top.digest()
+
+
+def verify_apk_signers(data: Any) -> List[str]:
+    """Fingerprints of v2/v3 signers whose RSA signature and content digest both verify."""
+    try:
+        found = apk_scheme_signers(data)
+    except (ValueError, IndexError, struct.error):
+        return []
+    if found is None:
+        return []
+    (block_start, cd_offset, eocd), signers = found
+    content_digests: Dict[str, bytes] = {}
+    verified = set()
+    for signer in signers:
+        if not signer["certificates"]:
+            continue
+        cert = signer["certificates"][0]
+        for algorithm, signature in signer["signatures"]:
+            if algorithm not in RSA_PKCS1_ALGORITHMS or algorithm not in signer["digests"]:
+                continue
+            try:
+                if certificate_public_key(cert) != signer["public_key"]:
+                    break
+                if not rsa_pkcs1_verify(signer["public_key"], algorithm, signer["signed_data"], signature):
+                    continue
+            except (ValueError, IndexError):
+                continue
+            hash_name = RSA_PKCS1_ALGORITHMS[algorithm][0]
+            if hash_name not in content_digests:
+                content_digests[hash_name] = apk_content_digest(data, hash_name, block_start, cd_offset, eocd)
+            if content_digests[hash_name] == signer["digests"][algorithm]:
+                verified.add(certificate_fingerprint(cert))
+                break
+    return sorted(verified)
+
+
+class MappedFile(io.RawIOBase):
+    """Read-only, seekable file object over an mmap, so zipfile reads it without a copy."""
+
+    def __init__(self, mm: mmap.mmap):
+        self.mm = mm
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, n: int = -1) -> bytes:
+        return self.mm.read(n)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        try:
+            self.mm.seek(offset, whence)
+        except ValueError as e:
+            # zipfile probes small/truncated files expecting OSError here.
+            raise OSError(str(e))
+        return self.mm.tell()
+
+    def tell(self) -> int:
+        return self.mm.tell()
+
+
+# -----------------------------
+# BACKEND: Entry cache
+# Repackaged clones share most of their .dex/.arsc/asset entries byte-for-byte. Scan
+# results are persisted per entry, keyed by a hash of the entry's raw compressed bytes
+# (which is far cheaper than inflating them), so a known entry is never inflated again.
+# Central-directory fields alone (CRC32, sizes) are attacker-chosen and could map a
+# different payload onto a cached clean result.
+# -----------------------------
+def entry_cache_key(data: Any, info: zipfile.ZipInfo, chunk_size: int = 1024 * 1024) -> Optional[str]:
+    """blake2b of the entry's compressed bytes plus method, size and name; None if its
+    local header cannot be located (the entry is then never cached)."""
+    try:
+        header = struct.unpack_from("<4s2B4HL2L2H", data, info.header_offset)
+    except struct.error:
+        return None
+    start = info.header_offset + 30 + header[10] + header[11]
+    end = start + info.compress_size
+    if header[0] != b"PK\x03\x04" or end > len(data):
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    for off in range(start, end, chunk_size):
+        h.update(data[off:min(off + chunk_size, end)])
+    return f"{h.hexdigest()}:{info.compress_type}:{info.file_size}:{info.filename}"
+
+
+class EntryFeatureCache:
+    """Persistent per-entry scan results stored in the entry_cache table.
+
+    Values are dicts with "urls" and, for parsed DEX entries, "stats", "api_calls" and
+    "packages". Entries that failed to read are never stored. The table is capped at
+    ENTRY_CACHE_MAX_ROWS, oldest rows first.
+    """
+
+    def __init__(self, max_rows: int = ENTRY_CACHE_MAX_ROWS):
+        self.max_rows = max_rows
+        self.stored = 0  # rows inserted by this process since the last eviction
+
+    def lookup(self, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        found: Dict[str, Dict[str, Any]] = {}
+        with SessionLocal() as db:
+            for i in range(0, len(keys), ENTRY_CACHE_BATCH):
+                rows = db.query(EntryCache.key, EntryCache.data).filter(EntryCache.key.in_(keys[i:i + ENTRY_CACHE_BATCH]))
+                for key, data in rows:
+                    found[key] = json.loads(data)
+        return found
+
+    def store(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        if not entries:
+            return
+        now = dt.datetime.utcnow()
+        rows = [{"key": k, "data": json.dumps(v), "created_at": now} for k, v in entries.items()]
+        # Concurrent workers may scan the same new entry; the first writer wins.
+        with engine.begin() as conn:
+            for i in range(0, len(rows), ENTRY_CACHE_BATCH):
+                conn.execute(sqlite_insert(EntryCache).on_conflict_do_nothing(), rows[i:i + ENTRY_CACHE_BATCH])
+        self.stored += len(rows)
+        if self.stored >= max(self.max_rows // 10, 1):
+            self.evict()
+
+    def evict(self) -> int:
+        """Deletes the oldest rows beyond max_rows; returns how many were removed."""
+        self.stored = 0
+        with engine.begin() as conn:
+            result = conn.execute(
+                text(
+                    "DELETE FROM entry_cache WHERE key IN "
+                    "(SELECT key FROM entry_cache ORDER BY created_at DESC LIMIT -1 OFFSET :keep)"
+                ),
+                {"keep": self.max_rows},
+            )
+            return result.rowcount
+
+
+entry_cache = EntryFeatureCache()
+
+
+class ByteBudget:
+    """Admits work while the bytes reserved stay within `limit`.
+
+    A reservation larger than the limit is clamped to it, so it runs alone rather than
+    never.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, n: int) -> Generator[None, None, None]:
+        n = min(n, self.limit)
+        with self.cond:
+            self.cond.wait_for(lambda: self.used + n <= self.limit)
+            self.used += n
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.used -= n
+                self.cond.notify_all()
+
+
+_entry_scan_pool: Optional[ThreadPoolExecutor] = None
+_entry_scan_pool_lock = threading.Lock()
+
+
+def entry_scan_pool() -> ThreadPoolExecutor:
+    """Process-wide thread pool for ApkArchive.scan_entries, created on first use."""
+    global _entry_scan_pool
+    with _entry_scan_pool_lock:
+        if _entry_scan_pool is None:
+            _entry_scan_pool = ThreadPoolExecutor(max_workers=ENTRY_SCAN_THREADS, thread_name_prefix="entry-scan")
+        return _entry_scan_pool
+
+
+# -----------------------------
+# BACKEND: Extraction budgets
+# Admission is decided from the central directory's declared sizes (zipfile never
+# inflates past them) before any entry is read, in directory order, so which entries
+# are skipped does not depend on thread timing. Only the deadline is time-based.
+# -----------------------------
+class ExtractionBudget:
+    """Per-APK limits on inflated bytes, entries, compression ratio and wall-clock time."""
+
+    def __init__(
+        self,
+        max_bytes: int = EXTRACT_MAX_BYTES,
+        max_entries: int = EXTRACT_MAX_ENTRIES,
+        max_ratio: float = EXTRACT_MAX_RATIO,
+        deadline: float = EXTRACT_DEADLINE
+    ):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_ratio = max_ratio
+        self.deadline = time.monotonic() + deadline
+        self.bytes = 0
+        self.entries = 0
+        self.exceeded: Dict[str, List[str]] = {}  # limit -> skipped entry names
+        self.admitted: set = set()
+        self.lock = threading.Lock()
+
+    def state(self) -> Dict[str, Any]:
+        """Picklable snapshot, so staged analyses in different workers share one budget."""
+        return {
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            "max_ratio": self.max_ratio,
+            "bytes": self.bytes,
+            "entries": self.entries,
+            "remaining": max(0.0, self.deadline - time.monotonic()),
+            "admitted": sorted(self.admitted),
+            "exceeded": {limit: list(names) for limit, names in self.exceeded.items()},
+        }
+
+    @classmethod
+    def resume(cls, state: Dict[str, Any]) -> "ExtractionBudget":
+        budget = cls(state["max_bytes"], state["max_entries"], state["max_ratio"], state["remaining"])
+        budget.bytes = state["bytes"]
+        budget.entries = state["entries"]
+        budget.admitted = set(state["admitted"])
+        budget.exceeded = {limit: list(names) for limit, names in state["exceeded"].items()}
+        return budget
+
+    def admit(self, info: zipfile.ZipInfo, max_size: Optional[int] = None) -> bool:
+        """Reserves an entry's declared size; False (and the limit recorded) if it does not fit.
+
+        An entry admitted before (by an earlier step on the same budget) is not charged again.
+        """
+        if info.filename in self.admitted:
+            return True
+        limit = None
+        if self.expired():
+            limit = "deadline"
+        elif max_size is not None and info.file_size > max_size:
+            limit = "entry_size"
+        elif (
+            info.file_size >= EXTRACT_RATIO_MIN_BYTES
+            and info.file_size > self.max_ratio * max(info.compress_size, 1)
+        ):
+            limit = "compression_ratio"
+        elif self.entries >= self.max_entries:
+            limit = "entries"
+        elif self.bytes + info.file_size > self.max_bytes:
+            limit = "bytes"
+        if limit is not None:
+            self.skip(info.filename, limit)
+            return False
+        self.entries += 1
+        if info.compress_type != zipfile.ZIP_STORED:
+            self.bytes += info.file_size
+        self.admitted.add(info.filename)
+        return True
+
+    def expired(self) -> bool:
+        return time.monotonic() > self.deadline
+
+    def skip(self, name: str, limit: str) -> None:
+        with self.lock:
+            self.exceeded.setdefault(limit, []).append(name)
+
+    @property
+    def skipped(self) -> set:
+        return {name for names in self.exceeded.values() for name in names}
+
+    def summary(self) -> List[str]:
+        """One line per exceeded limit, e.g. "compression_ratio: 2 entries skipped (a.bin, b.bin)"."""
+        out = []
+        for limit in sorted(self.exceeded):
+            names = self.exceeded[limit]
+            shown = ", ".join(names[:3]) + (", ..." if len(names) > 3 else "")
+            out.append(f"{limit}: {len(names)} entr{'y' if len(names) == 1 else 'ies'} skipped ({shown})")
+        return out
+
+
+class ApkArchive:
+    """Shared, single-pass view over an uploaded APK.
+
+    The ZIP is opened once and walked once: the central directory gives the file
+    listing and CRCs, the manifest bytes are kept, and every scannable entry is
+    streamed through scan_urls a single time. All extractors read from here.
+    `data` may be bytes or an mmap of the spooled upload (see `ApkArchive.open`).
+    With a `cache`, entries whose compressed bytes were seen in an earlier upload are
+    taken from it and not decompressed (nor CRC-checked) again. `cache_hits` counts them.
+    With `walk=False` only the cheap header pass runs (listing, manifest, resources,
+    signer fingerprints); call `walk()` later for the entry scan.
+    Entries are only inflated within an ExtractionBudget (a fresh one unless `budget` is
+    given); skipped ones are listed in `limits` and leave the features partial but valid.
+    Raises zipfile.BadZipFile if the upload is not a readable archive.
+    """
+
+    def __init__(
+        self,
+        data: Any,
+        path: Optional[str] = None,
+        cache: Optional[EntryFeatureCache] = None,
+        walk: bool = True,
+        budget: Optional[ExtractionBudget] = None
+    ):
+        self.data = data
+        self.path = path
+        self.cache_hits = 0
+        self.files: List[str] = []
+        self.crcs: Dict[str, int] = {}
+        self.manifest: Optional[bytes] = None
+        self.urls: List[str] = []
+        self.bad_entries: List[str] = []
+        self.resources: Optional[Tuple[Any, int, int]] = None
+        self.dex: Dict[str, Dict[str, int]] = {}
+        self.api_calls: List[str] = []
+        self.dex_packages: List[str] = []
+        self.signers: List[str] = []
+        self.signer_subjects: List[str] = []
+        self.walked = False
+        self.budget = budget or ExtractionBudget()
+        self._verified_signers: Optional[List[str]] = None
+        fp = MappedFile(data) if isinstance(data, mmap.mmap) else io.BytesIO(data)
+        self.zip = zipfile.ZipFile(fp)
+        try:
+            self.entries: List[zipfile.ZipInfo] = []
+            signature_files = []
+            for info in self.zip.infolist():
+                name = info.filename
+                self.files.append(name)
+                self.crcs[name] = info.CRC
+                if info.is_dir():
+                    continue
+                if SIGNATURE_FILE_REGEX.match(name):
+                    signature_files.append(info)
+                if name != MANIFEST_NAME and not name.endswith(SCANNABLE_EXTENSIONS):
+                    continue
+                self.entries.append(info)
+                try:
+                    # Reading an entry to the end also verifies its CRC, which replaces testzip().
+                    if name == MANIFEST_NAME:
+                        if self.budget.admit(info, max_size=MANIFEST_MAX_BYTES):
+                            self.manifest = self.zip.read(info)
+                    elif name == RESOURCES_NAME:
+                        if self.budget.admit(info, max_size=DEX_MAX_BYTES):
+                            self.resources = self.region(self.zip, info)
+                except Exception:
+                    self.bad_entries.append(name)
+            self.signers, self.signer_subjects = self.read_signers(signature_files)
+            if walk:
+                self.walk(cache)
+        except Exception:
+            self.zip.close()
+            raise
+
+    def walk(
+        self,
+        cache: Optional[EntryFeatureCache] = None,
+        select: Optional[Callable[[zipfile.ZipInfo], bool]] = None
+    ) -> None:
+        """Scans every scannable entry (or those `select` accepts) once for URLs and DEX features."""
+        if self.walked:
+            return
+        self.walked = True
+        z = self.zip
+        urls = set()
+        api_calls = set()
+        dex_packages = set()
+        failed = set(self.bad_entries) | self.budget.skipped
+        entries = [info for info in self.entries if info.filename not in failed and (select is None or select(info))]
+        keys = {}
+        if cache is not None:
+            keys = {
+                info.filename: key for info in entries
+                if info.file_size >= ENTRY_CACHE_MIN_BYTES and (key := entry_cache_key(self.data, info))
+            }
+        cached = cache.lookup(list(keys.values())) if keys else {}
+        misses = [info for info in entries if keys.get(info.filename) not in cached]
+        # Manifest and resources were admitted (and inflated) by the header pass.
+        misses = [
+            info for info in misses
+            if info.filename in (MANIFEST_NAME, RESOURCES_NAME) or self.budget.admit(info)
+        ]
+        scanned = dict(zip((info.filename for info in misses), self.scan_entries(z, misses)))
+        skipped = self.budget.skipped
+        fresh: Dict[str, Dict[str, Any]] = {}
+        # Merge in central-directory order so results never depend on thread timing.
+        for info in entries:
+            name = info.filename
+            key = keys.get(name)
+            if key in cached:
+                self.cache_hits += 1
+                entry = cached[key]
+            elif name in skipped:
+                continue
+            else:
+                entry = scanned[name]
+                if entry is None:
+                    self.bad_entries.append(name)
+                    continue
+                if key:
+                    fresh[key] = entry
+            urls.update(entry["urls"])
+            if "stats" in entry:
+                self.dex[name] = entry["stats"]
+                api_calls.update(entry["api_calls"])
+                dex_packages.update(entry["packages"])
+        if cache is not None and fresh:
+            cache.store(fresh)
+        self.urls = sorted(urls)
+        self.api_calls = sorted(api_calls)
+        self.dex_packages = sorted(dex_packages)
+
+    def read_signers(self, signature_files: List[zipfile.ZipInfo]) -> Tuple[List[str], List[str]]:
+        """(fingerprints, subjects) of every certificate in the v2/v3 block and v1 signature
+        files. Nothing here is verified."""
+        certs = []
+        try:
+            found = apk_scheme_signers(self.data)
+        except (ValueError, IndexError, struct.error):
+            found = None
+        for signer in (found[1] if found else []):
+            certs.extend(signer["certificates"][:1])
+        for info in signature_files:
+            try:
+                certs.extend(pkcs7_certificates(self.zip.read(info)))
+            except Exception:
+                continue
+        subjects = set()
+        for cert in certs:
+            try:
+                subjects.add(certificate_subject(cert))
+            except (ValueError, IndexError):
+                continue
+        return sorted({certificate_fingerprint(c) for c in certs}), sorted(subjects - {""})
+
+    def verified_signers(self) -> List[str]:
+        """Fingerprints of signers whose v2/v3 signature verifies; hashes the whole APK once."""
+        if self._verified_signers is None:
+            self._verified_signers = verify_apk_signers(self.data)
+        return self._verified_signers
+
+    def region(self, z: zipfile.ZipFile, info: zipfile.ZipInfo) -> Tuple[Any, int, int]:
+        """(buffer, offset, size) of an entry's contents.
+
+        STORED entries point straight into the archive buffer (no copy); compressed
+        entries are decompressed once.
+        """
+        if info.compress_type == zipfile.ZIP_STORED:
+            header = struct.unpack_from("<4s2B4HL2L2H", self.data, info.header_offset)
+            if header[0] == b"PK\x03\x04":
+                base = info.header_offset + 30 + header[10] + header[11]
+                if base + info.file_size <= len(self.data):
+                    return self.data, base, info.file_size
+        data = z.read(info)
+        return data, 0, len(data)
+
+    def scan_entries(self, z: zipfile.ZipFile, infos: List[zipfile.ZipInfo]) -> List[Optional[Dict[str, Any]]]:
+        """scan_entry over `infos` (None for an unreadable entry), results in input order.
+
+        With ENTRY_SCAN_THREADS > 1 entries run concurrently, admitted against a per-APK
+        ENTRY_SCAN_MEMORY_BUDGET of the bytes each one holds in memory while scanned.
+        """
+        def scan(info: zipfile.ZipInfo) -> Optional[Dict[str, Any]]:
+            try:
+                if self.budget.expired():
+                    raise ResourceLimitExceeded("deadline")
+                return self.scan_entry(z, info)
+            except ResourceLimitExceeded as e:
+                self.budget.skip(info.filename, str(e))
+                return None
+            except Exception:
+                return None
+
+        if ENTRY_SCAN_THREADS <= 1 or len(infos) < 2:
+            return [scan(info) for info in infos]
+        budget = ByteBudget(ENTRY_SCAN_MEMORY_BUDGET)
+
+        def scan_within_budget(info: zipfile.ZipInfo) -> Optional[Dict[str, Any]]:
+            with budget.reserve(self.scan_memory(info)):
+                return scan(info)
+
+        return list(entry_scan_pool().map(scan_within_budget, infos))
+
+    def scan_memory(self, info: zipfile.ZipInfo) -> int:
+        """Bytes an entry holds while scanned: compressed DEX is inflated whole, the rest streams."""
+        if DEX_NAME_REGEX.match(info.filename) and info.compress_type != zipfile.ZIP_STORED:
+            return info.file_size
+        return SCAN_CHUNK_SIZE + URL_MAX_LENGTH
+
+    def scan_entry(self, z: zipfile.ZipFile, info: zipfile.ZipInfo) -> Dict[str, Any]:
+        """Scan result for one entry, in the form stored by EntryFeatureCache."""
+        name = info.filename
+        if name == MANIFEST_NAME:
+            return {"urls": sorted(set(scan_urls(io.BytesIO(self.manifest or b""), deadline=self.budget.deadline)))}
+        if name == RESOURCES_NAME and self.resources is not None:
+            buf = self.resources[0]
+            with (io.BytesIO(buf) if buf is not self.data else z.open(info)) as stream:
+                return {"urls": sorted(set(scan_urls(stream, deadline=self.budget.deadline)))}
+        if DEX_NAME_REGEX.match(name) and info.file_size <= DEX_MAX_BYTES:
+            parsed = self.parse_dex_entry(z, info)
+            if parsed is not None:
+                return {
+                    "urls": sorted(parsed["urls"]),
+                    "stats": parsed["stats"],
+                    "api_calls": sorted(parsed["api_calls"]),
+                    "packages": sorted(parsed["packages"]),
+                }
+        with z.open(info) as stream:
+            return {"urls": sorted(set(scan_urls(stream, deadline=self.budget.deadline)))}
+
+    def parse_dex_entry(self, z: zipfile.ZipFile, info: zipfile.ZipInfo) -> Optional[Dict[str, Any]]:
+        """Parses a DEX entry in place when it is STORED, otherwise after one decompression.
+
+        Returns None if the entry is not a parseable DEX; the caller then falls back to
+        byte scanning.
+        """
+        try:
+            return parse_dex(*self.region(z, info))
+        except (ValueError, IndexError, struct.error):
+            return None
+
+    @classmethod
+    def open(
+        cls,
+        path: str,
+        cache: Optional[EntryFeatureCache] = None,
+        walk: bool = True,
+        budget: Optional[ExtractionBudget] = None
+    ) -> "ApkArchive":
+        """Maps a spooled APK read-only so it is parsed without copying it into memory."""
+        with open(path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise zipfile.BadZipFile("File is empty")
+        try:
+            return cls(mm, path=path, cache=cache, walk=walk, budget=budget)
+        except Exception:
+            mm.close()
+            raise
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    @property
+    def limits(self) -> List[str]:
+        out = self.budget.summary()
+        if len(self.files) > FEATURES_MAX_FILES:
+            out.append(f"files: listing truncated to {FEATURES_MAX_FILES} of {len(self.files)} entries")
+        return out
+
+    def close(self) -> None:
+        self.zip.close()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self) -> "ApkArchive":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def empty_features() -> Dict[str, Any]:
+    """Returns the feature skeleton shared by every extractor."""
+    return {
+        "app_name": None,
+        "package": None,
+        "permissions": [],
+        "activities": [],
+        "receivers": [],
+        "services": [],
+        "providers": [],
+        "files": [],
+        "urls": [],
+        "certificates": [],
+        "dex": {},
+        "api_calls": [],
+        "dex_packages": [],
+        "signers": [],
+        "signer_subjects": [],
+        "verified_signers": [],
+        "limits": [],
+    }
+
+
+def archive_features(archive: ApkArchive) -> Dict[str, Any]:
+    """Fills the archive-level features (file listing, URLs) from the shared view."""
+    out = empty_features()
+    out["files"] = archive.files[:FEATURES_MAX_FILES]
+    out["urls"] = list(archive.urls)
+    out["dex"] = dict(archive.dex)
+    out["api_calls"] = list(archive.api_calls)
+    out["dex_packages"] = list(archive.dex_packages)
+    out["signers"] = list(archive.signers)
+    out["signer_subjects"] = list(archive.signer_subjects)
+    out["limits"] = archive.limits
+    return out
+
+
+def extract_with_axml(archive: ApkArchive) -> Dict[str, Any]:
+    """Extracts manifest features with the built-in AXML/ARSC reader (the fast path)."""
+    if archive.manifest is None:
+        raise ValueError("APK has no AndroidManifest.xml")
+    out = archive_features(archive)
+    out.update(parse_manifest(archive.manifest, archive.resources))
+    out["certificates"] = [f for f in archive.files if SIGNATURE_FILE_REGEX.match(f)]
+    return out
+
+
+def extract_with_androguard(archive: ApkArchive) -> Dict[str, Any]:
+    """Extracts manifest features using androguard; archive features come from the shared view."""
+    from androguard.core.bytecodes.apk import APK  # type: ignore
+    a = APK(archive.path) if archive.path else APK(bytes(archive.data), raw=True)
+    out = archive_features(archive)
+    out.update({
+        "app_name": a.get_app_name(),
+        "package": a.get_package(),
+        "permissions": sorted(list(set(a.get_permissions() or []))),
+        "activities": a.get_activities() or [],
+        "receivers": a.get_receivers() or [],
+        "services": a.get_services() or [],
+        "providers": a.get_providers() or [],
+        "certificates": [str(x) for x in (a.get_signature_names() or [])],
+    })
+    return out
+
+
+def extract_with_apkutils(archive: ApkArchive) -> Dict[str, Any]:
+    """Extracts manifest features using apkutils2; archive features come from the shared view."""
+    apk = APKU(archive.path or io.BytesIO(archive.data))
+    manifest = apk.get_manifest() or {}
+    permissions = sorted(list({p["name"] for p in manifest.get("uses-permission", []) if "name" in p}))
+    out = archive_features(archive)
+    out.update({
+        "app_name": apk.get_app_name(),
+        "package": apk.get_package_name(),
+        "permissions": permissions,
+    })
+    return out
+
+
+def extract_features(archive: ApkArchive) -> Dict[str, Any]:
+    """Attempts to extract features using available libraries, with a fallback for basic info.
+
+    The built-in AXML reader runs first unless ANALYSIS_DEEP selects androguard.
+    """
+    if ANALYSIS_DEEP and ANDROGUARD_AVAILABLE and not archive.limits:
+        try:
+            return extract_with_androguard(archive)
+        except Exception:
+            pass
+    try:
+        return extract_with_axml(archive)
+    except Exception:
+        pass
+    if archive.limits:
+        # The library extractors would re-read the whole APK outside the budget.
+        return archive_features(archive)
+    if ANDROGUARD_AVAILABLE and not ANALYSIS_DEEP:
+        try:
+            return extract_with_androguard(archive)
+        except Exception:
+            pass
+    if APKUTILS_AVAILABLE:
+        try:
+            return extract_with_apkutils(archive)
+        except Exception:
+            pass
+    return archive_features(archive)
+
+
+# -----------------------------
+# BACKEND: Domain reputation
+# Each URL's host is parsed once, reduced to its registrable domain (eTLD+1) with a
+# public-suffix trie, and looked up in offline block/allow lists. A list is compiled once
+# into <list>.idx, a sorted array of 64-bit domain hashes that is memory-mapped and
+# binary searched: no parsing at startup, and the pages are shared by all workers.
+# -----------------------------
+def url_host(url: str) -> Optional[str]:
+    """Lower-case host of a URL without a trailing dot; None if it has none."""
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return None
+    host = (host or "").rstrip(".")
+    return host or None
+
+
+def is_ip_address(host: str) -> bool:
+    if not (host[-1:].isdigit() or ":" in host):  # skips the costly parse for names
+        return False
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class PublicSuffixTrie:
+    """Public Suffix List rules as a trie of reversed labels.
+
+    Supports wildcard (`*.ck`) and exception (`!www.ck`) rules; a host matching no rule
+    has its last label as the suffix.
+    """
+
+    def __init__(self, rules: List[str]):
+        self.root: Dict[str, Any] = {}
+        for rule in rules:
+            node = self.root
+            for label in reversed(rule.split(".")):
+                node = node.setdefault(label, {})
+            node["$"] = True
+
+    @classmethod
+    def from_file(cls, path: str) -> "PublicSuffixTrie":
+        rules = list(BUILTIN_PUBLIC_SUFFIXES)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    rule = line.strip().split(" ", 1)[0].lower()
+                    if not rule or rule.startswith("//"):
+                        continue
+                    try:
+                        rule = rule.encode("idna").decode("ascii")  # hosts in URLs are punycode
+                    except UnicodeError:
+                        pass
+                    rules.append(rule)
+        return cls(rules)
+
+    def suffix_labels(self, labels: List[str]) -> int:
+        """Number of trailing labels of `labels` that form the public suffix."""
+        best = 1
+        node = self.root
+        for depth, label in enumerate(reversed(labels)):
+            if "!" + label in node:
+                return depth
+            child = node.get(label, node.get("*"))
+            if child is None:
+                break
+            if child.get("$"):
+                best = depth + 1
+            node = child
+        return best
+
+    def registrable_domain(self, host: str) -> Optional[str]:
+        """eTLD+1 of a host (the host itself for IPs); None if the host is a public suffix."""
+        if is_ip_address(host):
+            return host
+        labels = host.split(".")
+        n = self.suffix_labels(labels)
+        if n >= len(labels):
+            return None
+        return ".".join(labels[-n - 1:])
+
+
+class DomainSet:
+    """Membership test over a domain list compiled to a memory-mapped sorted hash array.
+
+    The text list takes one domain per line; `#` comments and hosts-file lines
+    (`0.0.0.0 example.com`) are accepted. The .idx file records the list's size and mtime
+    and is rebuilt when they change.
+    """
+
+    MAGIC = b"DSET"
+    HEADER = struct.Struct("<4sQq")  # magic, source size, source mtime_ns
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.mm: Optional[mmap.mmap] = None
+        self.keys: Any = ()
+
+    @staticmethod
+    def key(domain: str) -> int:
+        return int.from_bytes(hashlib.blake2b(domain.encode(), digest_size=8).digest(), "little")
+
+    @staticmethod
+    def parse_line(line: str) -> Optional[str]:
+        tokens = line.split("#", 1)[0].split()
+        if not tokens:
+            return None
+        domain = tokens[1] if len(tokens) > 1 and is_ip_address(tokens[0]) else tokens[0]
+        return domain.lower().lstrip("*").strip(".") or None
+
+    def compile(self, st: os.stat_result) -> None:
+        keys = set()
+        with open(self.path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                domain = self.parse_line(line)
+                if domain:
+                    keys.add(self.key(domain))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.index_path) or ".", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                out.write(self.HEADER.pack(self.MAGIC, st.st_size, st.st_mtime_ns))
+                array("Q", sorted(keys)).tofile(out)
+            os.replace(tmp, self.index_path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def load(self) -> "DomainSet":
+        if not os.path.exists(self.path):
+            return self
+        st = os.stat(self.path)
+        header = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                header = f.read(self.HEADER.size)
+        if header != self.HEADER.pack(self.MAGIC, st.st_size, st.st_mtime_ns):
+            self.compile(st)
+        with open(self.index_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size > self.HEADER.size:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.keys = memoryview(self.mm)[self.HEADER.size:].cast("Q")
+        return self
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, domain: str) -> bool:
+        if not self.keys:
+            return False
+        k = self.key(domain)
+        i = bisect.bisect_left(self.keys, k)
+        return i < len(self.keys) and self.keys[i] == k
+
+
+class DomainReputation:
+    """Verdicts for URL hosts from the offline lists; loaded on first use in each process."""
+
+    def __init__(self, suffix_file: str, blocklist_file: str, allowlist_file: str):
+        self.suffix_file = suffix_file
+        self.blocklist_file = blocklist_file
+        self.allowlist_file = allowlist_file
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.suffixes = PublicSuffixTrie([])
+        self.blocklist = DomainSet(blocklist_file)
+        self.allowlist = DomainSet(allowlist_file)
+        self.host_status = functools.lru_cache(maxsize=DOMAIN_CACHE_SIZE)(self._host_status)
+
+    def load(self) -> None:
+        with self.lock:
+            if self.loaded:
+                return
+            self.suffixes = PublicSuffixTrie.from_file(self.suffix_file)
+            self.blocklist = DomainSet(self.blocklist_file).load()
+            self.allowlist = DomainSet(self.allowlist_file).load()
+            self.loaded = True
+
+    def _host_status(self, host: str) -> Tuple[Optional[str], Optional[str]]:
+        """(status, registrable domain); status is "allow", "block" or None.
+
+        The host and each parent domain down to the registrable domain are checked, so
+        listing `evil.com` covers `login.evil.com`; an allowlist hit wins.
+        """
+        if not self.loaded:
+            self.load()
+        domain = self.suffixes.registrable_domain(host)
+        if domain is None:
+            return None, None
+        labels = host.split(".")
+        names = [".".join(labels[i:]) for i in range(len(labels) - domain.count("."))]
+        if any(n in self.allowlist for n in names):
+            return "allow", domain
+        if any(n in self.blocklist for n in names):
+            return "block", domain
+        return None, domain
+
+
+domain_reputation = DomainReputation(PUBLIC_SUFFIX_FILE, DOMAIN_BLOCKLIST_FILE, DOMAIN_ALLOWLIST_FILE)
+
+
+def url_reputation(urls: List[str]) -> Tuple[int, int]:
+    """(suspicious TLD points, number of blocklisted registrable domains) for a URL list.
+
+    Each URL with a suspicious TLD adds 2 points unless its host is allowlisted.
+    """
+    points = 0
+    blocked = set()
+    for u in urls:
+        host = url_host(u)
+        if not host:
+            continue
+        status, domain = domain_reputation.host_status(host)
+        if status == "allow":
+            continue
+        if status == "block":
+            blocked.add(domain)
+        if "." + host.rsplit(".", 1)[-1] in SUSPICIOUS_TLDS:
+            points += 2
+    return points, len(blocked)
+
+
+def blocklist_points(blocked: int) -> int:
+    return min(BLOCKLIST_MAX_POINTS, BLOCKLIST_POINTS * blocked)
+
+
+def name_similarity_score(app_name: Optional[str], known: List[str]) -> float:
+    """Calculates app name similarity to a list of known names."""
+    if not app_name or not known:
+        return 0.0
+    if RAPIDFUZZ_AVAILABLE:
+        best = max(fuzz.ratio(app_name, k) for k in known)
+        return float(best)
+    app_lower = app_name.lower()
+    best = 0
+    for k in known:
+        k_lower = k.lower()
+        common = len(set(app_lower.split()) & set(k_lower.split()))
+        best = max(best, common / max(len(k_lower.split()), 1) * 100)
+    return float(best)
+
+
+# -----------------------------
+# BACKEND: Bank reference index
+# Official bank names/packages are preprocessed once into an in-memory index instead of
+# being re-queried and linearly scanned on every analysis. The index is rebuilt when
+# /banks is written (the version number changes) or after BANK_INDEX_TTL seconds, which
+# also picks up writes made by other server processes.
+# -----------------------------
+BANK_INDEX_TTL = 60.0
+BANK_NGRAM = 3
+BANK_SCAN_LIMIT = 256  # below this many names every name is scored (exact)
+BANK_CANDIDATES = 64   # above it, only the names sharing the most n-grams are scored
+BANK_SIMILARITY_CACHE = 4096
+
+
+class PrefixTrie:
+    """Character trie answering "is any stored key a prefix of this string?"."""
+
+    def __init__(self):
+        self.root: Dict[str, Any] = {}
+
+    def add(self, key: str) -> None:
+        node = self.root
+        for ch in key:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def has_prefix_of(self, s: str) -> bool:
+        node = self.root
+        if "" in node:
+            return True
+        for ch in s:
+            node = node.get(ch)
+            if node is None:
+                return False
+            if "" in node:
+                return True
+        return False
+
+
+def name_ngrams(name: str) -> set:
+    text_ = name.lower()
+    if len(text_) <= BANK_NGRAM:
+        return {text_}
+    return {text_[i:i + BANK_NGRAM] for i in range(len(text_) - BANK_NGRAM + 1)}
+
+
+class BankIndex:
+    """Preprocessed official bank references: package-prefix trie plus name candidate filters."""
+
+    def __init__(self, names: List[str], packages: List[str], signers: Optional[Dict[str, List[str]]] = None):
+        self.names = names
+        self.packages = packages
+        # fingerprint -> packages it officially signs, and the reverse for mismatch checks.
+        self.signer_packages: Dict[str, set] = {}
+        self.package_signers: Dict[str, set] = {}
+        for package, fingerprints in (signers or {}).items():
+            for fp in fingerprints:
+                self.signer_packages.setdefault(fp, set()).add(package)
+                self.package_signers.setdefault(package, set()).add(fp)
+        self.prefixes = PrefixTrie()
+        for p in packages:
+            self.prefixes.add(p.split(".")[0])
+        # Token index serves the word-overlap fallback, n-gram index the rapidfuzz path.
+        self.tokens = [set(n.lower().split()) for n in names]
+        self.token_index: Dict[str, List[int]] = {}
+        self.gram_index: Dict[str, List[int]] = {}
+        self.gram_counts: List[int] = []
+        for i, n in enumerate(names):
+            for t in self.tokens[i]:
+                self.token_index.setdefault(t, []).append(i)
+            grams = name_ngrams(n)
+            self.gram_counts.append(len(grams))
+            for g in grams:
+                self.gram_index.setdefault(g, []).append(i)
+        self.cache: Dict[str, float] = {}
+
+    def matches_bank_prefix(self, pkg: str) -> bool:
+        return self.prefixes.has_prefix_of(pkg)
+
+    def signer_status(self, pkg: str, verified: List[str]) -> Optional[str]:
+        """"official" if a verified signer is registered for `pkg` (or a parent package),
+        "mismatch" if `pkg` falls under a bank package with registered signers but no
+        verified signer is one of them, otherwise None.
+
+        Only verified fingerprints count: a registered certificate copied into an APK
+        whose signature does not verify is still a mismatch.
+        """
+        if not pkg or not self.package_signers:
+            return None
+        parts = pkg.split(".")
+        claimed = [p for p in (".".join(parts[:i]) for i in range(1, len(parts) + 1)) if p in self.package_signers]
+        if not claimed:
+            return None
+        if any(self.signer_packages.get(fp, set()).intersection(claimed) for fp in verified):
+            return "official"
+        return "mismatch"
+
+    def candidates(self, app_name: str) -> List[str]:
+        if not RAPIDFUZZ_AVAILABLE:
+            # Names sharing no word score 0 in the fallback, so this filter is exact.
+            ids = {i for t in app_name.lower().split() for i in self.token_index.get(t, [])}
+            return [self.names[i] for i in sorted(ids)]
+        if len(self.names) <= BANK_SCAN_LIMIT:
+            return self.names
+        grams = name_ngrams(app_name)
+        counts: Dict[int, int] = {}
+        for g in grams:
+            for i in self.gram_index.get(g, []):
+                counts[i] = counts.get(i, 0) + 1
+        # Rank by Dice overlap so long names sharing many n-grams do not crowd out close matches.
+        dice = {i: 2 * c / (len(grams) + self.gram_counts[i]) for i, c in counts.items()}
+        best = sorted(dice, key=lambda i: -dice[i])[:BANK_CANDIDATES]
+        return [self.names[i] for i in best]
+
+    def similarity(self, app_name: Optional[str]) -> float:
+        """name_similarity_score against the official names, scored over candidates only.
+
+        Exact up to BANK_SCAN_LIMIT names. Beyond that, names outside the best n-gram
+        candidates are skipped; they can only be weak matches, not ones near the 60 cut-off.
+        """
+        if not app_name:
+            return 0.0
+        sim = self.cache.get(app_name)
+        if sim is None:
+            sim = name_similarity_score(app_name, self.candidates(app_name))
+            if len(self.cache) >= BANK_SIMILARITY_CACHE:
+                self.cache.clear()
+            self.cache[app_name] = sim
+        return sim
+
+
+class BankIndexCache:
+    """Process-local holder of the current BankIndex."""
+
+    def __init__(self):
+        self.version = 0
+        self.index: Optional[BankIndex] = None
+        self.loaded_version = -1
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        self.version += 1
+        self.index = None
+
+    def get(self, version: Optional[int] = None) -> BankIndex:
+        """Returns the index, rebuilding it if `version` (default: this process's) is newer or the TTL expired."""
+        version = self.version if version is None else version
+        index = self.index
+        if index is not None and self.loaded_version == version and time.monotonic() - self.loaded_at < BANK_INDEX_TTL:
+            return index
+        with self.lock:
+            with SessionLocal() as db:
+                names, packages = official_bank_refs(db)
+                signers = official_bank_signers(db)
+            self.index = BankIndex(names, packages, signers)
+            self.loaded_version = version
+            self.loaded_at = time.monotonic()
+            return self.index
+
+
+bank_index = BankIndexCache()
+
+
+# -----------------------------
+# BACKEND: Permission rule engine
+# Permissions are interned to fixed bit positions so an APK's permission set is a single
+# integer (persisted as Report.perm_mask). Rules compile to masks and are evaluated with
+# AND + popcount, either on one mask or vectorized over a NumPy array of masks.
+# -----------------------------
+# Append-only: a permission's index is its bit in every stored perm_mask. Max 63 entries.
+# Stored masks gain a new bit when POST /reports/rescore (or backfill_permission_masks())
+# next rewrites them.
+PERMISSION_BITS = [
+    "android.permission.READ_SMS",
+    "android.permission.RECEIVE_SMS",
+    "android.permission.SEND_SMS",
+    "android.permission.READ_CONTACTS",
+    "android.permission.WRITE_CONTACTS",
+    "android.permission.CALL_PHONE",
+    "android.permission.READ_CALL_LOG",
+    "android.permission.WRITE_CALL_LOG",
+    "android.permission.RECORD_AUDIO",
+    "android.permission.READ_PHONE_STATE",
+    "android.permission.SYSTEM_ALERT_WINDOW",
+    "android.permission.QUERY_ALL_PACKAGES",
+    "android.permission.REQUEST_INSTALL_PACKAGES",
+    "android.permission.BIND_ACCESSIBILITY_SERVICE",
+    "android.permission.PACKAGE_USAGE_STATS",
+    "android.permission.INTERNET",
+    "android.permission.ACCESS_NETWORK_STATE",
+    "android.permission.ACCESS_WIFI_STATE",
+    "android.permission.CHANGE_WIFI_STATE",
+    "android.permission.RECEIVE_BOOT_COMPLETED",
+    "android.permission.WAKE_LOCK",
+    "android.permission.FOREGROUND_SERVICE",
+    "android.permission.VIBRATE",
+    "android.permission.CAMERA",
+    "android.permission.ACCESS_FINE_LOCATION",
+    "android.permission.ACCESS_COARSE_LOCATION",
+    "android.permission.ACCESS_BACKGROUND_LOCATION",
+    "android.permission.READ_EXTERNAL_STORAGE",
+    "android.permission.WRITE_EXTERNAL_STORAGE",
+    "android.permission.MANAGE_EXTERNAL_STORAGE",
+    "android.permission.GET_ACCOUNTS",
+    "android.permission.READ_PHONE_NUMBERS",
+    "android.permission.ANSWER_PHONE_CALLS",
+    "android.permission.PROCESS_OUTGOING_CALLS",
+    "android.permission.RECEIVE_MMS",
+    "android.permission.RECEIVE_WAP_PUSH",
+    "android.permission.BIND_NOTIFICATION_LISTENER_SERVICE",
+    "android.permission.BIND_DEVICE_ADMIN",
+    "android.permission.DISABLE_KEYGUARD",
+    "android.permission.USE_BIOMETRIC",
+    "android.permission.USE_FINGERPRINT",
+    "android.permission.REQUEST_IGNORE_BATTERY_OPTIMIZATIONS",
+    "android.permission.WRITE_SETTINGS",
+    "android.permission.BLUETOOTH",
+    "android.permission.NFC",
+]
+if len(PERMISSION_BITS) > 63 or len(set(PERMISSION_BITS)) != len(PERMISSION_BITS):
+    raise RuntimeError("PERMISSION_BITS must hold at most 63 distinct permissions")
+PERMISSION_BIT = {p: 1 << i for i, p in enumerate(PERMISSION_BITS)}
+
+
+def permission_mask(permissions: List[str]) -> int:
+    """Encodes a permission list as a bitmask; permissions outside PERMISSION_BITS are ignored."""
+    mask = 0
+    for p in permissions:
+        mask |= PERMISSION_BIT.get(p, 0)
+    return mask
+
+
+def mask_permissions(mask: int) -> List[str]:
+    """Decodes a bitmask back to its (sorted) permission names."""
+    return sorted(p for p, bit in PERMISSION_BIT.items() if mask & bit)
+
+
+def popcount64(masks: Any) -> Any:
+    """Vectorized popcount over an int64 NumPy array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(masks.astype(np.uint64)).astype(np.int64)
+    as_bytes = masks.astype(np.uint64).view(np.uint8).reshape(-1, 8)
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+    return table[as_bytes].sum(axis=1)
+
+
+class PermissionRule:
+    """A scoring rule over a permission mask.
+
+    With `per_match` the rule scores per_match * (number of matching bits), capped at
+    `cap`. Otherwise it scores `points` when at least one bit matches (`match="any"`)
+    or when every bit matches (`match="all"`). `detail` may use {count}, {perms}, {add}.
+    Raises ValueError for a permission without a PERMISSION_BITS entry, so a rule can
+    never silently lose part of its set.
+    """
+
+    def __init__(
+        self,
+        code: str,
+        permissions: List[str],
+        detail: str,
+        points: int = 0,
+        per_match: int = 0,
+        cap: int = 100,
+        match: str = "any",
+    ):
+        untracked = sorted(set(permissions) - PERMISSION_BIT.keys())
+        if untracked:
+            raise ValueError(f"Rule {code} uses permissions missing from PERMISSION_BITS: {', '.join(untracked)}")
+        self.code = code
+        self.mask = permission_mask(permissions)
+        self.detail = detail
+        self.points = points
+        self.per_match = per_match
+        self.cap = cap
+        self.match = match
+
+    def evaluate(self, mask: int) -> Optional[Tuple[int, Reason]]:
+        """Returns (points, reason) if the rule fires for `mask`."""
+        hits = mask & self.mask
+        if not hits or (self.match == "all" and hits != self.mask):
+            return None
+        count = hits.bit_count()
+        add = min(self.cap, self.per_match * count) if self.per_match else self.points
+        detail = self.detail.format(count=count, perms=", ".join(mask_permissions(hits)), add=add)
+        return add, Reason(code=self.code, detail=detail)
+
+    def vectorized_points(self, masks: Any) -> Any:
+        hits = masks & self.mask
+        if self.per_match:
+            return np.minimum(self.cap, self.per_match * popcount64(hits))
+        matched = hits == self.mask if self.match == "all" else hits != 0
+        return np.where(matched, self.points, 0)
+
+
+# Rules scored before the URL/package checks...
+PERMISSION_COUNT_RULES = [
+    PermissionRule(
+        "dangerous_permissions", sorted(DANGEROUS_PERMS),
+        "Requests {count} dangerous permissions: {perms} (+{add})",
+        per_match=5, cap=40,
+    ),
+]
+# ...and after them.
+CAPABILITY_RULES = [
+    PermissionRule(
+        "accessibility", ["android.permission.BIND_ACCESSIBILITY_SERVICE"],
+        "Requests Accessibility Service (used in overlay/credential theft) (+{add})", points=15,
+    ),
+    PermissionRule(
+        "overlay", ["android.permission.SYSTEM_ALERT_WINDOW"],
+        "Can draw over other apps (overlay attacks) (+{add})", points=10,
+    ),
+    PermissionRule(
+        "otp_capture", ["android.permission.READ_SMS", "android.permission.RECEIVE_SMS", "android.permission.SEND_SMS"],
+        "Requests SMS permissions (OTP capture risk) (+{add})", points=10,
+    ),
+]
+PERMISSION_RULES = PERMISSION_COUNT_RULES + CAPABILITY_RULES
+
+
+def apply_permission_rules(rules: List[PermissionRule], mask: int, reasons: List[Reason]) -> int:
+    """Evaluates rules against one mask, appending reasons; returns the points added."""
+    total = 0
+    for rule in rules:
+        hit = rule.evaluate(mask)
+        if hit:
+            total += hit[0]
+            reasons.append(hit[1])
+    return total
+
+
+def vectorized_permission_points(masks: Any) -> Any:
+    """Total permission-rule points for every mask in an int64 array."""
+    total = np.zeros(len(masks), dtype=np.float64)
+    for rule in PERMISSION_RULES:
+        total += rule.vectorized_points(masks)
+    return total
+
+
+def compute_heuristic_score(features: Dict[str, Any], banks: BankIndex) -> Tuple[float, List[Reason]]:
+    """Applies a set of heuristic rules to determine a risk score."""
+    score = 0.0
+    reasons: List[Reason] = []
+    mask = permission_mask(features.get("permissions") or [])
+    score += apply_permission_rules(PERMISSION_COUNT_RULES, mask, reasons)
+    urls = features.get("urls") or []
+    if urls:
+        add = min(20, 2 * len(urls))
+        score += add
+        reasons.append(Reason(code="embedded_urls", detail=f"Contains {len(urls)} embedded URL(s) in resources (+{add})"))
+        s_tld, blocked = url_reputation(urls)
+        if s_tld:
+            score += s_tld
+            reasons.append(Reason(code="suspicious_tlds", detail=f"URLs include suspicious TLDs (+{s_tld})"))
+        if blocked:
+            add = blocklist_points(blocked)
+            score += add
+            reasons.append(Reason(code="blocklisted_domains", detail=f"URLs point to {blocked} blocklisted domain(s) (+{add})"))
+    app_name = features.get("app_name")
+    pkg = features.get("package") or ""
+    sim = banks.similarity(app_name) if app_name else 0.0
+    if pkg and app_name and banks.matches_bank_prefix(pkg):
+        if sim < 60:
+            score += 15
+            reasons.append(Reason(code="pkg_name_mismatch", detail=f"Bank-like package prefix but name similarity low ({sim:.1f}) (+15)"))
+    if banks.signer_status(pkg, features.get("verified_signers") or []) == "mismatch":
+        score += 40
+        reasons.append(Reason(code="signer_mismatch", detail=f"Claims bank package {pkg} but is not signed by its official key (+40)"))
+    limits = features.get("limits") or []
+    if limits:
+        score += 10
+        reasons.append(Reason(code="resource_limit", detail=f"Extraction budget exceeded, features are partial: {'; '.join(limits)} (+10)"))
+    score += apply_permission_rules(CAPABILITY_RULES, mask, reasons)
+    score = max(0.0, min(100.0, score))
+    if score >= 70:
+        verdict = "MALICIOUS"
+    elif score >= 40:
+        verdict = "SUSPICIOUS"
+    else:
+        verdict = "SAFE"
+    reasons.insert(0, Reason(code="name_similarity", detail=f"App name similarity to official bank apps: {sim:.1f}/100"))
+    return score, reasons
+
+
+def backfill_permission_masks(chunk_size: int = 2000) -> None:
+    """Populates perm_mask for reports stored before the column existed (or before a
+    PERMISSION_BITS entry was appended)."""
+    with SessionLocal() as db:
+        last_id = 0
+        while True:
+            rows = (
+                db.query(Report.id, Report.features)
+                .filter(Report.id > last_id)
+                .order_by(asc(Report.id))
+                .limit(chunk_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1].id
+            updates = [
+                {"id": r.id, "perm_mask": permission_mask(r.features.get("permissions") or [])}
+                for r in rows
+            ]
+            db.bulk_update_mappings(Report, updates)  # type: ignore
+            db.commit()
+
+
+if ensure_column("reports", "perm_mask", "INTEGER DEFAULT 0"):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_reports_perm_mask ON reports (perm_mask)"))
+    backfill_permission_masks()
+
+
+# -----------------------------
+# BACKEND: Near-duplicate search
+# Each report gets a MinHash signature over its file list, permissions, URLs and signer
+# certificates. Signatures are split into LSH bands; reports sharing any band bucket are
+# candidates, ranked by the fraction of equal signature slots (an estimate of Jaccard).
+# -----------------------------
+MINHASH_PERMUTATIONS = 128
+LSH_BANDS = 32  # 4 rows per band: pairs above ~0.45 Jaccard almost always collide
+SIMILAR_MIN_SCORE = 0.3
+MINHASH_MASK64 = (1 << 64) - 1
+# Bump when feature_tokens changes; stored signatures of older versions are recomputed.
+MINHASH_TOKEN_VERSION = 2
+
+
+def _minhash_params() -> Tuple[List[int], List[int]]:
+    """Fixed multiply-shift hash family; must never change once signatures are stored."""
+    seed = hashlib.sha256(b"minhash-v1").digest()
+    a, b = [], []
+    while len(a) < MINHASH_PERMUTATIONS:
+        seed = hashlib.sha256(seed).digest()
+        a.append(int.from_bytes(seed[:8], "little") | 1)
+        b.append(int.from_bytes(seed[8:16], "little"))
+    return a, b
+
+
+MINHASH_A, MINHASH_B = _minhash_params()
+
+
+def feature_tokens(features: Dict[str, Any]) -> set:
+    """The shingle set compared between reports."""
+    tokens = set()
+    for prefix, key in (
+        ("f", "files"), ("p", "permissions"), ("u", "urls"), ("c", "certificates"), ("s", "signers"),
+    ):
+        for value in features.get(key) or []:
+            tokens.add(f"{prefix}:{value}")
+    return tokens
+
+
+def minhash_signature(features: Dict[str, Any]) -> Optional[bytes]:
+    """MINHASH_PERMUTATIONS little-endian uint32 minima, or None for an empty token set."""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(t.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+        for t in feature_tokens(features)
+    ]
+    if not hashes:
+        return None
+    if NUMPY_AVAILABLE:
+        x = np.array(hashes, dtype=np.uint64)[:, None]
+        a = np.array(MINHASH_A, dtype=np.uint64)[None, :]
+        b = np.array(MINHASH_B, dtype=np.uint64)[None, :]
+        with np.errstate(over="ignore"):
+            mins = ((x * a + b) >> np.uint64(32)).min(axis=0)
+        return mins.astype("<u4").tobytes()
+    mins = [
+        min(((a * x + b) & MINHASH_MASK64) >> 32 for x in hashes)
+        for a, b in zip(MINHASH_A, MINHASH_B)
+    ]
+    return struct.pack(f"<{MINHASH_PERMUTATIONS}I", *mins)
+
+
+def signature_similarity(a: bytes, b: bytes) -> float:
+    """Estimated Jaccard similarity: the share of equal signature slots."""
+    if NUMPY_AVAILABLE:
+        return float((np.frombuffer(a, dtype="<u4") == np.frombuffer(b, dtype="<u4")).mean())
+    n = MINHASH_PERMUTATIONS
+    return sum(x == y for x, y in zip(struct.unpack(f"<{n}I", a), struct.unpack(f"<{n}I", b))) / n
+
+
+class SimilarityIndex:
+    """Process-local LSH index over Report.minhash.
+
+    Loaded lazily and kept current incrementally: ReportWriter adds new signatures, and
+    every query first picks up rows with ids above the highest one loaded (written by
+    other processes).
+    """
+
+    def __init__(self):
+        self.signatures: Dict[int, bytes] = {}
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(LSH_BANDS)]
+        self.max_loaded_id = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def bands(signature: bytes) -> List[bytes]:
+        width = len(signature) // LSH_BANDS
+        return [signature[i * width:(i + 1) * width] for i in range(LSH_BANDS)]
+
+    def add(self, report_id: int, signature: Optional[bytes]) -> None:
+        if not signature or len(signature) != 4 * MINHASH_PERMUTATIONS:
+            return
+        with self.lock:
+            if report_id in self.signatures:
+                return
+            self.signatures[report_id] = signature
+            for table, band in zip(self.buckets, self.bands(signature)):
+                table.setdefault(band, []).append(report_id)
+
+    def refresh(self, db: Session, chunk_size: int = 5000) -> None:
+        while True:
+            rows = (
+                db.query(Report.id, Report.minhash)
+                .filter(Report.id > self.max_loaded_id)
+                .order_by(asc(Report.id))
+                .limit(chunk_size)
+                .all()
+            )
+            if not rows:
+                return
+            for r in rows:
+                self.add(r.id, r.minhash)
+            self.max_loaded_id = rows[-1].id
+
+    def query(
+        self,
+        signature: bytes,
+        limit: int = 10,
+        min_score: float = SIMILAR_MIN_SCORE,
+        exclude: Optional[int] = None
+    ) -> List[Tuple[int, float]]:
+        """(report_id, similarity) pairs, most similar first."""
+        candidates = set()
+        with self.lock:
+            for table, band in zip(self.buckets, self.bands(signature)):
+                candidates.update(table.get(band, ()))
+            candidates.discard(exclude)
+            scored = [(rid, signature_similarity(signature, self.signatures[rid])) for rid in candidates]
+        scored = [x for x in scored if x[1] >= min_score]
+        scored.sort(key=lambda x: (-x[1], x[0]))
+        return scored[:limit]
+
+
+similarity_index = SimilarityIndex()
+
+
+def backfill_minhash(chunk_size: int = 2000) -> None:
+    """(Re)computes minhash for reports stored before the column existed or signed with
+    an older MINHASH_TOKEN_VERSION."""
+    with SessionLocal() as db:
+        last_id = 0
+        while True:
+            rows = (
+                db.query(Report.id, Report.features)
+                .filter(Report.id > last_id, Report.minhash_version != MINHASH_TOKEN_VERSION)
+                .order_by(asc(Report.id))
+                .limit(chunk_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1].id
+            updates = [
+                {"id": r.id, "minhash": minhash_signature(r.features), "minhash_version": MINHASH_TOKEN_VERSION}
+                for r in rows
+            ]
+            db.bulk_update_mappings(Report, updates)  # type: ignore
+            db.commit()
+
+
+ensure_column("reports", "minhash", "BLOB")
+ensure_column("reports", "minhash_version", "INTEGER DEFAULT 0")
+backfill_minhash()  # only reads rows whose signature is missing or stale
+
+
+def train_report_dictionary(sample_size: int = REPORT_DICT_SAMPLES) -> Optional[int]:
+    """Trains a new report_codec dictionary on the features of the most recent reports."""
+    with SessionLocal() as db:
+        rows = db.query(Report.features).order_by(desc(Report.id)).limit(sample_size).all()
+    return report_codec.train([r.features for r in rows])
+
+
+def migrate_report_storage(recode_all: bool = False, chunk_size: int = 500) -> int:
+    """Rewrites reports still stored as JSON text (or, with `recode_all`, every report)
+    in the current codec format. Returns the number of rows rewritten."""
+    converted = 0
+    with SessionLocal() as db:
+        last_id = 0
+        while True:
+            q = db.query(Report.id, Report.features, Report.reasons).filter(Report.id > last_id)
+            if not recode_all:
+                q = q.filter(or_(func.typeof(Report.features) == "text", func.typeof(Report.reasons) == "text"))
+            rows = q.order_by(asc(Report.id)).limit(chunk_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            updates = [{"id": r.id, "features": r.features, "reasons": r.reasons} for r in rows]
+            db.bulk_update_mappings(Report, updates)  # type: ignore
+            db.commit()
+            converted += len(rows)
+    return converted
+
+
+with engine.connect() as conn:
+    has_text_rows = conn.execute(text("SELECT 1 FROM reports WHERE typeof(features) = 'text' LIMIT 1")).first()
+if has_text_rows:
+    # First start after the storage change: train on the JSON rows, then convert them.
+    report_codec.load()
+    if not report_codec.active_id:
+        train_report_dictionary()
+    migrate_report_storage()
+
+
+def feature_vector(features: Dict[str, Any]) -> List[float]:
+    """The fixed-length input vector the ML models are trained on."""
+    perms = set(features.get("permissions") or [])
+    return [
+        len(perms & DANGEROUS_PERMS),
+        len(features.get("urls") or []),
+        1 if "android.permission.BIND_ACCESSIBILITY_SERVICE" in perms else 0,
+        1 if "android.permission.SYSTEM_ALERT_WINDOW" in perms else 0,
+    ]
+
+
+class ModelRegistry:
+    """Named model versions, loaded once per process and hot-reloaded when their file changes.
+
+    A file is re-stat'ed at most every MODEL_RELOAD_INTERVAL seconds. A changed mtime/size
+    triggers a content hash, and the model is only reloaded when the hash differs, so a
+    `touch` does not cost a reload. If a new file fails to load, the previous model stays.
+    """
+
+    def __init__(self, model_dir: str, split: str):
+        self.model_dir = model_dir
+        self.split: List[Tuple[str, int]] = []
+        for part in split.split(","):
+            name, _, weight = part.strip().partition(":")
+            if name:
+                self.split.append((name, int(weight or 1)))
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.model_dir, f"{name}.joblib")
+
+    def choose(self, key: str) -> str:
+        """Deterministically assigns a sample (by sha256) to a model version for A/B tests."""
+        total = sum(w for _, w in self.split)
+        if total <= 0:
+            return DEFAULT_MODEL_NAME
+        bucket = int(hashlib.sha256(key.encode()).hexdigest()[:8], 16) % total
+        for name, weight in self.split:
+            if bucket < weight:
+                return name
+            bucket -= weight
+        return DEFAULT_MODEL_NAME
+
+    def get(self, name: str = DEFAULT_MODEL_NAME) -> Any:
+        if not JOBLIB_AVAILABLE:
+            return None
+        entry = self.entries.get(name)
+        now = time.monotonic()
+        if entry and now - entry["checked"] < MODEL_RELOAD_INTERVAL:
+            return entry["model"]
+        with self.lock:
+            path = self.path(name)
+            try:
+                st_ = os.stat(path)
+            except OSError:
+                self.entries.pop(name, None)
+                return None
+            stamp = (st_.st_mtime_ns, st_.st_size)
+            if entry and entry["stamp"] == stamp:
+                entry["checked"] = now
+                return entry["model"]
+            digest = sha256_file(path)
+            if entry and entry["sha256"] == digest:
+                entry.update(stamp=stamp, checked=now)
+                return entry["model"]
+            try:
+                model = joblib.load(path)
+            except Exception:
+                return entry["model"] if entry else None
+            self.entries[name] = {"model": model, "stamp": stamp, "sha256": digest, "checked": now}
+            return model
+
+
+model_registry = ModelRegistry(MODEL_DIR, MODEL_AB_SPLIT)
+
+
+def predict_proba(vectors: List[List[float]], model_name: str = DEFAULT_MODEL_NAME) -> Optional[List[float]]:
+    """Scores many feature vectors with one model call; None when no model is available."""
+    model = model_registry.get(model_name)
+    if model is None or not vectors:
+        return None
+    try:
+        if hasattr(model, "predict_proba"):
+            return [float(p[1]) for p in model.predict_proba(vectors)]  # type: ignore
+        return [1.0 / (1.0 + math.exp(-float(d))) for d in model.decision_function(vectors)]  # type: ignore
+    except Exception:
+        return None
+
+
+def model_predict_probability(features: Dict[str, Any], model_name: str = DEFAULT_MODEL_NAME) -> Optional[float]:
+    """Uses a machine learning model to predict a malicious probability."""
+    probs = predict_proba([feature_vector(features)], model_name)
+    return probs[0] if probs else None
+
+
+def verdict_for_score(score: float) -> str:
+    if score >= 70:
+        return "MALICIOUS"
+    if score >= 40:
+        return "SUSPICIOUS"
+    return "SAFE"
+
+
+def score_features(
+    features: Dict[str, Any],
+    banks: BankIndex,
+    model_name: str = DEFAULT_MODEL_NAME
+) -> Tuple[float, str, List[Reason]]:
+    """Combines heuristic and ML scores into a final (score, verdict, reasons)."""
+    pkg = features.get("package") or ""
+    if banks.signer_status(pkg, features.get("verified_signers") or []) == "official":
+        return 0.0, "SAFE", [Reason(code="official_signer", detail=f"Verified signature by the registered key of {pkg}")]
+    h_score, reasons = compute_heuristic_score(features, banks)
+    proba = model_predict_probability(features, model_name)
+    if proba is not None:
+        ml_score = float(proba * 100)
+        version = "" if model_name == DEFAULT_MODEL_NAME else f" [{model_name}]"
+        reasons.append(Reason(code="ml_probability", detail=f"ML model risk probability: {ml_score:.1f}/100{version}"))
+        score = 0.7 * ml_score + 0.3 * h_score
+    else:
+        score = h_score
+    return float(score), verdict_for_score(score), reasons
+
+
+# -----------------------------
+# BACKEND: Bulk rescoring
+# Re-applies the current rules and models to every stored report. Reports are streamed
+# out of SQLite in id-ordered chunks, turned into one NumPy matrix per chunk, scored
+# with vectorized arithmetic plus a single predict_proba call, and written back in
+# one transaction per chunk.
+# -----------------------------
+PERMISSION_COLUMNS = sorted(DANGEROUS_PERMS)
+MODEL_COLUMNS = 4  # leading columns of the matrix == feature_vector()
+
+
+def build_feature_matrix(rows: List[Dict[str, Any]], banks: BankIndex) -> Tuple[Any, Any, Any]:
+    """Returns (X, aux, masks) for a list of stored feature dicts.
+
+    X holds the model's four columns followed by one one-hot column per entry of
+    PERMISSION_COLUMNS. aux holds the per-row heuristic inputs that are not plain
+    counts: [suspicious TLD score, bank package prefix with low name similarity,
+    signer mismatch, verified official signer, extraction budget exceeded,
+    blocklisted domains].
+    masks is the int64 permission bitmask of every row, computed from its current
+    permissions and PERMISSION_BITS (the one-hot columns are read off it).
+    """
+    X = np.zeros((len(rows), MODEL_COLUMNS + len(PERMISSION_COLUMNS)), dtype=np.float64)
+    aux = np.zeros((len(rows), 6), dtype=np.float64)
+    masks = np.array([permission_mask(f.get("permissions") or []) for f in rows], dtype=np.int64)
+    column_bits = np.array([PERMISSION_BIT[p] for p in PERMISSION_COLUMNS], dtype=np.int64)
+    X[:, MODEL_COLUMNS:] = (masks[:, None] & column_bits) != 0
+    for i, features in enumerate(rows):
+        X[i, :MODEL_COLUMNS] = feature_vector(features)
+        urls = features.get("urls") or []
+        if urls:
+            aux[i, 0], aux[i, 5] = url_reputation(urls)
+        pkg = features.get("package") or ""
+        app_name = features.get("app_name")
+        if pkg and app_name and banks.matches_bank_prefix(pkg):
+            aux[i, 1] = 1.0 if banks.similarity(app_name) < 60 else 0.0
+        status = banks.signer_status(pkg, features.get("verified_signers") or [])
+        aux[i, 2] = 1.0 if status == "mismatch" else 0.0
+        aux[i, 3] = 1.0 if status == "official" else 0.0
+        aux[i, 4] = 1.0 if features.get("limits") else 0.0
+    return X, aux, masks
+
+
+def vectorized_heuristic_scores(X: Any, aux: Any, masks: Any) -> Any:
+    """Array form of compute_heuristic_score over the output of build_feature_matrix."""
+    urls = X[:, 1]
+    score = vectorized_permission_points(masks)
+    score += np.minimum(20, 2 * urls)
+    score += np.where(urls > 0, aux[:, 0], 0)
+    score += 15 * aux[:, 1]
+    score += 40 * aux[:, 2]
+    score += 10 * aux[:, 4]
+    score += np.minimum(BLOCKLIST_MAX_POINTS, BLOCKLIST_POINTS * aux[:, 5])
+    return np.clip(score, 0.0, 100.0)
+
+
+def verdicts_for(scores: Any) -> List[str]:
+    return np.select([scores >= 70, scores >= 40], ["MALICIOUS", "SUSPICIOUS"], "SAFE").tolist()
+
+
+def rescore_reports(db: Session, chunk_size: int = RESCORE_CHUNK_SIZE) -> Dict[str, Any]:
+    """Rescores every stored report with the current rules and models.
+
+    Only `score`, `verdict` and `perm_mask` are rewritten; stored reasons keep
+    describing the original analysis. perm_mask is recomputed from the stored
+    permissions, so masks follow PERMISSION_BITS changes.
+    """
+    started = time.time()
+    banks = bank_index.get()
+    total = changed = 0
+    last_id = 0
+    while True:
+        rows = (
+            db.query(Report.id, Report.sha256, Report.features, Report.perm_mask, Report.score, Report.verdict)
+            .filter(Report.id > last_id)
+            .order_by(asc(Report.id))
+            .limit(chunk_size)
+            .all()
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        X, aux, masks = build_feature_matrix([r.features for r in rows], banks)
+        scores = vectorized_heuristic_scores(X, aux, masks)
+
+        # One predict_proba call per model version present in the chunk.
+        groups: Dict[str, List[int]] = {}
+        for i, r in enumerate(rows):
+            groups.setdefault(model_registry.choose(r.sha256), []).append(i)
+        for model_name, idx in groups.items():
+            probs = predict_proba(X[idx, :MODEL_COLUMNS].tolist(), model_name)
+            if probs is not None:
+                scores[idx] = 0.7 * (np.asarray(probs) * 100) + 0.3 * scores[idx]
+        scores = np.where(aux[:, 3] > 0, 0.0, scores)  # verified official signers, as in score_features
+
+        verdicts = verdicts_for(scores)
+        updates = []
+        for r, score, verdict, mask in zip(rows, scores.tolist(), verdicts, masks.tolist()):
+            if verdict != r.verdict or abs(score - r.score) > 1e-9 or mask != r.perm_mask:
+                updates.append({"id": r.id, "score": float(score), "verdict": verdict, "perm_mask": mask})
+        if updates:
+            db.bulk_update_mappings(Report, updates)  # type: ignore
+            db.commit()
+        total += len(rows)
+        changed += len(updates)
+    return {"rescored": total, "changed": changed, "seconds": round(time.time() - started, 3)}
+
+
+# -----------------------------
+# BACKEND: Report search
+# report_search is an FTS5 table (trigram tokenizer, SQLite >= 3.34) whose rowid is the
+# report id. ReportWriter indexes each report in the transaction that inserts it, so
+# searches never decode the features blobs.
+# -----------------------------
+REPORT_SEARCH_FIELDS = {  # query parameter -> indexed column
+    "package": "package",
+    "app_name": "app_name",
+    "url": "urls",
+    "host": "hosts",
+    "subject": "subjects",
+}
+
+
+def search_document(report_id: int, features: Dict[str, Any]) -> Dict[str, Any]:
+    """The report_search row of a report. Multi-valued columns are newline-joined."""
+    urls = features.get("urls") or []
+    return {
+        "rowid": report_id,
+        "package": features.get("package") or "",
+        "app_name": features.get("app_name") or "",
+        "urls": "\n".join(urls),
+        "hosts": "\n".join(sorted({h for h in map(url_host, urls) if h})),
+        "subjects": "\n".join(features.get("signer_subjects") or []),
+    }
+
+
+def create_search_index() -> bool:
+    """Creates report_search; False if this SQLite lacks FTS5 or the trigram tokenizer."""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS report_search "
+                "USING fts5(package, app_name, urls, hosts, subjects, tokenize='trigram')"
+            ))
+        return True
+    except OperationalError:
+        return False
+
+
+FTS5_AVAILABLE = create_search_index()
+
+
+def index_reports(db: Session, docs: List[Tuple[int, Dict[str, Any]]]) -> None:
+    """Adds (report_id, features) pairs to report_search within the caller's transaction."""
+    if FTS5_AVAILABLE and docs:
+        db.execute(
+            text(
+                "INSERT INTO report_search (rowid, package, app_name, urls, hosts, subjects) "
+                "VALUES (:rowid, :package, :app_name, :urls, :hosts, :subjects)"
+            ),
+            [search_document(report_id, features) for report_id, features in docs],
+        )
+
+
+def backfill_search_index(chunk_size: int = 500) -> int:
+    """Indexes reports newer than the last indexed one (e.g. stored before the index existed)."""
+    if not FTS5_AVAILABLE:
+        return 0
+    indexed = 0
+    with SessionLocal() as db:
+        last_id = db.execute(text("SELECT coalesce(max(rowid), 0) FROM report_search")).scalar() or 0
+        while True:
+            rows = (
+                db.query(Report.id, Report.features)
+                .filter(Report.id > last_id)
+                .order_by(asc(Report.id))
+                .limit(chunk_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1].id
+            index_reports(db, [(r.id, r.features) for r in rows])
+            db.commit()
+            indexed += len(rows)
+    return indexed
+
+
+backfill_search_index()
+
+
+def search_patterns(pattern: str) -> Tuple[str, Optional[str]]:
+    """LIKE patterns matching `pattern` anywhere in a column, where `*` matches any run.
+
+    Returns (indexed, exact). `indexed` is a plain LIKE pattern, the only form the
+    trigram index can answer; a `%` or `_` typed by the user is still a wildcard in it,
+    so it matches a superset. `exact` is None when that superset is already exact,
+    otherwise an ESCAPE '\\' pattern in which `%` and `_` match only themselves, to be
+    applied as a residual filter.
+    """
+    indexed = "%" + pattern.replace("*", "%") + "%"
+    if "%" not in pattern and "_" not in pattern:
+        return indexed, None
+    escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return indexed, "%" + escaped.replace("*", "%") + "%"
+
+
+def search_query(q: Optional[str], patterns: Dict[str, str], limit: int) -> Tuple[str, Dict[str, Any]]:
+    """The SQL and parameters of a /reports/search request. `patterns` maps query
+    parameters of REPORT_SEARCH_FIELDS to their raw values."""
+    where: List[str] = []
+    params: Dict[str, Any] = {"limit": limit}
+    if q:
+        where.append("report_search MATCH :q")
+        params["q"] = q
+    for name, value in patterns.items():
+        column = f"report_search.{REPORT_SEARCH_FIELDS[name]}"
+        params[name], exact = search_patterns(value)
+        where.append(f"{column} LIKE :{name}")
+        if exact is not None:
+            where.append(f"{column} LIKE :{name}_exact ESCAPE '\\'")
+            params[f"{name}_exact"] = exact
+    sql = (
+        "SELECT r.id, r.sha256, r.filename, r.size_bytes, r.score, r.verdict, r.created_at, "
+        "report_search.package, report_search.app_name "
+        "FROM report_search JOIN reports AS r ON r.id = report_search.rowid "
+        f"WHERE {' AND '.join(where)} ORDER BY {'report_search.rank, ' if q else ''}r.id DESC LIMIT :limit"
+    )
+    return sql, params
+
+
+def report_row(
+    filename: str,
+    digest: str,
+    size: int,
+    features: Dict[str, Any],
+    score: float,
+    verdict: str,
+    reasons: List[Reason]
+) -> Dict[str, Any]:
+    """Column values of the Report row for a finished analysis.
+
+    `minhash` is left to the writer thread (see ReportWriter.write), off the event loop.
+    """
+    return {
+        "filename": filename,
+        "sha256": digest,
+        "size_bytes": size,
+        "verdict": verdict,
+        "score": float(score),
+        "reasons": [r.dict() for r in reasons],
+        "features": features,
+        "perm_mask": permission_mask(features.get("permissions") or []),
+        "created_at": dt.datetime.utcnow(),
+    }
+
+
+class ReportWriter:
+    """Write-behind Report persistence: one thread group-commits queued inserts.
+
+    Callers get a Future of the new row's id. A batch is committed as one transaction;
+    if it hits the sha256 unique constraint, its rows are retried one by one and a
+    duplicate resolves to the id of the stored report. Until report_codec has a
+    dictionary, the thread trains one as soon as REPORT_DICT_MIN_SAMPLES reports exist.
+    """
+
+    def __init__(self, batch_size: int = REPORT_WRITE_BATCH, delay: float = REPORT_WRITE_DELAY):
+        self.batch_size = batch_size
+        self.delay = delay
+        self.untrained_rows = 0  # rows written while there was no dictionary
+        self.train_at = 0  # untrained_rows at which the report count is checked again
+        self.queue: "queue.Queue[Optional[Tuple[Dict[str, Any], Future]]]" = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="report-writer", daemon=True)
+                self.thread.start()
+
+    def stop(self) -> None:
+        """Flushes everything queued so far, then stops the thread."""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def submit(self, row: Dict[str, Any]) -> Future:
+        fut: Future = Future()
+        self.start()
+        self.queue.put((row, fut))
+        return fut
+
+    async def save(
+        self,
+        filename: str,
+        digest: str,
+        size: int,
+        features: Dict[str, Any],
+        score: float,
+        verdict: str,
+        reasons: List[Reason]
+    ) -> int:
+        """Queues a finished analysis and returns the stored report's id once committed."""
+        row = report_row(filename, digest, size, features, score, verdict, reasons)
+        return await asyncio.wrap_future(self.submit(row))
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.delay
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self.write(batch)
+            if stop:
+                return
+
+    def write(self, batch: List[Tuple[Dict[str, Any], Future]]) -> None:
+        try:
+            for row, _ in batch:
+                row["minhash"] = minhash_signature(row["features"])
+                row["minhash_version"] = MINHASH_TOKEN_VERSION
+            with SessionLocal() as db:
+                reports = [Report(**row) for row, _ in batch]
+                db.add_all(reports)
+                try:
+                    db.flush()
+                    ids = [r.id for r in reports]
+                    index_reports(db, [(report_id, row["features"]) for report_id, (row, _) in zip(ids, batch)])
+                    db.commit()
+                except IntegrityError:
+                    db.rollback()
+                    ids = [self.write_one(db, row) for row, _ in batch]
+            for (row, fut), report_id in zip(batch, ids):
+                similarity_index.add(report_id, row["minhash"])
+                fut.set_result(report_id)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        try:
+            self.maybe_train(len(batch))
+        except Exception:
+            pass  # only compression is lost; retried after the next REPORT_DICT_MIN_SAMPLES rows
+
+    def maybe_train(self, written: int) -> None:
+        """Trains the first report_codec dictionary once enough reports are stored."""
+        if not ZSTD_AVAILABLE or report_codec.active_id:
+            return
+        self.untrained_rows += written
+        if self.untrained_rows < self.train_at:
+            return
+        # Checked again after this many more rows, also if training fails or finds too few.
+        self.train_at = self.untrained_rows + REPORT_DICT_MIN_SAMPLES
+        with SessionLocal() as db:
+            count = db.query(func.count(Report.id)).scalar() or 0
+        if count >= REPORT_DICT_MIN_SAMPLES:
+            train_report_dictionary()
+        else:
+            self.train_at = self.untrained_rows + REPORT_DICT_MIN_SAMPLES - count
+
+    @staticmethod
+    def write_one(db: Session, row: Dict[str, Any]) -> int:
+        report = Report(**row)
+        db.add(report)
+        try:
+            db.flush()
+            report_id = report.id
+            index_reports(db, [(report_id, row["features"])])
+            db.commit()
+            return report_id
+        except IntegrityError:
+            db.rollback()
+            existing = db.query(Report.id).filter(Report.sha256 == row["sha256"]).first()
+            if existing is None:
+                raise
+            return existing.id
+
+
+report_writer = ReportWriter()
+
+
+def unpack_apk_bundle(
+    path: str,
+    limit: int = BATCH_MAX_ITEMS
+) -> Optional[List[Tuple[str, Optional[str], str, int, Optional[str]]]]:
+    """Splits a ZIP of APKs into spooled members.
+
+    Returns None when `path` is not a bundle (a plain APK or not a ZIP at all), otherwise
+    a list of (member_name, temp_path, sha256, size, error) tuples. The bundle is removed.
+    Members after the first `limit` are not spooled; they get a BATCH_LIMIT_ERROR tuple.
+    """
     try:
-        model = joblib.load(model_path)
-    except Exception:
+        with zipfile.ZipFile(path) as z:
+            names = z.namelist()
+            if MANIFEST_NAME in names:
+                return None
+            members = [i for i in z.infolist() if not i.is_dir() and i.filename.lower().endswith(".apk")]
+            if not members:
+                return None
+            out: List[Tuple[str, Optional[str], str, int, Optional[str]]] = []
+            for i, info in enumerate(members):
+                name = os.path.basename(info.filename)
+                if i >= limit:
+                    out.append((name, None, "", 0, BATCH_LIMIT_ERROR))
+                    continue
+                try:
+                    with z.open(info) as src:
+                        tmp_path, digest, size = spool_fileobj(src)
+                    out.append((name, tmp_path, digest, size, None))
+                except HTTPException as e:
+                    out.append((name, None, "", 0, str(e.detail)))
+                except Exception as e:
+                    out.append((name, None, "", 0, str(e) or type(e).__name__))
+    except zipfile.BadZipFile:
+        return None
+    os.remove(path)
+    return out
+
+
+def official_bank_refs(db: Session) -> Tuple[List[str], List[str]]:
+    """Returns (names, packages) of the official bank references."""
+    banks = db.query(BankRef).filter(BankRef.official == True).all()
+    return [b.name for b in banks], [b.package for b in banks]
+
+
+def official_bank_signers(db: Session) -> Dict[str, List[str]]:
+    """Maps each official bank package to its registered signer fingerprints."""
+    rows = (
+        db.query(BankRef.package, BankSigner.fingerprint)
+        .join(BankSigner, BankSigner.bank_id == BankRef.id)
+        .filter(BankRef.official == True)
+        .all()
+    )
+    out: Dict[str, List[str]] = {}
+    for package, fingerprint in rows:
+        out.setdefault(package, []).append(fingerprint)
+    return out
+
+
+def verified_official_features(archive: ApkArchive, banks: BankIndex) -> Optional[Dict[str, Any]]:
+    """Manifest-level features if the APK is verifiably signed by its bank's registered key.
+
+    Runs on the header pass only; None means the full analysis is needed. The signature
+    is only verified when one of the APK's certificates is a registered signer at all.
+    """
+    if archive.manifest is None or not any(fp in banks.signer_packages for fp in archive.signers):
         return None
-    perms = set(features.get("permissions") or [])
-    vec = [
-        len(perms & DANGEROUS_PERMS),
-        len(features.get("urls") or []),
-        1 if "android.permission.BIND_ACCESSIBILITY_SERVICE" in perms else 0,
-        1 if "android.permission.SYSTEM_ALERT_WINDOW" in perms else 0,
-    ]
     try:
-        if hasattr(model, "predict_proba"):
-            proba = float(model.predict_proba([vec])[0][1])  # type: ignore
-        else:
-            d = float(model.decision_function([vec])[0])  # type: ignore
-            proba = 1.0 / (1.0 + math.exp(-d))
-        return proba
+        manifest = parse_manifest(archive.manifest, archive.resources)
     except Exception:
         return None
+    verified = archive.verified_signers()
+    if banks.signer_status(manifest.get("package") or "", verified) != "official":
+        return None
+    out = archive_features(archive)
+    out.update(manifest)
+    out["certificates"] = [f for f in archive.files if SIGNATURE_FILE_REGEX.match(f)]
+    out["verified_signers"] = verified
+    return out
+
+
+def claimed_verified_signers(archive: ApkArchive, banks: BankIndex, pkg: str) -> List[str]:
+    """archive.verified_signers() when `pkg` falls under a bank with registered signers,
+    else [] without hashing the APK: the signer status is None either way."""
+    if banks.signer_status(pkg, []) is None:
+        return []
+    return archive.verified_signers()
+
+
+def analyze_file(
+    path: str,
+    bank_version: Optional[int] = None,
+    model_name: str = DEFAULT_MODEL_NAME
+) -> Tuple[Dict[str, Any], float, str, List[Reason]]:
+    """Runs the full CPU-bound analysis of a stored APK. Executed inside an engine worker.
+
+    `bank_version` is the caller's bank index version, so workers rebuild their own
+    copy of the index after /banks writes.
+    """
+    banks = bank_index.get(bank_version)
+    cache = entry_cache if ENTRY_CACHE_ENABLED else None
+    with ApkArchive.open(path, cache=cache, walk=False) as archive:
+        # A known-good signer skips the entry walk and DEX parsing entirely.
+        features = verified_official_features(archive, banks)
+        if features is None:
+            archive.walk(cache)
+            features = extract_features(archive)
+            features["verified_signers"] = claimed_verified_signers(archive, banks, features.get("package") or "")
+    score, verdict, reasons = score_features(features, banks, model_name)
+    return features, score, verdict, reasons
+
+
+def analyze_sample(
+    digest: str,
+    bank_version: Optional[int] = None,
+    model_name: str = DEFAULT_MODEL_NAME
+) -> Tuple[Dict[str, Any], float, str, List[Reason]]:
+    """analyze_file for a sample in the store. Executed inside an engine worker."""
+    with sample_store.local_path(digest) as path:
+        return analyze_file(path, bank_version, model_name)
+
+
+# Streamed analyses run these steps in order; each reopens the stored APK (the header
+# pass is cheap) so the event loop can report progress between them. The steps hand one
+# ExtractionBudget state along, so together they get the budget of a single analysis.
+ANALYSIS_STAGES = ("manifest", "resources", "dex")
+
+
+def is_dex_entry(info: zipfile.ZipInfo) -> bool:
+    return bool(DEX_NAME_REGEX.match(info.filename))
+
+
+def analyze_stage(
+    path: str,
+    stage: str,
+    bank_version: Optional[int] = None,
+    budget: Optional[Dict[str, Any]] = None
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """(features, budget state) of one ANALYSIS_STAGES step. Executed inside an engine worker.
+
+    "manifest" returns the manifest-level features with `verified_signers` (or the
+    complete features of a verified official APK); "resources" and "dex" return
+    the archive features of the non-DEX and DEX entries respectively. `budget` is
+    the state returned by the previous step.
+    """
+    banks = bank_index.get(bank_version)
+    cache = entry_cache if ENTRY_CACHE_ENABLED else None
+    shared = ExtractionBudget.resume(budget) if budget else ExtractionBudget()
+    with ApkArchive.open(path, cache=cache, walk=False, budget=shared) as archive:
+        if stage == "manifest":
+            features = verified_official_features(archive, banks)
+            if features is None:
+                features = extract_features(archive)
+                features["verified_signers"] = claimed_verified_signers(archive, banks, features.get("package") or "")
+        else:
+            if stage == "dex":
+                archive.walk(cache, select=is_dex_entry)
+            else:
+                archive.walk(cache, select=lambda info: not is_dex_entry(info))
+            features = archive_features(archive)
+        return features, shared.state()
+
+
+def merge_stage_features(features: Dict[str, Any], partial: Dict[str, Any]) -> Dict[str, Any]:
+    """Adds a "resources"/"dex" step's archive features to the features gathered so far.
+
+    The step's `limits` replace the earlier ones: the budget it ran on includes theirs.
+    """
+    out = dict(features)
+    for key in ("urls", "api_calls", "dex_packages"):
+        out[key] = sorted(set(features.get(key) or []) | set(partial.get(key) or []))
+    out["limits"] = list(partial.get("limits") or [])
+    out["dex"] = {**(features.get("dex") or {}), **(partial.get("dex") or {})}
+    return out
+
+
+# -----------------------------
+# BACKEND: Analysis engine
+# CPU-bound extraction runs in a pool of worker processes so a large APK never blocks
+# the event loop. Submissions beyond ANALYSIS_MAX_PENDING are rejected with 503.
+# -----------------------------
+def warm_worker() -> None:
+    """Process-pool initializer: imports the heavy parsers once per worker."""
+    if ANDROGUARD_AVAILABLE and ANALYSIS_DEEP:
+        import androguard.core.bytecodes.apk  # type: ignore  # noqa: F401
+    if APKUTILS_AVAILABLE:
+        import apkutils2  # type: ignore  # noqa: F401
+
+
+def _noop() -> None:
+    return None
+
+
+class AnalysisEngine:
+    """Bounded front door to a ProcessPoolExecutor (or the thread pool when workers == 0)."""
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self) -> None:
+        if self.workers <= 0 or self.executor is not None:
+            return
+        self.executor = self.new_executor()
+
+    def new_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context(ANALYSIS_MP_CONTEXT),
+            initializer=warm_worker,
+        )
+        # Workers start lazily; push one no-op per worker so imports happen before traffic.
+        for _ in range(self.workers):
+            executor.submit(_noop)
+        return executor
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, fn, *args):
+        """Runs fn(*args) off the event loop, or raises 503 with Retry-After when saturated.
+
+        A worker that dies (OOM kill, crash in a parser) breaks the whole pool: the pool
+        is replaced and every call that was running on it gets a 503 as well.
+        """
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=503,
+                detail="Analysis queue is full, retry later",
+                headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)},
+            )
+        self.pending += 1
+        try:
+            executor = self.executor
+            if executor is None:
+                return await run_in_threadpool(fn, *args)
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(executor, fn, *args)
+            except BrokenProcessPool:
+                # Only the first caller to notice replaces it; the rest share the new pool.
+                if self.executor is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self.new_executor()
+                raise HTTPException(
+                    status_code=503,
+                    detail="Analysis worker crashed, retry later",
+                    headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)},
+                )
+        finally:
+            self.pending -= 1
+
+
+analysis_engine = AnalysisEngine(ANALYSIS_WORKERS, ANALYSIS_MAX_PENDING)
+
+
+# -----------------------------
+# BACKEND: Single-flight analysis
+# Concurrent uploads of the same sample share one analysis. Within a process callers
+# await the same future; across processes on the same database the analysis_locks row
+# elects one owner and the others poll until its Report exists.
+# -----------------------------
+# The owner renews its lock every ANALYSIS_LOCK_RENEW seconds while it runs; a lock not
+# renewed for ANALYSIS_LOCK_TTL is assumed abandoned by a crashed process.
+ANALYSIS_LOCK_TTL = 2 * EXTRACT_DEADLINE
+ANALYSIS_LOCK_RENEW = ANALYSIS_LOCK_TTL / 4
+ANALYSIS_LOCK_POLL = 0.5
+
+
+def report_id_for(digest: str) -> Optional[int]:
+    with SessionLocal() as db:
+        row = db.query(Report.id).filter(Report.sha256 == digest).first()
+        return row.id if row else None
+
+
+class SingleFlight:
+    """At most one in-flight analysis per sha256.
+
+    The analysis_locks queries are synchronous, so they run in the thread pool.
+    """
+
+    def __init__(self):
+        self.inflight: Dict[str, "asyncio.Future[int]"] = {}
+        self.owner = uuid.uuid4().hex
+
+    async def run(self, digest: str, analyze: Callable[[], Awaitable[int]]) -> int:
+        """Returns the id of the sample's Report, calling `analyze` (which must save it and
+        return its id) only when no other request or process is already doing so.
+
+        Waiters see the owner's exception if it fails; if the owner is cancelled, one of
+        them takes over.
+        """
+        while True:
+            fut = self.inflight.get(digest)
+            if fut is None:
+                break
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())  # no "never retrieved" noise
+        self.inflight[digest] = fut
+        try:
+            report_id = await self.run_locked(digest, analyze)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(report_id)
+            return report_id
+        finally:
+            del self.inflight[digest]
+
+    async def run_locked(self, digest: str, analyze: Callable[[], Awaitable[int]]) -> int:
+        while True:
+            report_id = await run_in_threadpool(report_id_for, digest)
+            if report_id is not None:
+                return report_id
+            if await run_in_threadpool(self.acquire, digest):
+                heartbeat = asyncio.ensure_future(self.hold(digest))
+                try:
+                    # Another process may have finished between the lookup and the lock.
+                    report_id = await run_in_threadpool(report_id_for, digest)
+                    return report_id if report_id is not None else await analyze()
+                finally:
+                    heartbeat.cancel()
+                    # Shielded so a cancelled owner still frees the lock for the others.
+                    await asyncio.shield(run_in_threadpool(self.release, digest))
+            await asyncio.sleep(ANALYSIS_LOCK_POLL)
+
+    async def hold(self, digest: str) -> None:
+        while True:
+            await asyncio.sleep(ANALYSIS_LOCK_RENEW)
+            await run_in_threadpool(self.renew, digest)
+
+    def acquire(self, digest: str) -> bool:
+        now = dt.datetime.utcnow()
+        with engine.begin() as conn:
+            conn.execute(
+                AnalysisLock.__table__.delete().where(
+                    AnalysisLock.sha256 == digest,
+                    AnalysisLock.acquired_at < now - dt.timedelta(seconds=ANALYSIS_LOCK_TTL),
+                )
+            )
+            result = conn.execute(
+                sqlite_insert(AnalysisLock).on_conflict_do_nothing(),
+                {"sha256": digest, "owner": self.owner, "acquired_at": now},
+            )
+            return result.rowcount == 1
+
+    def renew(self, digest: str) -> None:
+        with engine.begin() as conn:
+            conn.execute(
+                AnalysisLock.__table__.update()
+                .where(AnalysisLock.sha256 == digest, AnalysisLock.owner == self.owner)
+                .values(acquired_at=dt.datetime.utcnow())
+            )
+
+    def release(self, digest: str) -> None:
+        with engine.begin() as conn:
+            conn.execute(
+                AnalysisLock.__table__.delete().where(AnalysisLock.sha256 == digest, AnalysisLock.owner == self.owner)
+            )
+
+
+single_flight = SingleFlight()
+
+
+# -----------------------------
+# BACKEND: Job queue
+# Jobs are persisted in the `jobs` table so queued work survives restarts. Runner tasks
+# claim queued rows with a conditional UPDATE, which keeps several server processes
+# from picking up the same job.
+# -----------------------------
+JOB_RUNNERS = int(os.environ.get("JOB_RUNNERS", max(ANALYSIS_WORKERS, 1)))
+JOB_POLL_INTERVAL = 2.0
+
+
+class JobRunner:
+    """Background tasks that drain the `jobs` table through the analysis engine.
+
+    Their `jobs` table queries run in the thread pool, off the event loop.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.wakeup = asyncio.Event()
+        self.tasks: List["asyncio.Task[None]"] = []
+
+    def start(self) -> None:
+        with SessionLocal() as db:
+            # Jobs left running by a previous process never finished; run them again.
+            db.query(AnalysisJob).filter(AnalysisJob.status == "running").update(
+                {"status": "queued", "updated_at": dt.datetime.utcnow()}
+            )
+            db.commit()
+        self.tasks = [asyncio.create_task(self.loop()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def claim(self) -> Optional[int]:
+        """Atomically moves the oldest queued job to `running` and returns its id."""
+        with SessionLocal() as db:
+            ids = [
+                row[0] for row in db.query(AnalysisJob.id)
+                .filter(AnalysisJob.status == "queued")
+                .order_by(asc(AnalysisJob.id))
+                .limit(self.concurrency + 1)
+            ]
+            for job_id in ids:
+                claimed = db.query(AnalysisJob).filter(
+                    AnalysisJob.id == job_id, AnalysisJob.status == "queued"
+                ).update({"status": "running", "updated_at": dt.datetime.utcnow()})
+                db.commit()
+                if claimed:
+                    return job_id
+        return None
+
+    def finish(self, job_id: int, status: str, report_id: Optional[int] = None, error: Optional[str] = None) -> None:
+        with SessionLocal() as db:
+            db.query(AnalysisJob).filter(AnalysisJob.id == job_id).update(
+                {"status": status, "report_id": report_id, "error": error, "updated_at": dt.datetime.utcnow()}
+            )
+            db.commit()
+
+    async def loop(self) -> None:
+        while True:
+            self.wakeup.clear()
+            job_id = await run_in_threadpool(self.claim)
+            if job_id is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await run_in_threadpool(self.finish, job_id, "failed", None, str(e) or type(e).__name__)
+
+    @staticmethod
+    def load(job_id: int) -> Tuple[str, str, int, Optional[int]]:
+        """(filename, sha256, size, id of an existing report) of a claimed job."""
+        with SessionLocal() as db:
+            job = cast(AnalysisJob, db.query(AnalysisJob).filter(AnalysisJob.id == job_id).first())
+            existing = db.query(Report.id).filter(Report.sha256 == job.sha256).first()
+            return job.filename, job.sha256, job.size_bytes, existing.id if existing else None
+
+    async def process(self, job_id: int) -> None:
+        filename, digest, size, existing_id = await run_in_threadpool(self.load, job_id)
+        if existing_id is not None:
+            await run_in_threadpool(self.finish, job_id, "done", existing_id)
+            return
+
+        async def analyze() -> int:
+            features, score, verdict, reasons = await analysis_engine.run(
+                analyze_sample, digest, bank_index.version, model_registry.choose(digest)
+            )
+            return await report_writer.save(filename, digest, size, features, score, verdict, reasons)
+
+        try:
+            report_id = await single_flight.run(digest, analyze)
+        except HTTPException as e:
+            if e.status_code != 503:
+                raise
+            # Engine saturated by direct /analyze traffic: put the job back and back off.
+            await run_in_threadpool(self.finish, job_id, "queued")
+            await asyncio.sleep(ANALYSIS_RETRY_AFTER)
+            return
+        except zipfile.BadZipFile:
+            sample_store.delete(digest)
+            await run_in_threadpool(self.finish, job_id, "failed", None, "File is not a valid APK/ZIP archive")
+            return
+        await run_in_threadpool(self.finish, job_id, "done", report_id)
+
+
+job_runner = JobRunner(JOB_RUNNERS)
+
+
+@app.on_event("startup")
+def start_analysis_engine():
+    domain_reputation.load()  # compiles changed domain lists before workers look them up
+    analysis_engine.start()
+    report_writer.start()
+    job_runner.start()
+
+
+@app.on_event("shutdown")
+async def stop_analysis_engine():
+    await job_runner.stop()
+    analysis_engine.shutdown()
+    await run_in_threadpool(report_writer.stop)
 
 
 # -----------------------------
@@ -452,7 +4121,14 @@ def model_predict_probability(features: Dict[str, Any]) -> Optional[float]:
 @app.get("/health")
 def health():
     """Health check endpoint to ensure the backend is running."""
-    return {"ok": True, "androguard": ANDROGUARD_AVAILABLE, "apkutils": APKUTILS_AVAILABLE}
+    return {
+        "ok": True,
+        "androguard": ANDROGUARD_AVAILABLE,
+        "apkutils": APKUTILS_AVAILABLE,
+        "deep_mode": ANALYSIS_DEEP,
+        "analysis_workers": analysis_engine.workers,
+        "analysis_pending": analysis_engine.pending,
+    }
 
 
 @app.post("/analyze", response_model=AnalysisResult)
@@ -460,95 +4136,460 @@ async def analyze_apk(file: UploadFile = File(...), db: Session = Depends(get_db
     """Analyzes an uploaded APK file and returns a security report."""
     if file.content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(status_code=400, detail=f"Unsupported content type: {file.content_type}")
-    content = await file.read()
-    if len(content) > MAX_UPLOAD_SIZE:
-        raise HTTPException(status_code=413, detail="File too large")
-    try:
-        zipfile.ZipFile(io.BytesIO(content)).testzip()
-    except Exception:
-        raise HTTPException(status_code=400, detail="File is not a valid APK/ZIP archive")
+    tmp_path, digest, size = await spool_upload(file)
+    existing = db.query(Report).filter(Report.sha256 == digest).first()
+    if existing:
+        os.remove(tmp_path)
+        return report_to_result(cast(Report, existing))
+
+    await sample_store.put(tmp_path, digest)
+    safe_name = os.path.basename(file.filename or f"upload_{int(time.time())}.apk")
+
+    async def analyze() -> int:
+        try:
+            features, score, verdict, reasons = await analysis_engine.run(
+                analyze_sample, digest, bank_index.version, model_registry.choose(digest)
+            )
+        except zipfile.BadZipFile:
+            sample_store.delete(digest)
+            raise HTTPException(status_code=400, detail="File is not a valid APK/ZIP archive")
+        return await report_writer.save(safe_name, digest, size, features, score, verdict, reasons)
+
+    # Concurrent uploads of the same sample wait for this analysis instead of repeating it.
+    report_id = await single_flight.run(digest, analyze)
+    return report_to_result(cast(Report, db.query(Report).filter(Report.id == report_id).first()))
+
+
+@app.post("/analyze/stream")
+async def analyze_apk_stream(
+    file: UploadFile = File(...),
+    format: str = Query("ndjson"),
+    db: Session = Depends(get_db),
+):
+    """Analyzes an APK in stages, streaming an AnalysisProgress after each one.
+
+    The first line is a provisional heuristic verdict from the manifest alone
+    (permissions, package and name similarity); URL scanning and DEX parsing refine it,
+    and the last line, with `final` set, carries the stored report including the ML
+    score. `format=sse` wraps each line as a Server-Sent Event.
+    """
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'")
+    if file.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported content type: {file.content_type}")
+    tmp_path, digest, size = await spool_upload(file)
+    safe_name = os.path.basename(file.filename or f"upload_{int(time.time())}.apk")
+
+    def event(progress: AnalysisProgress) -> str:
+        line = progress.json()
+        return f"event: {progress.stage}\ndata: {line}\n\n" if format == "sse" else line + "\n"
 
-    digest = sha256_bytes(content)
+    def final_event(report: Report) -> str:
+        result = report_to_result(report)
+        return event(AnalysisProgress(
+            stage="final", final=True, sha256=digest, score=result.score, verdict=result.verdict,
+            reasons=result.reasons, features=result.features, report=result,
+        ))
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
     existing = db.query(Report).filter(Report.sha256 == digest).first()
     if existing:
-        existing = cast(Report, existing)
-        return AnalysisResult(
-            sha256=existing.sha256,
-            filename=existing.filename,
-            size_bytes=existing.size_bytes,
-            score=existing.score,
-            verdict=existing.verdict,
-            reasons=[Reason(**r) for r in json.loads(existing.reasons)],
-            features=json.loads(existing.features),
-            created_at=existing.created_at,
+        os.remove(tmp_path)
+        line = final_event(cast(Report, existing))
+        return StreamingResponse(iter([line]), media_type=media_type)
+
+    await sample_store.put(tmp_path, digest)
+    version = bank_index.version
+    banks = bank_index.get(version)
+    # Progress lines of the analysis, if this request runs it; None once it has ended.
+    lines: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    latest: Optional[AnalysisProgress] = None
+
+    def publish(progress: AnalysisProgress) -> None:
+        nonlocal latest
+        latest = progress
+        lines.put_nowait(event(progress))
+
+    async def analyze() -> int:
+        # Every step reads the same plain copy (the blob itself unless it is compressed).
+        out_path, is_temp = await run_in_threadpool(sample_store.checkout, digest)
+        try:
+            return await analyze_stages(out_path)
+        finally:
+            sample_store.checkin(out_path, is_temp)
+
+    async def analyze_stages(out_path: str) -> int:
+        try:
+            features, budget = await analysis_engine.run(analyze_stage, out_path, "manifest", version)
+        except zipfile.BadZipFile:
+            sample_store.delete(digest)
+            raise HTTPException(status_code=400, detail="File is not a valid APK/ZIP archive")
+        official = banks.signer_status(features.get("package") or "", features.get("verified_signers") or [])
+        stages = [] if official == "official" else list(ANALYSIS_STAGES[1:])
+        if stages:
+            score, reasons = compute_heuristic_score(features, banks)
+            publish(AnalysisProgress(
+                stage="manifest", sha256=digest, score=score, verdict=verdict_for_score(score),
+                reasons=reasons, features=features,
+            ))
+        for stage in stages:
+            try:
+                partial, budget = await analysis_engine.run(analyze_stage, out_path, stage, version, budget)
+            except Exception as e:
+                publish(AnalysisProgress(
+                    stage=stage, sha256=digest, score=score, verdict=verdict_for_score(score),
+                    reasons=reasons, features=features, error=str(getattr(e, "detail", "")) or str(e) or type(e).__name__,
+                ))
+                raise
+            features = merge_stage_features(features, partial)
+            score, reasons = compute_heuristic_score(features, banks)
+            publish(AnalysisProgress(
+                stage=stage, sha256=digest, score=score, verdict=verdict_for_score(score),
+                reasons=reasons, features=features,
+            ))
+        final_score, verdict, final_reasons = await run_in_threadpool(
+            score_features, features, banks, model_registry.choose(digest)
         )
+        return await report_writer.save(safe_name, digest, size, features, final_score, verdict, final_reasons)
 
-    features = extract_features(content)
-    banks = db.query(BankRef).filter(BankRef.official == True).all()
-    bank_names = [b.name for b in banks]
-    bank_packages = [b.package for b in banks]
+    # A concurrent upload of the same sample (streamed or not) is awaited, not repeated;
+    # this request then only streams the final line.
+    task = asyncio.ensure_future(single_flight.run(digest, analyze))
+    task.add_done_callback(lambda _: lines.put_nowait(None))
+    # The manifest step ends before the response starts, so a bad upload is still a 400.
+    first = await lines.get()
+    if first is None:
+        report_id = await task
+        with SessionLocal() as s:
+            line = final_event(cast(Report, s.query(Report).filter(Report.id == report_id).first()))
+        return StreamingResponse(iter([line]), media_type=media_type)
 
-    h_score, reasons = compute_heuristic_score(features, bank_names, bank_packages)
-    proba = model_predict_probability(features)
-    if proba is not None:
-        ml_score = float(proba * 100)
-        reasons.append(Reason(code="ml_probability", detail=f"ML model risk probability: {ml_score:.1f}/100"))
-        score = 0.7 * ml_score + 0.3 * h_score
-    else:
-        score = h_score
+    async def stream():
+        line = first
+        try:
+            while line is not None:
+                yield line
+                line = await lines.get()
+            try:
+                report_id = await task
+            except Exception as e:
+                if latest is not None and latest.error is None:
+                    error = str(getattr(e, "detail", "")) or str(e) or type(e).__name__
+                    yield event(latest.copy(update={"error": error}))
+                return
+            with SessionLocal() as s:
+                yield final_event(cast(Report, s.query(Report).filter(Report.id == report_id).first()))
+        finally:
+            # A disconnected client stops the analysis; a waiting request takes it over.
+            if not task.done():
+                task.cancel()
 
-    verdict = "SAFE"
-    if score >= 70:
-        verdict = "MALICIOUS"
-    elif score >= 40:
-        verdict = "SUSPICIOUS"
+    return StreamingResponse(stream(), media_type=media_type)
+
+
+@app.post("/analyze/batch")
+async def analyze_batch(files: List[UploadFile] = File(...)):
+    """Analyzes many APKs (or ZIP bundles of APKs) in one request.
+
+    Samples are deduplicated by sha256 within the batch and against stored reports;
+    only unknown samples are sent to the analysis engine, in parallel. One NDJSON
+    line per input APK is streamed back as soon as its result is available. Inputs
+    beyond BATCH_MAX_ITEMS are not analyzed and come back as "error" lines.
+    """
+    # (filename, temp_path, sha256, size, error)
+    items: List[Tuple[str, Optional[str], str, int, Optional[str]]] = []
+    for f in files:
+        name = os.path.basename(f.filename or f"upload_{int(time.time())}.apk")
+        remaining = BATCH_MAX_ITEMS - len(items)
+        if remaining <= 0:
+            items.append((name, None, "", 0, BATCH_LIMIT_ERROR))
+            continue
+        if f.content_type not in BATCH_CONTENT_TYPES:
+            items.append((name, None, "", 0, f"Unsupported content type: {f.content_type}"))
+            continue
+        try:
+            tmp_path, digest, size = await spool_upload(f)
+        except HTTPException as e:
+            items.append((name, None, "", 0, str(e.detail)))
+            continue
+        members = await run_in_threadpool(unpack_apk_bundle, tmp_path, remaining)
+        if members is None:
+            items.append((name, tmp_path, digest, size, None))
+        else:
+            items.extend(members)
+
+    # Group by digest: each unique sample is looked up / analyzed once.
+    by_digest: Dict[str, List[str]] = {}
+    first: Dict[str, Tuple[str, str, int]] = {}
+    for name, tmp_path, digest, size, error in items:
+        if error or tmp_path is None:
+            continue
+        if digest in by_digest:
+            os.remove(tmp_path)
+        else:
+            first[digest] = (name, tmp_path, size)
+        by_digest.setdefault(digest, []).append(name)
+
+    known_results = await run_in_threadpool(load_results, list(by_digest))
+    for digest, (_, tmp_path, _) in first.items():
+        if digest in known_results:
+            os.remove(tmp_path)
+        else:
+            await sample_store.put(tmp_path, digest)
+
+    async def analyze_one(digest: str) -> Tuple[str, Optional[AnalysisResult], Optional[str]]:
+        name, _, size = first[digest]
+
+        async def analyze() -> int:
+            while True:
+                try:
+                    features, score, verdict, reasons = await analysis_engine.run(
+                        analyze_sample, digest, bank_index.version, model_registry.choose(digest)
+                    )
+                    break
+                except HTTPException as e:
+                    if e.status_code != 503:
+                        raise
+                    await asyncio.sleep(ANALYSIS_RETRY_AFTER)
+            return await report_writer.save(name, digest, size, features, score, verdict, reasons)
+
+        try:
+            report_id = await single_flight.run(digest, analyze)
+        except HTTPException as e:
+            return digest, None, str(e.detail)
+        except zipfile.BadZipFile:
+            sample_store.delete(digest)
+            return digest, None, "File is not a valid APK/ZIP archive"
+        except Exception as e:
+            return digest, None, str(e) or type(e).__name__
+        return digest, await run_in_threadpool(load_result, report_id), None
+
+    async def stream():
+        for name, _, digest, _, error in items:
+            if error:
+                yield BatchItem(filename=name, status="error", error=error).json() + "\n"
+        for digest, result in known_results.items():
+            for name in by_digest[digest]:
+                yield BatchItem(filename=name, sha256=digest, status="cached", report=result).json() + "\n"
+        pending = [asyncio.ensure_future(analyze_one(d)) for d in by_digest if d not in known_results]
+        try:
+            for fut in asyncio.as_completed(pending):
+                digest, result, error = await fut
+                for name in by_digest[digest]:
+                    if result is not None:
+                        yield BatchItem(filename=name, sha256=digest, status="analyzed", report=result).json() + "\n"
+                    else:
+                        yield BatchItem(filename=name, sha256=digest, status="error", error=error).json() + "\n"
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
 
+
+@app.post("/jobs", response_model=JobOut)
+async def create_job(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """Queues an uploaded APK for background analysis and returns the job immediately."""
+    if file.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported content type: {file.content_type}")
+    tmp_path, digest, size = await spool_upload(file)
     safe_name = os.path.basename(file.filename or f"upload_{int(time.time())}.apk")
-    out_path = os.path.join(UPLOAD_DIR, f"{digest}.apk")
-    with open(out_path, "wb") as f:
-        f.write(content)
-
-    report = Report(
-        filename=safe_name,
-        sha256=digest,
-        size_bytes=len(content),
-        verdict=verdict,
-        score=float(score),
-        reasons=json.dumps([r.dict() for r in reasons]),
-        features=json.dumps(features),
-        created_at=dt.datetime.utcnow(),
-    )
-    db.add(report)
+    existing = db.query(Report).filter(Report.sha256 == digest).first()
+    if existing:
+        os.remove(tmp_path)
+        job = AnalysisJob(sha256=digest, filename=safe_name, size_bytes=size, status="done", report_id=existing.id)
+    else:
+        await sample_store.put(tmp_path, digest)
+        job = AnalysisJob(sha256=digest, filename=safe_name, size_bytes=size, status="queued")
+    db.add(job)
     db.commit()
-    db.refresh(report)
+    db.refresh(job)
+    if job.status == "queued":
+        job_runner.notify()
+    return job_to_out(cast(AnalysisJob, job), cast(Optional[Report], existing))
+
+
+@app.get("/jobs/{job_id}", response_model=JobOut)
+def get_job(job_id: int, db: Session = Depends(get_db)):
+    """Returns a job's status, with the full report once it is done."""
+    job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job = cast(AnalysisJob, job)
+    report = None
+    if job.report_id is not None:
+        report = db.query(Report).filter(Report.id == job.report_id).first()
+    return job_to_out(job, report)
+
+
+# Columns /reports can project. Features are deliberately absent: they can run to
+# megabytes per report and are only served by /reports/{id}.
+REPORT_LIST_COLUMNS = {
+    "id": Report.id,
+    "sha256": Report.sha256,
+    "filename": Report.filename,
+    "size_bytes": Report.size_bytes,
+    "score": Report.score,
+    "verdict": Report.verdict,
+    "created_at": Report.created_at,
+    "reasons": Report.reasons,
+}
+REPORT_SUMMARY_FIELDS = ("id", "sha256", "filename", "size_bytes", "score", "verdict", "created_at")
 
-    return AnalysisResult(**report.dict())
 
+def encode_report_cursor(created_at: dt.datetime, report_id: int) -> str:
+    return f"{created_at.isoformat()}_{report_id}"
 
-@app.get("/reports", response_model=List[AnalysisResult])
-def list_reports(limit: int = Query(50, ge=1, le=200), db: Session = Depends(get_db)):
-    """Retrieves a list of recent analysis reports."""
-    rows = db.query(Report).order_by(desc(Report.created_at)).limit(limit).all()
-    out: List[AnalysisResult] = []
-    for r in cast(List[Report], rows):
-        data = r.__dict__
-        data["reasons"] = [Reason(**x) for x in json.loads(data["reasons"])]
-        data["features"] = json.loads(data["features"])
-        out.append(AnalysisResult(**data))
+
+def decode_report_cursor(cursor: str) -> Tuple[dt.datetime, int]:
+    ts, _, report_id = cursor.rpartition("_")
+    try:
+        return dt.datetime.fromisoformat(ts), int(report_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/reports", response_model=List[Dict[str, Any]])
+def list_reports(
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    fields: Optional[str] = Query(None, description="Comma-separated columns; defaults to the summary"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    db: Session = Depends(get_db),
+):
+    """Retrieves recent analysis reports, newest first, without their features.
+
+    Pages are keyed on (created_at, id): pass the previous response's X-Next-Cursor
+    header as `cursor` to continue. `fields` picks columns from REPORT_LIST_COLUMNS,
+    e.g. `?fields=id,verdict,score`.
+    """
+    names = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(REPORT_SUMMARY_FIELDS)
+    unknown = [f for f in names if f not in REPORT_LIST_COLUMNS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown or unlisted fields: {', '.join(unknown)}. Features are served by /reports/{{id}}.",
+        )
+    # The cursor columns are always read, whether or not they are returned.
+    selected = list(dict.fromkeys(["id", "created_at"] + names))
+    q = db.query(*[REPORT_LIST_COLUMNS[f] for f in selected])
+    if cursor:
+        q = q.filter(tuple_(Report.created_at, Report.id) < decode_report_cursor(cursor))
+    rows = q.order_by(desc(Report.created_at), desc(Report.id)).limit(limit).all()
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_report_cursor(rows[-1].created_at, rows[-1].id)
+    out: List[Dict[str, Any]] = []
+    for r in rows:
+        out.append({f: r._mapping[f] for f in names})
     return out
 
 
+@app.get("/reports/by-permission", response_model=List[ReportSummary])
+def reports_by_permission(
+    all_of: List[str] = Query([]),
+    any_of: List[str] = Query([]),
+    limit: int = Query(200, ge=1, le=10000),
+    db: Session = Depends(get_db),
+):
+    """Finds reports whose permissions include every `all_of` and at least one `any_of` entry.
+
+    The match runs as a bitmask test on the indexed perm_mask column, e.g.
+    `?all_of=android.permission.RECEIVE_SMS&all_of=android.permission.BIND_ACCESSIBILITY_SERVICE`.
+    """
+    unknown = [p for p in all_of + any_of if p not in PERMISSION_BIT]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Permissions not tracked in masks: {', '.join(unknown)}")
+    all_mask = permission_mask(all_of)
+    any_mask = permission_mask(any_of)
+    q = db.query(Report.id, Report.sha256, Report.filename, Report.size_bytes, Report.score, Report.verdict, Report.created_at)
+    if all_mask:
+        q = q.filter(Report.perm_mask.op("&")(all_mask) == all_mask)
+    if any_mask:
+        q = q.filter(Report.perm_mask.op("&")(any_mask) != 0)
+    rows = q.order_by(desc(Report.created_at)).limit(limit).all()
+    return [ReportSummary(**r._mapping) for r in rows]
+
+
+@app.get("/reports/search", response_model=List[SearchHit])
+def search_reports(
+    q: Optional[str] = Query(None, description="FTS5 query over all indexed columns"),
+    package: Optional[str] = Query(None),
+    app_name: Optional[str] = Query(None),
+    url: Optional[str] = Query(None),
+    host: Optional[str] = Query(None),
+    subject: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_db),
+):
+    """Finds reports by package, app name, URL, host or signer certificate subject.
+
+    Field parameters are case-insensitive substring patterns where `*` matches any run of
+    characters, e.g. `?url=*.xyz/login` or `?package=com.sbi.*`. Multi-valued columns are
+    matched as one newline-joined text. `q` is an FTS5 query (terms of 3+ characters,
+    `package : "sbi"`); its hits are ranked by bm25, otherwise newest reports come first.
+    """
+    if not FTS5_AVAILABLE:
+        raise HTTPException(status_code=501, detail="SQLite FTS5 with the trigram tokenizer is required for search")
+    patterns = {
+        name: value for name, value in
+        (("package", package), ("app_name", app_name), ("url", url), ("host", host), ("subject", subject))
+        if value
+    }
+    if not q and not patterns:
+        raise HTTPException(status_code=400, detail="Pass q or at least one field pattern")
+    sql, params = search_query(q, patterns, limit)
+    try:
+        rows = db.execute(text(sql), params).all()
+    except OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search query: {e.orig}")
+    return [SearchHit(**{**r._mapping, "package": r.package or None, "app_name": r.app_name or None}) for r in rows]
+
+
+@app.post("/reports/rescore")
+def rescore(db: Session = Depends(get_db)):
+    """Re-applies the current heuristics and ML models to all stored reports."""
+    if not NUMPY_AVAILABLE:
+        raise HTTPException(status_code=501, detail="NumPy is required for bulk rescoring")
+    return rescore_reports(db)
+
+
 @app.get("/reports/{report_id}", response_model=AnalysisResult)
 def get_report(report_id: int, db: Session = Depends(get_db)):
     """Retrieves a single report by its ID."""
     r = db.query(Report).filter(Report.id == report_id).first()
     if not r:
         raise HTTPException(status_code=404, detail="Report not found")
-    r = cast(Report, r)
-    data = r.__dict__
-    data["reasons"] = [Reason(**x) for x in json.loads(data["reasons"])]
-    data["features"] = json.loads(data["features"])
-    return AnalysisResult(**data)
+    return report_to_result(cast(Report, r))
+
+
+@app.get("/reports/{report_id}/similar", response_model=List[SimilarReport])
+def similar_reports(
+    report_id: int,
+    limit: int = Query(10, ge=1, le=100),
+    min_similarity: float = Query(SIMILAR_MIN_SCORE, ge=0.0, le=1.0),
+    db: Session = Depends(get_db),
+):
+    """Finds stored reports whose files, permissions, URLs and certificates overlap this one's.
+
+    Served from the in-memory LSH index; `similarity` estimates the Jaccard similarity
+    of the two feature sets.
+    """
+    r = db.query(Report.id, Report.minhash).filter(Report.id == report_id).first()
+    if not r:
+        raise HTTPException(status_code=404, detail="Report not found")
+    if not r.minhash:
+        return []
+    similarity_index.refresh(db)
+    matches = similarity_index.query(r.minhash, limit=limit, min_score=min_similarity, exclude=report_id)
+    if not matches:
+        return []
+    rows = (
+        db.query(Report.id, Report.sha256, Report.filename, Report.size_bytes, Report.score, Report.verdict, Report.created_at)
+        .filter(Report.id.in_([rid for rid, _ in matches]))
+        .all()
+    )
+    by_id = {row.id: row for row in rows}
+    return [SimilarReport(**by_id[rid]._mapping, similarity=round(sim, 4)) for rid, sim in matches if rid in by_id]
 
 
 @app.get("/reports/sha/{sha256}", response_model=AnalysisResult)
@@ -557,18 +4598,56 @@ def get_report_by_sha(sha256: str, db: Session = Depends(get_db)):
     r = db.query(Report).filter(Report.sha256 == sha256).first()
     if not r:
         raise HTTPException(status_code=404, detail="Report not found")
-    r = cast(Report, r)
-    data = r.__dict__
-    data["reasons"] = [Reason(**x) for x in json.loads(data["reasons"])]
-    data["features"] = json.loads(data["features"])
-    return AnalysisResult(**data)
+    return report_to_result(cast(Report, r))
+
+
+def bank_signer_map(db: Session, bank_ids: List[int]) -> Dict[int, List[str]]:
+    out: Dict[int, List[str]] = {}
+    rows = db.query(BankSigner.bank_id, BankSigner.fingerprint).filter(BankSigner.bank_id.in_(bank_ids))
+    for bank_id, fingerprint in rows.order_by(asc(BankSigner.fingerprint)).all():
+        out.setdefault(bank_id, []).append(fingerprint)
+    return out
+
+
+def replace_bank_signers(db: Session, bank_id: int, signers: List[str]) -> List[str]:
+    """Validates and stores a bank's signer fingerprints (caller commits)."""
+    try:
+        fingerprints = sorted({normalize_fingerprint(fp) for fp in signers})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db.query(BankSigner).filter(BankSigner.bank_id == bank_id).delete()
+    for fp in fingerprints:
+        db.add(BankSigner(bank_id=bank_id, fingerprint=fp))
+    return fingerprints
+
+
+@app.get("/samples/{sha256}")
+def download_sample(sha256: str):
+    """Streams a stored sample's original bytes, e.g. to re-analyze it elsewhere."""
+    if not DIGEST_REGEX.match(sha256) or sample_store.locate(sha256) is None:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    return StreamingResponse(
+        sample_store.iter_chunks(sha256),
+        media_type="application/vnd.android.package-archive",
+        headers={"Content-Disposition": f'attachment; filename="{sha256}.apk"'},
+    )
+
+
+@app.post("/samples/gc")
+def collect_samples(retention_days: int = Query(SAMPLE_RETENTION_DAYS, ge=0)):
+    """Deletes stored samples whose report is older than the retention period."""
+    return gc_samples(retention_days)
 
 
 @app.get("/banks", response_model=List[BankOut])
 def list_banks(db: Session = Depends(get_db)):
     """Lists all official bank references in the database."""
-    rows = db.query(BankRef).order_by(asc(BankRef.name)).all()
-    return [BankOut(id=r.id, name=r.name, package=r.package, official=r.official) for r in cast(List[BankRef], rows)]
+    rows = cast(List[BankRef], db.query(BankRef).order_by(asc(BankRef.name)).all())
+    signers = bank_signer_map(db, [r.id for r in rows])
+    return [
+        BankOut(id=r.id, name=r.name, package=r.package, official=r.official, signers=signers.get(r.id, []))
+        for r in rows
+    ]
 
 
 @app.post("/banks", response_model=BankOut)
@@ -576,10 +4655,25 @@ def add_bank(bank: BankIn, db: Session = Depends(get_db)):
     """Adds a new bank reference to the database."""
     row = BankRef(name=bank.name, package=bank.package, official=bank.official)
     db.add(row)
+    db.flush()
+    row = cast(BankRef, row)
+    signers = replace_bank_signers(db, row.id, bank.signers)
     db.commit()
-    db.refresh(row)
+    bank_index.invalidate()
+    return BankOut(id=row.id, name=row.name, package=row.package, official=row.official, signers=signers)
+
+
+@app.put("/banks/{bank_id}/signers", response_model=BankOut)
+def set_bank_signers(bank_id: int, signers: List[str], db: Session = Depends(get_db)):
+    """Replaces the SHA-256 signer fingerprints registered for a bank."""
+    row = db.query(BankRef).filter(BankRef.id == bank_id).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Bank not found")
     row = cast(BankRef, row)
-    return BankOut(id=row.id, name=row.name, package=row.package, official=row.official)
+    fingerprints = replace_bank_signers(db, bank_id, signers)
+    db.commit()
+    bank_index.invalidate()
+    return BankOut(id=row.id, name=row.name, package=row.package, official=row.official, signers=fingerprints)
 
 
 @app.delete("/banks/{bank_id}")
@@ -589,7 +4683,9 @@ def delete_bank(bank_id: int, db: Session = Depends(get_db)):
     if not row:
         raise HTTPException(status_code=404, detail="Bank not found")
     db.delete(row)
+    db.query(BankSigner).filter(BankSigner.bank_id == bank_id).delete()
     db.commit()
+    bank_index.invalidate()
     return {"deleted": bank_id}
 
 
@@ -648,17 +4744,81 @@ def run_streamlit_app():
         st.subheader("Upload an APK file")
         uploaded_file = st.file_uploader("Choose an APK file", type=['apk'])
 
-        if uploaded_file is not None:
+        # A background job survives page reloads and backend restarts; live progress
+        # streams a provisional verdict while the APK is still being scanned.
+        mode = st.radio("Analysis mode", ["Background job", "Live progress"], horizontal=True)
+
+        if uploaded_file is not None and mode == "Background job":
             with st.spinner("Analyzing APK... This may take a moment."):
-                files = {'file': uploaded_file.getvalue()}
+                upload_key = f"{uploaded_file.name}:{uploaded_file.size}"
                 try:
-                    # Connects to the /analyze endpoint of the FastAPI backend
-                    response = requests.post(f"{BACKEND_URL}/analyze", files=files, timeout=60)
-                    if response.status_code == 200:
-                        analysis_result = response.json()
-                        display_analysis_result(analysis_result)
-                    else:
-                        st.error(f"Error analyzing file: {response.text}")
+                    # Submit once per uploaded file; Streamlit reruns must not re-queue it.
+                    if st.session_state.get("job_upload_key") != upload_key:
+                        files = {'file': (uploaded_file.name, uploaded_file.getvalue(), "application/vnd.android.package-archive")}
+                        # Connects to the /jobs endpoint of the FastAPI backend
+                        response = requests.post(f"{BACKEND_URL}/jobs", files=files, timeout=60)
+                        if response.status_code != 200:
+                            st.error(f"Error analyzing file: {response.text}")
+                            st.stop()
+                        st.session_state.job_upload_key = upload_key
+                        st.session_state.job_id = response.json()["id"]
+
+                    # Poll the job until the worker finishes it
+                    job = None
+                    while True:
+                        response = requests.get(f"{BACKEND_URL}/jobs/{st.session_state.job_id}", timeout=10)
+                        if response.status_code != 200:
+                            st.error(f"Error fetching job status: {response.text}")
+                            break
+                        job = response.json()
+                        if job["status"] in ("done", "failed"):
+                            break
+                        time.sleep(1)
+
+                    if job and job["status"] == "done":
+                        display_analysis_result(job["report"])
+                    elif job and job["status"] == "failed":
+                        st.error(f"Error analyzing file: {job['error']}")
+                except requests.exceptions.RequestException as e:
+                    st.error(f"Could not connect to the backend. Please check if the FastAPI server is running at {BACKEND_URL}.")
+                    st.exception(e)
+
+        elif uploaded_file is not None:
+            upload_key = f"{uploaded_file.name}:{uploaded_file.size}"
+            # Analyze once per uploaded file; Streamlit reruns reuse the stored result.
+            if st.session_state.get("stream_upload_key") == upload_key:
+                display_analysis_result(st.session_state.stream_result)
+            else:
+                progress = st.empty()
+                try:
+                    files = {'file': (uploaded_file.name, uploaded_file.getvalue(), "application/vnd.android.package-archive")}
+                    # Connects to the streaming /analyze endpoint: a provisional verdict
+                    # arrives first, then one refinement per finished stage.
+                    with requests.post(f"{BACKEND_URL}/analyze/stream", files=files, stream=True, timeout=300) as response:
+                        if response.status_code != 200:
+                            st.error(f"Error analyzing file: {response.text}")
+                            st.stop()
+                        for line in response.iter_lines():
+                            if not line:
+                                continue
+                            event = json.loads(line)
+                            if event.get("error"):
+                                progress.empty()
+                                st.error(f"Error analyzing file: {event['error']}")
+                                break
+                            if event["final"]:
+                                progress.empty()
+                                st.session_state.stream_upload_key = upload_key
+                                st.session_state.stream_result = event["report"]
+                                display_analysis_result(event["report"])
+                                break
+                            with progress.container():
+                                st.info(f"Provisional verdict after the {event['stage']} stage, still scanning...")
+                                col1, col2 = st.columns(2)
+                                col1.metric("Verdict", event["verdict"])
+                                col2.metric("Score", f"{event['score']:.2f}")
+                                for reason in event["reasons"]:
+                                    st.markdown(f"- **{reason['code'].replace('_', ' ').title()}**: {reason['detail']}")
                 except requests.exceptions.RequestException as e:
                     st.error(f"Could not connect to the backend. Please check if the FastAPI server is running at {BACKEND_URL}.")
                     st.exception(e)
@@ -669,22 +4829,29 @@ def run_streamlit_app():
         if st.button("Refresh Reports"):
             st.session_state.reports_data = None
         
-        if 'reports_data' not in st.session_state or st.session_state.reports_data is None:
+        def fetch_reports(cursor=None):
+            # Connects to the /reports endpoint of the FastAPI backend; summaries only.
+            params = {"cursor": cursor} if cursor else {}
             try:
-                # Connects to the /reports endpoint of the FastAPI backend
-                response = requests.get(f"{BACKEND_URL}/reports")
+                response = requests.get(f"{BACKEND_URL}/reports", params=params)
                 if response.status_code == 200:
-                    st.session_state.reports_data = response.json()
-                else:
-                    st.error(f"Error fetching reports: {response.text}")
-                    st.session_state.reports_data = []
-            except requests.exceptions.RequestException as e:
+                    st.session_state.reports_cursor = response.headers.get("X-Next-Cursor")
+                    return response.json()
+                st.error(f"Error fetching reports: {response.text}")
+            except requests.exceptions.RequestException:
                 st.error(f"Could not connect to the backend at {BACKEND_URL}.")
-                st.session_state.reports_data = []
+            st.session_state.reports_cursor = None
+            return []
+
+        if 'reports_data' not in st.session_state or st.session_state.reports_data is None:
+            st.session_state.reports_data = fetch_reports()
 
         if st.session_state.reports_data:
             df = st.session_state.reports_data
             st.dataframe(df, use_container_width=True)
+            if st.session_state.get("reports_cursor") and st.button("Load older reports"):
+                st.session_state.reports_data = df + fetch_reports(st.session_state.reports_cursor)
+                st.rerun()
         else:
             st.info("No reports found.")
 
@@ -739,7 +4906,24 @@ def run_fastapi_server():
 
 
 if __name__ == "__main__":
-    if multiprocessing.current_process().name == 'MainProcess':
+    if len(sys.argv) > 1 and sys.argv[1] == "rescore":
+        # `python final_app.py rescore` rescores stored reports without starting the servers.
+        with SessionLocal() as s:
+            print(json.dumps(rescore_reports(s)))
+    elif len(sys.argv) > 1 and sys.argv[1] == "gc":
+        # `python final_app.py gc [retention_days]` removes expired samples.
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else SAMPLE_RETENTION_DAYS
+        print(json.dumps(gc_samples(days)))
+    elif len(sys.argv) > 1 and sys.argv[1] == "compact":
+        # `python final_app.py compact` retrains the report dictionary, re-encodes every
+        # report with it and vacuums the database to release the freed pages.
+        dict_id = train_report_dictionary()
+        converted = migrate_report_storage(recode_all=True)
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+            conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+        print(json.dumps({"dictionary": dict_id, "converted": converted}))
+    elif multiprocessing.current_process().name == 'MainProcess':
         # This part of the code serves as a launcher to run both applications simultaneously.
         # It creates a temporary file to launch the Streamlit app.
         streamlit_script_content = """
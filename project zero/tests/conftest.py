@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# final_app creates data/, storage/ and models/ relative to the working directory at
+# import time; keep them (and the SQLite database) out of the source tree.
+os.environ.setdefault("ANALYSIS_WORKERS", "0")
+os.chdir(tempfile.mkdtemp(prefix="final_app_tests_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
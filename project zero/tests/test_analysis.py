@@ -0,0 +1,425 @@
+import asyncio
+import hashlib
+import io
+import json
+import operator
+import os
+import struct
+import time
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import final_app as fa
+from test_binary_readers import CLASSES_DEX, MANIFEST, build_apk
+
+
+def run_stages(path, max_entries=fa.EXTRACT_MAX_ENTRIES):
+    budget = fa.ExtractionBudget(max_entries=max_entries).state()
+    features, budget = fa.analyze_stage(path, "manifest", budget=budget)
+    for stage in fa.ANALYSIS_STAGES[1:]:
+        partial, budget = fa.analyze_stage(path, stage, budget=budget)
+        features = fa.merge_stage_features(features, partial)
+    return features, budget
+
+
+def test_stages_share_one_extraction_budget(tmp_path):
+    path = tmp_path / "staged.apk"
+    path.write_bytes(build_apk({
+        "AndroidManifest.xml": MANIFEST,
+        "classes.dex": CLASSES_DEX,
+        "res/raw/a.json": b'{"u": "http://phish.top/x"}',
+        "res/raw/b.json": b'{"u": "http://phish.top/y"}',
+    }))
+    features, budget = run_stages(str(path))
+    # Each entry is charged once, though every step re-reads the manifest.
+    assert budget["entries"] == 4
+    assert sorted(budget["admitted"]) == sorted(features["files"])
+    assert not features["limits"]
+    assert {"http://phish.top/x", "https://evil.xyz/login"} <= set(features["urls"])
+
+    features, budget = run_stages(str(path), max_entries=3)
+    assert budget["entries"] == 3
+    assert features["limits"] == ["entries: 1 entry skipped (classes.dex)"]
+
+
+def test_engine_replaces_a_broken_process_pool():
+    async def scenario():
+        engine = fa.AnalysisEngine(workers=1, max_pending=4)
+        engine.start()
+        try:
+            broken = engine.executor
+            with pytest.raises(HTTPException) as e:
+                await engine.run(os._exit, 1)
+            assert e.value.status_code == 503
+            assert e.value.headers["Retry-After"] == str(fa.ANALYSIS_RETRY_AFTER)
+            assert engine.executor is not broken
+            assert await engine.run(operator.add, 1, 2) == 3
+            assert engine.pending == 0
+        finally:
+            engine.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_batch_reports_inputs_beyond_the_limit(monkeypatch):
+    monkeypatch.setattr(fa, "BATCH_MAX_ITEMS", 2)
+    apks = [build_apk({"AndroidManifest.xml": MANIFEST, "res/raw/n": str(i).encode()}) for i in range(4)]
+    bundle = build_apk({"a.apk": apks[0], "b.apk": apks[1]})
+    files = [
+        ("files", ("2.apk", apks[2], "application/octet-stream")),
+        ("files", ("bundle.zip", bundle, "application/zip")),
+        ("files", ("3.apk", apks[3], "application/octet-stream")),
+    ]
+    with TestClient(fa.app) as client:
+        r = client.post("/analyze/batch", files=files)
+    lines = {item["filename"]: item for item in map(json.loads, r.text.splitlines())}
+    assert sorted(lines) == ["2.apk", "3.apk", "a.apk", "b.apk"]
+    assert [lines[n]["status"] for n in ("2.apk", "a.apk")] == ["analyzed"] * 2
+    # Dropped both from inside a bundle and as a whole upload.
+    assert [lines[n]["error"] for n in ("b.apk", "3.apk")] == [fa.BATCH_LIMIT_ERROR] * 2
+
+
+def test_minhash_is_computed_by_the_writer_and_covers_signers():
+    features = {"files": ["a", "b"], "signers": ["ab" * 32]}
+    assert "s:" + "ab" * 32 in fa.feature_tokens(features)
+    row = fa.report_row("m.apk", "0" * 64, 1, features, 0.0, "SAFE", [])
+    assert "minhash" not in row
+    writer = fa.ReportWriter()
+    try:
+        report_id = writer.submit(row).result(timeout=10)
+    finally:
+        writer.stop()
+    with fa.SessionLocal() as db:
+        report = db.query(fa.Report).filter(fa.Report.id == report_id).one()
+        assert report.minhash == fa.minhash_signature(features)
+        assert report.minhash_version == fa.MINHASH_TOKEN_VERSION
+
+
+def test_rescore_refreshes_stale_permission_masks():
+    features = {"package": "com.x", "files": [], "urls": [], "permissions": ["android.permission.READ_SMS"]}
+    X, _, masks = fa.build_feature_matrix([features], fa.bank_index.get())
+    assert X.shape == (1, fa.MODEL_COLUMNS + len(fa.PERMISSION_COLUMNS))
+    assert X[0, fa.MODEL_COLUMNS + fa.PERMISSION_COLUMNS.index("android.permission.READ_SMS")] == 1
+    assert X[0, fa.MODEL_COLUMNS:].sum() == 1
+    writer = fa.ReportWriter()
+    try:
+        report_id = writer.submit(fa.report_row("p.apk", hashlib.sha256(b"perm").hexdigest(), 1, features, 0.0, "SAFE", [])).result(10)
+    finally:
+        writer.stop()
+    with fa.SessionLocal() as db:
+        db.query(fa.Report).filter(fa.Report.id == report_id).update({"perm_mask": 0})  # as if stored before the bit existed
+        db.commit()
+        fa.rescore_reports(db)
+        assert db.query(fa.Report.perm_mask).filter(fa.Report.id == report_id).scalar() == masks[0]
+
+
+def test_file_listing_is_capped(tmp_path, monkeypatch):
+    monkeypatch.setattr(fa, "FEATURES_MAX_FILES", 3)
+    path = tmp_path / "many.apk"
+    path.write_bytes(build_apk({"AndroidManifest.xml": MANIFEST, **{f"res/raw/{i}": b"" for i in range(5)}}))
+    features, _, _, _ = fa.analyze_file(str(path))
+    assert features["files"] == ["AndroidManifest.xml", "res/raw/0", "res/raw/1"]
+    assert features["limits"] == ["files: listing truncated to 3 of 6 entries"]
+
+
+def test_single_flight_renews_its_lock_and_takes_over_abandoned_ones(monkeypatch):
+    monkeypatch.setattr(fa, "ANALYSIS_LOCK_RENEW", 0.05)
+    digest = "1" * 64
+    stale = fa.dt.datetime.utcnow() - fa.dt.timedelta(seconds=fa.ANALYSIS_LOCK_TTL + 1)
+    with fa.engine.begin() as conn:
+        conn.execute(fa.AnalysisLock.__table__.insert(), {"sha256": digest, "owner": "crashed", "acquired_at": stale})
+
+    def lock_time():
+        with fa.SessionLocal() as db:
+            return db.query(fa.AnalysisLock.acquired_at).filter(fa.AnalysisLock.sha256 == digest).scalar()
+
+    async def analyze():
+        first = lock_time()
+        await asyncio.sleep(0.3)
+        assert lock_time() > first
+        return 42
+
+    assert asyncio.run(fa.SingleFlight().run(digest, analyze)) == 42
+    assert lock_time() is None
+
+
+def stored_apk(text):
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, "w", zipfile.ZIP_STORED) as z:
+        z.writestr("AndroidManifest.xml", MANIFEST)
+        z.writestr("assets/a.txt", text.ljust(fa.ENTRY_CACHE_MIN_BYTES + 100).encode())
+    return b.getvalue()
+
+
+def archive_urls(data):
+    archive = fa.ApkArchive(data, cache=fa.entry_cache)
+    try:
+        return archive.urls, archive.cache_hits
+    finally:
+        archive.close()
+
+
+def test_entry_cache_keys_on_compressed_bytes_not_central_directory_fields():
+    clean = stored_apk("http://clean.example.com/")
+    assert archive_urls(clean) == (["http://clean.example.com/"], 0)
+    assert archive_urls(clean) == (["http://clean.example.com/"], 1)
+
+    # Same name, sizes and (forged) CRC as the cached entry, different bytes.
+    forged = bytearray(stored_apk("http://evil.example.top/"))
+    crc = zipfile.ZipFile(io.BytesIO(clean)).getinfo("assets/a.txt").CRC
+    info = zipfile.ZipFile(io.BytesIO(bytes(forged))).getinfo("assets/a.txt")
+    struct.pack_into("<I", forged, info.header_offset + 14, crc)
+    forged[forged.rindex(b"PK\x01\x02") + 16:forged.rindex(b"PK\x01\x02") + 20] = struct.pack("<I", crc)
+    urls, hits = archive_urls(bytes(forged))
+    assert hits == 0
+    assert "http://clean.example.com/" not in urls
+
+
+def test_entry_cache_evicts_oldest_rows():
+    cache = fa.EntryFeatureCache(max_rows=2)
+    cache.evict()
+    with fa.engine.begin() as conn:
+        conn.execute(fa.EntryCache.__table__.delete())
+    for i in range(3):
+        cache.store({f"k{i}": {"urls": []}})
+    assert sorted(cache.lookup(["k0", "k1", "k2"])) == ["k1", "k2"]
+    assert fa.gc_samples()["cache_evicted"] == 0
+
+
+def test_writer_trains_the_report_dictionary_once_enough_reports_exist(monkeypatch):
+    pytest.importorskip("zstandard")
+    monkeypatch.setattr(fa, "REPORT_DICT_MIN_SAMPLES", 20)
+    monkeypatch.setattr(fa.report_codec, "active_id", 0)
+    writer = fa.ReportWriter()
+    with fa.SessionLocal() as db:
+        stored = db.query(fa.Report).count()
+    try:
+        for i in range(max(20 - stored, 0) + 5):
+            features = {"files": [f"res/raw/{i}", "classes.dex"], "urls": [f"http://h{i}.example.com/"], "permissions": []}
+            writer.submit(fa.report_row(f"d{i}.apk", hashlib.sha256(b"dict%d" % i).hexdigest(), 1, features, 0.0, "SAFE", [])).result(10)
+    finally:
+        writer.stop()
+    assert fa.report_codec.active_id
+    with fa.SessionLocal() as db:
+        assert db.query(fa.CodecDictionary).filter(fa.CodecDictionary.id == fa.report_codec.active_id).count() == 1
+
+
+def test_search_field_patterns_treat_like_wildcards_literally():
+    if not fa.FTS5_AVAILABLE:
+        pytest.skip("SQLite FTS5 trigram tokenizer unavailable")
+    writer = fa.ReportWriter()
+    try:
+        for i, package in enumerate(["com.pay_now.app", "com.paysnow.app", "com.pay%now.app"]):
+            features = {"package": package, "files": [], "urls": [], "permissions": []}
+            writer.submit(fa.report_row(f"s{i}.apk", hashlib.sha256(b"search%d" % i).hexdigest(), 1, features, 0.0, "SAFE", [])).result(10)
+    finally:
+        writer.stop()
+    client = TestClient(fa.app)
+
+    def found(pattern):
+        return sorted(h["package"] for h in client.get("/reports/search", params={"package": pattern}).json())
+
+    assert found("pay_now") == ["com.pay_now.app"]
+    assert found("pay%now") == ["com.pay%now.app"]
+    assert found("com.pay*now.app") == ["com.pay%now.app", "com.pay_now.app", "com.paysnow.app"]
+
+
+@pytest.mark.parametrize("pattern", ["pay_now", "pay%now", "com.pay*now.app", "paynow"])
+def test_search_field_patterns_use_the_trigram_index(pattern):
+    if not fa.FTS5_AVAILABLE:
+        pytest.skip("SQLite FTS5 trigram tokenizer unavailable")
+    sql, params = fa.search_query(None, {"package": pattern}, 10)
+    with fa.engine.connect() as conn:
+        plan = " ".join(row[-1] for row in conn.execute(fa.text("EXPLAIN QUERY PLAN " + sql), params))
+    assert "VIRTUAL TABLE INDEX 0:L" in plan, plan
+
+
+def store_sample(tmp_path, data):
+    digest = hashlib.sha256(data).hexdigest()
+    spool = tmp_path / f"{digest}.spool"
+    spool.write_bytes(data)
+    return digest, fa.sample_store.put_file(str(spool), digest)
+
+
+def test_gc_removes_old_blobs_without_a_report(tmp_path):
+    reported, reported_path = store_sample(tmp_path, b"reported sample")
+    orphan, orphan_path = store_sample(tmp_path, b"rejected upload")
+    _, fresh_path = store_sample(tmp_path, b"upload still being analyzed")
+    writer = fa.ReportWriter()
+    try:
+        writer.submit(fa.report_row("r.apk", reported, 1, {"files": [], "urls": []}, 0.0, "SAFE", [])).result(10)
+    finally:
+        writer.stop()
+    old = time.time() - fa.SPOOL_MAX_AGE - 60
+    for path in (reported_path, orphan_path):
+        os.utime(path, (old, old))
+    assert fa.gc_samples(retention_days=365)["orphans_removed"] == 1
+    assert not os.path.exists(orphan_path)
+    assert os.path.exists(reported_path) and os.path.exists(fresh_path)
+
+    # Re-uploading an old orphan restarts its grace period.
+    os.utime(fresh_path, (old, old))
+    store_sample(tmp_path, b"upload still being analyzed")
+    assert fa.gc_samples(retention_days=365)["orphans_removed"] == 0
+    assert os.path.exists(fresh_path)
+
+
+@pytest.mark.parametrize("compression", ["none", "zstd"])
+def test_sample_store_shards_and_dedupes(tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    store = fa.SampleStore(str(tmp_path / "samples"), compression)
+    data = b"sample bytes" * 1000
+    digest = hashlib.sha256(data).hexdigest()
+    assert store.locate(digest) is None
+    for name in ("first", "second"):
+        spool = tmp_path / name
+        spool.write_bytes(data)
+        path = store.put_file(str(spool), digest)
+        assert not spool.exists()  # consumed, also when the blob already exists
+    assert os.path.dirname(path) == str(tmp_path / "samples" / digest[:2] / digest[2:4])
+    assert path.endswith(".zst") == (compression == "zstd")
+    assert [e.path for e in store.scan()] == [path]
+    assert store.locate(digest) == path
+    with store.local_path(digest) as local, open(local, "rb") as f:
+        assert f.read() == data
+    assert b"".join(store.iter_chunks(digest, 100)) == data
+    assert store.delete(digest) and store.locate(digest) is None
+    with pytest.raises(ValueError):
+        store.locate("../" + digest)
+
+
+def test_report_pages_have_no_gaps_or_duplicates_across_equal_timestamps():
+    writer = fa.ReportWriter()
+    try:
+        ids = [
+            writer.submit(fa.report_row(f"p{i}.apk", hashlib.sha256(b"page%d" % i).hexdigest(), 1, {}, 0.0, "SAFE", [])).result(10)
+            for i in range(7)
+        ]
+    finally:
+        writer.stop()
+    tied = fa.dt.datetime(2100, 1, 1, 12, 0, 0, 123456)
+    with fa.SessionLocal() as db:
+        db.query(fa.Report).filter(fa.Report.id.in_(ids)).update({"created_at": tied}, synchronize_session=False)
+        db.commit()
+        expected = [r.id for r in db.query(fa.Report.id).order_by(fa.desc(fa.Report.created_at), fa.desc(fa.Report.id))]
+    assert fa.decode_report_cursor(fa.encode_report_cursor(tied, 42)) == (tied, 42)
+
+    client = TestClient(fa.app)
+    seen, cursor, pages = [], None, 0
+    while True:
+        response = client.get("/reports", params={"limit": 3, "fields": "id", **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        seen += [r["id"] for r in response.json()]
+        pages += 1
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert seen == expected  # the tied rows are split across pages, ordered by id
+    assert pages == len(expected) // 3 + 1  # the last page is short (possibly empty) and has no cursor
+    assert client.get("/reports", params={"cursor": "not-a-cursor"}).status_code == 400
+
+
+def bank_names():
+    # 6 * 20 * 5 = 600 names, more than BANK_SCAN_LIMIT, so the n-gram filter is used.
+    regions = ["State", "National", "Central", "United", "Federal", "Punjab"]
+    cities = [f"{c}pur" for c in ("Jai", "Nag", "Kan", "Rai", "Bilas", "Jodh", "Udai", "Gorakh", "Muzaffar", "Shah",
+                                  "Bhagal", "Durga", "Sitam", "Hamir", "Saharan", "Jamal", "Mirza", "Fateh", "Tirup", "Ala")]
+    kinds = ["Bank", "Co-operative Bank", "Gramin Bank", "Finance Bank", "Urban Bank"]
+    return [f"{r} {c} {k}" for r in regions for c in cities for k in kinds]
+
+
+def test_bank_candidates_keep_every_match_near_the_threshold():
+    names = bank_names()
+    banks = fa.BankIndex(names, [])
+    assert len(names) > fa.BANK_SCAN_LIMIT
+    queries = [names[0], names[137].upper(), "State Jaipur Bnk", "Natinal Nagpur Gramin Bank", "Central Kanpur",
+               "Punjab Alapur Urban", "Totally Unrelated Game", "Bhagalpur Bank", "SBI Quick Pay", "United Finance"]
+    for q in queries:
+        exact = fa.name_similarity_score(q, names)
+        filtered = banks.similarity(q)
+        assert filtered <= exact, q
+        if exact >= 50:
+            assert filtered == exact, q
+        assert (filtered >= 60) == (exact >= 60), q
+
+
+def test_bank_candidates_without_rapidfuzz_are_exact(monkeypatch):
+    monkeypatch.setattr(fa, "RAPIDFUZZ_AVAILABLE", False)
+    names = bank_names()
+    banks = fa.BankIndex(names, [])
+    for q in ["State Jaipur Bank", "jaipur", "Unrelated words", "Urban Bank of Nowhere"]:
+        assert banks.similarity(q) == fa.name_similarity_score(q, names), q
+
+
+def test_bank_signer_maps_and_status():
+    banks = fa.BankIndex(["Test Bank"], ["com.testbank"], {
+        "com.testbank": ["aa", "bb"],
+        "com.testbank.pay": ["cc"],
+        "in.other": ["aa"],
+    })
+    assert banks.signer_packages == {"aa": {"com.testbank", "in.other"}, "bb": {"com.testbank"}, "cc": {"com.testbank.pay"}}
+    assert banks.package_signers["com.testbank"] == {"aa", "bb"}
+    assert banks.signer_status("com.testbank.app", ["bb"]) == "official"  # a parent package's key
+    assert banks.signer_status("com.testbank.pay.ui", ["cc"]) == "official"
+    assert banks.signer_status("com.testbank", ["cc", "dd"]) == "mismatch"
+    assert banks.signer_status("in.other.app", []) == "mismatch"
+    assert banks.signer_status("com.testbankfake", ["dd"]) is None  # label boundaries, not string prefixes
+    assert banks.signer_status("", ["aa"]) is None
+    assert fa.BankIndex([], []).signer_status("com.testbank", ["aa"]) is None
+    assert banks.matches_bank_prefix("com.anything") and not banks.matches_bank_prefix("org.x")
+
+
+class ConstantModel:
+    def __init__(self, p):
+        self.p = p
+
+    def predict_proba(self, vectors):
+        return [[1 - self.p, self.p] for _ in vectors]
+
+
+def test_model_registry_hot_reloads_and_keeps_the_last_good_model(tmp_path, monkeypatch):
+    joblib = pytest.importorskip("joblib")
+    monkeypatch.setattr(fa, "MODEL_RELOAD_INTERVAL", 0.0)
+    registry = fa.ModelRegistry(str(tmp_path), "model")
+    monkeypatch.setattr(fa, "model_registry", registry)
+    path = registry.path("model")
+    assert fa.predict_proba([[0, 0, 0, 0]]) is None  # no file yet
+
+    def write(model, mtime_ns):
+        joblib.dump(model, path)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    write(ConstantModel(0.25), 1_000_000_000)
+    assert fa.predict_proba([[0, 0, 0, 0], [1, 1, 1, 1]]) == [0.25, 0.25]
+
+    loads = []
+    real_load = joblib.load
+    monkeypatch.setattr(fa.joblib, "load", lambda p: loads.append(p) or real_load(p))
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))  # touched, same content
+    assert registry.get().p == 0.25 and loads == []
+
+    write(ConstantModel(0.75), 3_000_000_000)
+    assert registry.get().p == 0.75 and len(loads) == 1
+
+    with open(path, "wb") as f:
+        f.write(b"not a model")
+    os.utime(path, ns=(4_000_000_000, 4_000_000_000))
+    assert registry.get().p == 0.75  # a broken file keeps the previous model
+
+    os.remove(path)
+    assert registry.get() is None
+    features = {"package": "com.x", "permissions": [], "urls": [], "files": []}
+    _, _, reasons = fa.score_features(features, fa.BankIndex([], []))
+    assert "ml_probability" not in [r.code for r in reasons]
+
+
+def test_model_registry_split_is_deterministic():
+    registry = fa.ModelRegistry("unused", "model:1, model-b:3")
+    picks = [registry.choose(hashlib.sha256(b"%d" % i).hexdigest()) for i in range(400)]
+    assert picks == [registry.choose(hashlib.sha256(b"%d" % i).hexdigest()) for i in range(400)]
+    assert 50 < picks.count("model") < 150 and picks.count("model-b") == 400 - picks.count("model")
+    assert fa.ModelRegistry("unused", "").choose("abc") == fa.DEFAULT_MODEL_NAME
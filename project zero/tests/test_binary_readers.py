@@ -0,0 +1,396 @@
+"""Fixture tests for the hand-written binary readers: URL scanning, AXML, DEX and APK
+signature verification. Every fixture is built in-process, so no sample APKs are
+checked in."""
+import hashlib
+import io
+import random
+import struct
+import time
+import zipfile
+
+import pytest
+
+import final_app as fa
+
+
+# -----------------------------
+# Fixture builders
+# -----------------------------
+def der(tag, content):
+    n = len(content)
+    if n < 0x80:
+        length = bytes([n])
+    else:
+        raw = n.to_bytes((n.bit_length() + 7) // 8, "big")
+        length = bytes([0x80 | len(raw)]) + raw
+    return bytes([tag]) + length + content
+
+
+def der_int(value):
+    return der(0x02, value.to_bytes(value.bit_length() // 8 + 1, "big"))
+
+
+def lp(data):
+    return struct.pack("<I", len(data)) + data
+
+
+# A fixed 1024-bit test key, so fixtures are deterministic.
+RSA_P = int(
+    "d28760ef9506638db175fe91be734122e49bec562b042161d1857d02f52435b58d7eaeea5569ec0810d555f2753d1d8b"
+    "74c7d32222b2f1e9cfcafd579dba66b7", 16)
+RSA_Q = int(
+    "f4954f6624364119efd339bb654db1386ef85f3cbbf4d9b32bedef32acf60cd11cecc1cae4f1181146f9003364e78d69"
+    "b4e95b86ddb5cc1534b6b13eaf6d15eb", 16)
+RSA_N = RSA_P * RSA_Q
+RSA_E = 65537
+RSA_D = pow(RSA_E, -1, (RSA_P - 1) * (RSA_Q - 1))
+SHA256_WITH_RSA_OID = bytes.fromhex("2a864886f70d01010b")
+
+
+def rsa_sign(message):
+    k = (RSA_N.bit_length() + 7) // 8
+    t = fa.RSA_PKCS1_ALGORITHMS[0x0103][1] + hashlib.sha256(message).digest()
+    em = b"\x00\x01" + b"\xff" * (k - len(t) - 3) + b"\x00" + t
+    return pow(int.from_bytes(em, "big"), RSA_D, RSA_N).to_bytes(k, "big")
+
+
+def x509_name(cn, org):
+    return der(0x30, b"".join(
+        der(0x31, der(0x30, der(0x06, oid) + der(0x0C, value.encode())))
+        for oid, value in ((bytes.fromhex("550403"), cn), (bytes.fromhex("55040a"), org))
+    ))
+
+
+def subject_public_key_info():
+    key = der(0x30, der_int(RSA_N) + der_int(RSA_E))
+    return der(0x30, der(0x30, der(0x06, fa.RSA_ENCRYPTION_OID) + der(0x05, b"")) + der(0x03, b"\x00" + key))
+
+
+def certificate(cn="Test Bank", org="Example"):
+    algorithm = der(0x30, der(0x06, SHA256_WITH_RSA_OID) + der(0x05, b""))
+    name = x509_name(cn, org)
+    validity = der(0x30, der(0x17, b"250101000000Z") + der(0x17, b"350101000000Z"))
+    tbs = der(0x30, der(0xA0, der_int(2)) + der_int(1) + algorithm + name + validity + name + subject_public_key_info())
+    # The certificate's own signature is not checked by the verifier.
+    return der(0x30, tbs + algorithm + der(0x03, b"\x00" + b"\x01" * 128))
+
+
+def string_pool(strings):
+    data = b""
+    offsets = []
+    for s in strings:
+        offsets.append(len(data))
+        data += struct.pack("<H", len(s)) + s.encode("utf-16-le") + b"\0\0"
+    data += b"\0" * (-len(data) % 4)
+    start = 28 + 4 * len(strings)
+    header = struct.pack("<HHIIIIII", fa.RES_STRING_POOL_TYPE, 28, start + len(data), len(strings), 0, 0, start, 0)
+    return header + struct.pack(f"<{len(strings)}I", *offsets) + data
+
+
+def axml(elements):
+    """Binary XML with one start element per (tag, {attr: str or ResourceRef})."""
+    strings = []
+
+    def idx(s):
+        if s not in strings:
+            strings.append(s)
+        return strings.index(s)
+
+    chunks = b""
+    for tag, attrs in elements:
+        body = b""
+        for name, value in attrs.items():
+            if isinstance(value, fa.ResourceRef):
+                body += struct.pack("<IIIHBBI", fa.NO_ENTRY, idx(name), fa.NO_ENTRY, 8, 0, fa.RES_VALUE_REFERENCE, value)
+            else:
+                body += struct.pack("<IIIHBBI", fa.NO_ENTRY, idx(name), idx(value), 8, 0, fa.RES_VALUE_STRING, idx(value))
+        ext = struct.pack("<IIHHHHHH", fa.NO_ENTRY, idx(tag), 20, 20, len(attrs), 0, 0, 0)
+        chunks += struct.pack("<HHIII", fa.RES_XML_START_ELEMENT_TYPE, 16, 16 + len(ext) + len(body), 1, fa.NO_ENTRY) + ext + body
+    body = string_pool(strings) + chunks
+    return struct.pack("<HHI", fa.RES_XML_TYPE, 8, 8 + len(body)) + body
+
+
+MANIFEST = axml([
+    ("manifest", {"package": "com.testbank.app"}),
+    ("uses-permission", {"name": "android.permission.RECEIVE_SMS"}),
+    ("uses-permission", {"name": "android.permission.INTERNET"}),
+    ("application", {"label": "Test Bank"}),
+    ("activity", {"name": ".Main"}),
+    ("service", {"name": "com.testbank.app.sync.SyncService"}),
+])
+
+
+def uleb128(value):
+    out = b""
+    while True:
+        b = value & 0x7F
+        value >>= 7
+        if value:
+            out += bytes([b | 0x80])
+        else:
+            return out + bytes([b])
+
+
+def dex(strings, types, methods, classes):
+    """A DEX with just the tables DexFile reads. `types` index `strings`, `methods` are
+    (type index, name string index) and `classes` index `types`."""
+    string_ids_off = 0x70
+    type_ids_off = string_ids_off + 4 * len(strings)
+    method_ids_off = type_ids_off + 4 * len(types)
+    class_defs_off = method_ids_off + 8 * len(methods)
+    data_off = class_defs_off + 32 * len(classes)
+    data = b""
+    string_offsets = []
+    for s in strings:
+        string_offsets.append(data_off + len(data))
+        data += uleb128(len(s)) + s.encode() + b"\0"
+    header = bytearray(b"dex\n035\0".ljust(0x70, b"\0"))
+    struct.pack_into(
+        "<12I", header, 0x38,
+        len(strings), string_ids_off, len(types), type_ids_off, 0, 0, 0, 0,
+        len(methods), method_ids_off, len(classes), class_defs_off,
+    )
+    return (
+        bytes(header)
+        + struct.pack(f"<{len(strings)}I", *string_offsets)
+        + struct.pack(f"<{len(types)}I", *types)
+        + b"".join(struct.pack("<HHI", t, 0, name) for t, name in methods)
+        + b"".join(struct.pack("<I", c).ljust(32, b"\0") for c in classes)
+        + data
+    )
+
+
+DEX_STRINGS = [
+    "Landroid/telephony/SmsManager;",
+    "Lcom/evil/Main;",
+    "https://evil.xyz/login",
+    "sendTextMessage",
+    "http://split",
+    ".example.com/x",
+    "visit https://ok.com/a now",
+]
+CLASSES_DEX = dex(DEX_STRINGS, types=[0, 1], methods=[(0, 3)], classes=[1])
+
+
+def build_apk(entries):
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in entries.items():
+            z.writestr(zipfile.ZipInfo(name, date_time=(2026, 1, 1, 0, 0, 0)), data)
+    return b.getvalue()
+
+
+def sign_v2(apk, cert=None):
+    """Inserts an APK Signature Scheme v2 block signed with the test key."""
+    cert = cert or certificate()
+    eocd = apk.rfind(b"PK\x05\x06")
+    (cd_offset,) = struct.unpack_from("<I", apk, eocd + 16)
+    digest = fa.apk_content_digest(apk, "sha256", cd_offset, cd_offset, eocd)
+    signed_data = lp(lp(struct.pack("<I", 0x0103) + lp(digest))) + lp(lp(cert)) + lp(b"")
+    signer = lp(signed_data) + lp(lp(struct.pack("<I", 0x0103) + lp(rsa_sign(signed_data)))) + lp(subject_public_key_info())
+    value = lp(lp(signer))
+    pairs = struct.pack("<QI", 4 + len(value), fa.APK_SIGNATURE_SCHEME_V2_ID) + value
+    size = len(pairs) + 8 + len(fa.APK_SIG_BLOCK_MAGIC)
+    block = struct.pack("<Q", size) + pairs + struct.pack("<Q", size) + fa.APK_SIG_BLOCK_MAGIC
+    tail = bytearray(apk[eocd:])
+    struct.pack_into("<I", tail, 16, cd_offset + len(block))
+    return apk[:cd_offset] + block + apk[cd_offset:eocd] + bytes(tail)
+
+
+@pytest.fixture(scope="module")
+def signed_apk():
+    return sign_v2(build_apk({"AndroidManifest.xml": MANIFEST, "classes.dex": CLASSES_DEX}))
+
+
+@pytest.fixture(scope="module")
+def fingerprint():
+    return fa.certificate_fingerprint(certificate())
+
+
+# -----------------------------
+# scan_urls
+# -----------------------------
+def test_scan_urls_matches_whole_buffer_regex_at_every_chunk_size():
+    rng = random.Random(7)
+    urls = [b"https://bank.example.com/login", b"http://a.b/c?x=1&y=%20#f", b"http://evil.xyz/", b"https://t.co"]
+    parts = []
+    for _ in range(300):
+        parts.append(bytes(rng.choice(b" \0\n\"'<>{}()abcXYZ019./:") for _ in range(rng.randint(0, 40))))
+        parts.append(rng.choice(urls))
+    buf = b"".join(parts)
+    expected = [m.group().decode() for m in fa.URL_BYTES_REGEX.finditer(buf)]
+    for chunk_size in (1, 2, 3, 7, 8, 9, 13, 64, 4096):
+        assert list(fa.scan_urls(io.BytesIO(buf), chunk_size=chunk_size)) == expected, chunk_size
+
+
+def test_scan_urls_joins_url_split_across_chunks():
+    buf = b"xx https://bank.example.com/login yy"
+    split = buf.index(b"example")
+    assert list(fa.scan_urls(io.BytesIO(buf), chunk_size=split)) == ["https://bank.example.com/login"]
+
+
+def test_scan_urls_limits():
+    assert list(fa.scan_urls(io.BytesIO(b"http://a.com/ http://b.com/"), max_bytes=14)) == ["http://a.com/"]
+    with pytest.raises(fa.ResourceLimitExceeded):
+        list(fa.scan_urls(io.BytesIO(b"http://a.com/"), deadline=time.monotonic() - 1))
+
+
+# -----------------------------
+# AXML manifest
+# -----------------------------
+def test_parse_manifest():
+    out = fa.parse_manifest(MANIFEST)
+    assert out["package"] == "com.testbank.app"
+    assert out["app_name"] == "Test Bank"
+    assert out["permissions"] == ["android.permission.INTERNET", "android.permission.RECEIVE_SMS"]
+    assert out["activities"] == ["com.testbank.app.Main"]
+    assert out["services"] == ["com.testbank.app.sync.SyncService"]
+
+
+def test_parse_manifest_unresolved_label_reference():
+    manifest = axml([("manifest", {"package": "a.b"}), ("application", {"label": fa.ResourceRef(0x7F010000)})])
+    assert fa.parse_manifest(manifest)["app_name"] is None
+
+
+@pytest.mark.parametrize("manifest", [
+    b"",
+    struct.pack("<HHI", 0x0002, 8, 16) + b"\0" * 8,  # not an XML document
+    MANIFEST[:8] + struct.pack("<HHI", fa.RES_STRING_POOL_TYPE, 28, 4),  # chunk smaller than its header
+    MANIFEST[:len(MANIFEST) - 30],  # truncated inside an element
+])
+def test_parse_manifest_rejects_malformed_input(manifest):
+    with pytest.raises((ValueError, struct.error, IndexError)):
+        fa.parse_manifest(manifest)
+
+
+def test_parse_manifest_without_elements():
+    # A bare document header is not an error, it just declares nothing.
+    assert fa.parse_manifest(b"\x03\x00\x08\x00junk")["package"] is None
+
+
+def test_analysis_survives_malformed_manifest_and_dex(tmp_path):
+    path = tmp_path / "bad.apk"
+    path.write_bytes(build_apk({
+        "AndroidManifest.xml": MANIFEST[:40],
+        "classes.dex": CLASSES_DEX[:0x80],
+        "res/raw/a.json": b'{"u": "http://phish.top/x"}',
+    }))
+    features, score, verdict, reasons = fa.analyze_file(str(path))
+    assert not features["package"]
+    assert "http://phish.top/x" in features["urls"]
+    assert verdict in ("SAFE", "SUSPICIOUS", "MALICIOUS")
+
+
+# -----------------------------
+# DEX
+# -----------------------------
+def test_parse_dex():
+    out = fa.parse_dex(CLASSES_DEX)
+    assert out["stats"] == {"strings": len(DEX_STRINGS), "types": 2, "methods": 1, "classes": 1}
+    # "http://split" ends at its NUL; it is never joined with the next string.
+    assert out["urls"] == {"https://evil.xyz/login", "http://split", "https://ok.com/a"}
+    assert out["api_calls"] == {"Landroid/telephony/SmsManager;->sendTextMessage"}
+    assert out["packages"] == {"com.evil"}
+
+
+def test_parse_dex_at_offset_in_larger_buffer():
+    buf = b"\xff" * 100 + CLASSES_DEX + b"\xff" * 10
+    assert fa.parse_dex(buf, 100, len(CLASSES_DEX))["urls"] == fa.parse_dex(CLASSES_DEX)["urls"]
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"dey\n035\0" + CLASSES_DEX[8:],  # bad magic
+    CLASSES_DEX[:0x70],  # tables point past the end
+    CLASSES_DEX[:-1],  # last string has no terminating NUL
+])
+def test_parse_dex_rejects_malformed_input(data):
+    with pytest.raises((ValueError, struct.error, IndexError)):
+        fa.parse_dex(data)
+
+
+# -----------------------------
+# APK signing
+# -----------------------------
+def test_certificate_parsing(fingerprint):
+    cert = certificate()
+    assert fa.certificate_subject(cert) == "CN=Test Bank, O=Example"
+    assert fa.rsa_public_key(fa.certificate_public_key(cert)) == (RSA_N, RSA_E)
+    assert fingerprint == hashlib.sha256(cert).hexdigest()
+
+
+def test_signed_apk_verifies(signed_apk, fingerprint):
+    assert zipfile.ZipFile(io.BytesIO(signed_apk)).testzip() is None
+    assert fa.verify_apk_signers(signed_apk) == [fingerprint]
+    archive = fa.ApkArchive(signed_apk, walk=False)
+    try:
+        assert archive.signers == [fingerprint]
+        assert archive.signer_subjects == ["CN=Test Bank, O=Example"]
+    finally:
+        archive.close()
+
+
+def test_unsigned_apk_has_no_signers():
+    assert fa.verify_apk_signers(build_apk({"AndroidManifest.xml": MANIFEST})) == []
+
+
+def test_tampered_apk_does_not_verify(signed_apk, fingerprint):
+    entry = bytearray(signed_apk)
+    entry[signed_apk.index(b"AndroidManifest.xml") + 25] ^= 0xFF  # inside the first entry's data
+    assert fa.verify_apk_signers(bytes(entry)) == []
+
+    signature = bytearray(signed_apk)
+    block = signed_apk.index(fa.APK_SIG_BLOCK_MAGIC)
+    signature[block - 200] ^= 0xFF  # inside the RSA signature / public key
+    assert fa.verify_apk_signers(bytes(signature)) == []
+
+    # The unverified certificate is still reported, so a copied cert is visible.
+    archive = fa.ApkArchive(bytes(entry), walk=False)
+    try:
+        assert archive.signers == [fingerprint]
+    finally:
+        archive.close()
+
+
+def test_signer_status_trusts_only_verified_signers(signed_apk, fingerprint):
+    banks = fa.BankIndex(["Test Bank"], ["com.testbank.app"], {"com.testbank.app": [fingerprint]})
+    tampered = bytearray(signed_apk)
+    tampered[signed_apk.index(b"AndroidManifest.xml") + 25] ^= 0xFF
+    features = {"package": "com.testbank.app", "app_name": "Test Bank", "signers": [fingerprint]}
+
+    genuine = dict(features, verified_signers=fa.verify_apk_signers(signed_apk))
+    assert fa.score_features(genuine, banks)[2][0].code == "official_signer"
+
+    copied = dict(features, verified_signers=fa.verify_apk_signers(bytes(tampered)))
+    _, reasons = fa.compute_heuristic_score(copied, banks)
+    assert "signer_mismatch" in [r.code for r in reasons]
+
+
+def test_full_analysis_records_verified_signers(signed_apk, fingerprint, tmp_path, monkeypatch):
+    # The bank registers another key, so the analysis is not cut short as official.
+    banks = fa.BankIndex(["Test Bank"], ["com.testbank.app"], {"com.testbank.app": ["00" * 32]})
+    monkeypatch.setattr(fa.bank_index, "get", lambda version=None: banks)
+    path = tmp_path / "signed.apk"
+    path.write_bytes(signed_apk)
+    features, _, _, reasons = fa.analyze_file(str(path))
+    assert features["package"] == "com.testbank.app"
+    assert features["verified_signers"] == [fingerprint]
+    assert "https://evil.xyz/login" in features["urls"]
+    assert "signer_mismatch" in [r.code for r in reasons]
+
+
+def test_analysis_skips_verification_without_a_bank_claim(signed_apk, fingerprint, tmp_path, monkeypatch):
+    banks = fa.BankIndex(["Other Bank"], ["com.otherbank"], {"com.otherbank": [fingerprint]})
+    monkeypatch.setattr(fa.bank_index, "get", lambda version=None: banks)
+
+    def fail(data):
+        raise AssertionError("the whole APK was hashed")
+
+    monkeypatch.setattr(fa, "verify_apk_signers", fail)
+    path = tmp_path / "signed.apk"
+    path.write_bytes(sign_v2(build_apk({"AndroidManifest.xml": MANIFEST, "classes.dex": CLASSES_DEX}), certificate("Other")))
+    features, _, _, _ = fa.analyze_file(str(path))
+    assert features["package"] == "com.testbank.app"
+    assert features["verified_signers"] == []
+    budget = fa.ExtractionBudget().state()
+    assert fa.analyze_stage(str(path), "manifest", budget=budget)[0]["verified_signers"] == []
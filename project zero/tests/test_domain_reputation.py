@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+import final_app as fa
+
+
+@pytest.fixture
+def suffixes():
+    return fa.PublicSuffixTrie(["com", "co.uk", "uk", "ck", "*.ck", "!www.ck", "github.io"])
+
+
+@pytest.mark.parametrize("host, domain", [
+    ("login.bank.com", "bank.com"),
+    ("a.b.bank.co.uk", "bank.co.uk"),
+    ("evil.github.io", "evil.github.io"),
+    ("shop.example.ck", "shop.example.ck"),  # *.ck: every second-level name is a suffix
+    ("www.ck", "www.ck"),  # !www.ck: the exception is registrable itself
+    ("a.www.ck", "www.ck"),
+    ("host.unlisted", "host.unlisted"),  # no rule: the last label is the suffix
+    ("10.0.0.1", "10.0.0.1"),
+])
+def test_registrable_domain(suffixes, host, domain):
+    assert suffixes.registrable_domain(host) == domain
+
+
+@pytest.mark.parametrize("host", ["com", "co.uk", "example.ck", "github.io"])
+def test_public_suffix_has_no_registrable_domain(suffixes, host):
+    assert suffixes.registrable_domain(host) is None
+
+
+def test_suffix_file_rules_and_comments(tmp_path):
+    path = tmp_path / "psl.dat"
+    path.write_text("// comment\n\nkawasaki.jp\n*.kawasaki.jp\n!city.kawasaki.jp\n", encoding="utf-8")
+    trie = fa.PublicSuffixTrie.from_file(str(path))
+    assert trie.registrable_domain("a.b.kawasaki.jp") == "a.b.kawasaki.jp"
+    assert trie.registrable_domain("x.city.kawasaki.jp") == "city.kawasaki.jp"
+    assert trie.registrable_domain("shop.co.in") == "shop.co.in"  # built-in rules are kept
+
+
+def write_list(path, text, mtime_ns):
+    path.write_text(text, encoding="utf-8")
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_domain_set_compiles_and_binary_searches(tmp_path):
+    path = tmp_path / "block.txt"
+    names = [f"d{i}.example" for i in range(500)]
+    write_list(path, "# feed\n0.0.0.0 hosts.example  # hosts-file line\n*.wild.example\nUPPER.Example.\n"
+               + "\n".join(names) + "\n", 1_000_000_000)
+    ds = fa.DomainSet(str(path)).load()
+    assert len(ds) == 503
+    for name in ["hosts.example", "wild.example", "upper.example", names[0], names[250], names[-1]]:
+        assert name in ds
+    for name in ["0.0.0.0", "feed", "d500.example", "example", "sub.d1.example"]:
+        assert name not in ds
+    assert os.path.exists(str(path) + ".idx")
+
+
+def test_domain_set_reuses_or_rebuilds_its_index(tmp_path, monkeypatch):
+    path = tmp_path / "block.txt"
+    write_list(path, "a.example\n", 1_000_000_000)
+    fa.DomainSet(str(path)).load()
+
+    def fail(self, st):
+        raise AssertionError("index rebuilt")
+
+    with monkeypatch.context() as m:
+        m.setattr(fa.DomainSet, "compile", fail)
+        assert "a.example" in fa.DomainSet(str(path)).load()
+
+    write_list(path, "b.example\n", 2_000_000_000)
+    reloaded = fa.DomainSet(str(path)).load()
+    assert "b.example" in reloaded and "a.example" not in reloaded
+
+
+def test_missing_or_empty_lists_match_nothing(tmp_path):
+    assert "a.example" not in fa.DomainSet(str(tmp_path / "missing.txt")).load()
+    write_list(tmp_path / "empty.txt", "# nothing yet\n", 1_000_000_000)
+    empty = fa.DomainSet(str(tmp_path / "empty.txt")).load()
+    assert len(empty) == 0 and "a.example" not in empty
+
+
+def test_host_status_checks_parent_domains_and_allowlist_wins(tmp_path):
+    write_list(tmp_path / "block.txt", "evil.com\nphish.top\n", 1_000_000_000)
+    write_list(tmp_path / "allow.txt", "good.phish.top\n", 1_000_000_000)
+    reputation = fa.DomainReputation(
+        str(tmp_path / "psl.dat"), str(tmp_path / "block.txt"), str(tmp_path / "allow.txt")
+    )
+    assert reputation.host_status("login.evil.com") == ("block", "evil.com")
+    assert reputation.host_status("good.phish.top") == ("allow", "phish.top")
+    assert reputation.host_status("bank.com") == (None, "bank.com")
+    assert reputation.host_status("co.uk") == (None, None)
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+import final_app as fa
+
+
+def test_every_rule_permission_has_a_bit():
+    assert fa.DANGEROUS_PERMS <= fa.PERMISSION_BIT.keys()
+    for rule in fa.PERMISSION_RULES:
+        assert rule.mask
+
+
+def test_rule_with_untracked_permission_fails():
+    with pytest.raises(ValueError, match="android.permission.NEW_DANGEROUS"):
+        fa.PermissionRule("x", ["android.permission.READ_SMS", "android.permission.NEW_DANGEROUS"], "", points=1)
+
+
+def test_dangerous_permissions_score_counts_every_entry():
+    mask = fa.permission_mask(sorted(fa.DANGEROUS_PERMS))
+    points, reason = fa.PERMISSION_COUNT_RULES[0].evaluate(mask)
+    assert reason.detail.startswith(f"Requests {len(fa.DANGEROUS_PERMS)} dangerous permissions")
+    assert fa.vectorized_permission_points(np.array([mask], dtype=np.int64))[0] >= points